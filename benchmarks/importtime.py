@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Measure the import time of each dotsecrets subcommand.
+
+Each subcommand is loaded in a fresh interpreter started with
+``python -X importtime``. The best time over a number of runs is compared
+with the budget recorded in ``import_budget.json``. The script exits with
+status 1 when a subcommand exceeds its budget or imports a module it is
+not supposed to import.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from pathlib import Path
+
+
+BUDGET_FILE = Path(__file__).with_name('import_budget.json')
+
+LOAD_COMMAND = """\
+import sys
+from dotsecrets.main import load_command
+load_command({!r})
+print(' '.join(sorted(sys.modules)))
+"""
+
+
+def measure(command):
+    """Return import time in milliseconds and the imported modules."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           LOAD_COMMAND.format(command)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    total_us = 0
+    after_startup = False
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        if name.startswith(' ' * 2):
+            # Nested import, already part of the cumulative time
+            continue
+        name = name.strip()
+        if name == 'site':
+            # Everything up to site is interpreter startup
+            after_startup = True
+            continue
+        if after_startup:
+            total_us += int(fields[1])
+    return total_us / 1000, set(proc.stdout.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs per subcommand, '
+                             'default is %(default)s')
+    parser.add_argument('--record', action='store_true',
+                        help='record measured times with 50%% headroom '
+                             'as new budget')
+    args = parser.parse_args()
+
+    budget = json.loads(BUDGET_FILE.read_text())
+    results = {}
+    failed = False
+    for command, limits in sorted(budget.items()):
+        times = []
+        for i in range(args.repeat):
+            import_ms, modules = measure(command)
+            times.append(import_ms)
+        best_ms = min(times)
+        forbidden = sorted(set(limits.get('forbidden', [])) & modules)
+        ok = best_ms <= limits['max_ms'] and not forbidden
+        failed = failed or not ok
+        results[command] = {'import_ms': round(best_ms, 2),
+                            'max_ms': limits['max_ms'],
+                            'forbidden_imported': forbidden,
+                            'ok': ok}
+        if args.record:
+            limits['max_ms'] = round(best_ms * 1.5, 1)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if args.record:
+        BUDGET_FILE.write_text(json.dumps(budget, indent=2,
+                                          sort_keys=True) + '\n')
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Measure the throughput of the dotsecrets clean and smudge filters.
+
+Each case generates a synthetic dotfile together with a filter definition
+and a secrets store. The time to set up the filters and the throughput of
+``CleanFilter.sub``, ``SmudgeFilter.sub``, ``clean_stream`` and
+``smudge_stream`` are measured, as well as the peak Python memory of the
+stream functions. Smudging the cleaned file must give back the original
+file, otherwise the case fails.
+
+Results are written as JSON. Pass the results of an earlier run (or an
+earlier release) with ``--compare`` to report the relative change and exit
+with status 1 on a throughput regression beyond the tolerance.
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pathlib import Path
+
+from dotsecrets.clean import CleanFilter, clean_stream
+from dotsecrets.metadata import __version__
+from dotsecrets.smudge import SmudgeFilter, smudge_stream
+
+
+KEYWORDS = ('(?#QuotedString)',
+            '(?#QuotedOrSingleWord)',
+            '(?#WSUpToHash)',
+            '(?#WSUpToSemicolon)')
+
+DEFAULT_CASE = {
+    'lines': 20000,
+    'min_len': 10,
+    'max_len': 100,
+    'density': 0.02,
+    'rules': 20,
+    'secrets': 1000,
+    'numbered': 0.5,
+    'buffered': None,
+    'seed': 1,
+}
+
+CASES = {
+    'small': dict(DEFAULT_CASE, lines=1000, rules=1, secrets=10,
+                  density=0.05),
+    'typical': dict(DEFAULT_CASE),
+    'many_rules': dict(DEFAULT_CASE, rules=200, secrets=10000),
+    'dense': dict(DEFAULT_CASE, density=0.5, secrets=10000),
+    'long_lines': dict(DEFAULT_CASE, lines=2000, min_len=500, max_len=5000),
+    'large_store': dict(DEFAULT_CASE, rules=50, secrets=100000),
+    'large_file': dict(DEFAULT_CASE, lines=200000),
+    'large_file_lines': dict(DEFAULT_CASE, lines=200000, buffered=False),
+}
+
+# Throughput metrics compared between runs, higher is better
+THROUGHPUT_METRICS = ('clean_sub_mbs', 'smudge_sub_mbs',
+                      'clean_stream_mbs', 'smudge_stream_mbs')
+
+
+def random_words(rng, length):
+    words = []
+    size = 0
+    while size < length:
+        word = ''.join(rng.choice(string.ascii_lowercase)
+                       for i in range(rng.randint(2, 10)))
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def secret_value(rng, keyword):
+    word = ''.join(rng.choice(string.ascii_letters + string.digits)
+                   for i in range(rng.randint(8, 24)))
+    if keyword == '(?#QuotedString)':
+        return '"{}"'.format(word)
+    if keyword == '(?#QuotedOrSingleWord)':
+        return rng.choice(('{}', "'{}'")).format(word)
+    if keyword == '(?#WSUpToHash)':
+        return '{} {} # comment'.format(word, word[::-1])
+    return '{} {};'.format(word, word[::-1])
+
+
+def generate(case):
+    """Return the filter definition and content of a synthetic dotfile."""
+    rng = random.Random(case['seed'])
+    rules = {}
+    # Rules that are not numbered have the same secret on every line
+    values = {}
+    for i in range(case['rules']):
+        keyword = KEYWORDS[i % len(KEYWORDS)]
+        numbered = rng.random() < case['numbered']
+        rules['opt{}'.format(i)] = {
+            'regex': r'opt{}(\s*)=(\s*){}'.format(i, keyword),
+            'substitute': r'opt{}\1=\2(?#Key)'.format(i),
+            'numbered': numbered,
+        }
+        if not numbered:
+            values[i] = secret_value(rng, keyword)
+    lines = []
+    for i in range(case['lines']):
+        length = rng.randint(case['min_len'], case['max_len'])
+        if rules and rng.random() < case['density']:
+            n = rng.randrange(case['rules'])
+            keyword = KEYWORDS[n % len(KEYWORDS)]
+            value = values.get(n) or secret_value(rng, keyword)
+            line = 'opt{} = {}'.format(n, value)
+            if len(line) < length and keyword not in KEYWORDS[2:]:
+                line += ' ' + random_words(rng, length - len(line))
+        else:
+            line = '# ' + random_words(rng, length)
+        lines.append(line + '\n')
+    return {'rules': rules, 'buffered': case['buffered']}, ''.join(lines)
+
+
+def make_secrets(case, content, cleaned):
+    """Return a secrets store that smudges cleaned back to content."""
+    secrets = {}
+    clean_lines = cleaned.splitlines(keepends=True)
+    for line, clean_line in zip(content.splitlines(keepends=True),
+                                clean_lines):
+        if line == clean_line:
+            continue
+        # Lines of a single secret, the value follows ' = '
+        head, sep, tail = clean_line.partition(' = $DotSecrets: ')
+        key, sep, rest = tail.partition('$')
+        secrets[key] = {'secret': line[len(head) + 3:len(line) - len(rest)]}
+    n = 0
+    while len(secrets) < case['secrets']:
+        secrets['unused_{}'.format(n)] = {'secret': 'unused'}
+        n += 1
+    return secrets
+
+
+def reset(clean_filter):
+    # Releases before 0.5 lack CleanFilter.reset
+    for rule in clean_filter.rules.values():
+        rule.n = 0
+
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def mbs(size, seconds):
+    return round(size / seconds / 10**6, 2) if seconds else None
+
+
+def run_case(case, repeat, tmp_path):
+    filter_def, content = generate(case)
+    size = len(content.encode('utf-8'))
+    lines = content.splitlines(keepends=True)
+    setup_start = time.perf_counter()
+    clean_filter = CleanFilter('bench', filter_def)
+    clean_setup = time.perf_counter() - setup_start
+
+    def clean_lines():
+        reset(clean_filter)
+        return [clean_filter.sub(line) for line in lines]
+
+    cleaned = ''.join(clean_lines())
+    secrets = make_secrets(case, content, cleaned)
+    setup_start = time.perf_counter()
+    smudge_filter = SmudgeFilter('bench', json.loads(json.dumps(secrets)))
+    smudge_setup = time.perf_counter() - setup_start
+    smudge_filter.buffered = case['buffered']
+    clean_lines_list = cleaned.splitlines(keepends=True)
+
+    def smudge_lines():
+        return [smudge_filter.sub(line) for line in clean_lines_list]
+
+    input_file = tmp_path.joinpath('input')
+    cleaned_file = tmp_path.joinpath('cleaned')
+    smudged_file = tmp_path.joinpath('smudged')
+    input_file.write_bytes(content.encode('utf-8'))
+
+    def clean_file():
+        reset(clean_filter)
+        clean_stream(input_file, cleaned_file, clean_filter)
+
+    def smudge_file():
+        smudge_stream(cleaned_file, smudged_file, smudge_filter)
+
+    clean_file()
+    smudge_file()
+    verified = (''.join(smudge_lines()) == content and
+                smudged_file.read_bytes() == input_file.read_bytes())
+    return {
+        'params': case,
+        'size_bytes': size,
+        'secret_lines': sum(1 for line, clean_line in
+                            zip(lines, clean_lines_list)
+                            if line != clean_line),
+        'verified': verified,
+        'clean_setup_ms': round(clean_setup * 1000, 2),
+        'smudge_setup_ms': round(smudge_setup * 1000, 2),
+        'clean_sub_mbs': mbs(size, best_time(clean_lines, repeat)),
+        'smudge_sub_mbs': mbs(size, best_time(smudge_lines, repeat)),
+        'clean_stream_mbs': mbs(size, best_time(clean_file, repeat)),
+        'smudge_stream_mbs': mbs(size, best_time(smudge_file, repeat)),
+        'clean_stream_peak_bytes': peak_memory(clean_file),
+        'smudge_stream_peak_bytes': peak_memory(smudge_file),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return relative change of throughput and whether it regressed."""
+    changes = {}
+    regressed = False
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['params'] != result['params']:
+            continue
+        changes[name] = {}
+        for metric in THROUGHPUT_METRICS:
+            if not base.get(metric) or not result.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            changes[name][metric] = round(change, 3)
+            regressed = regressed or change < -tolerance
+    return changes, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--case', action='append', choices=sorted(CASES),
+                        help='case to run, can be given multiple times, '
+                             'default is all cases')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs per measurement, '
+                             'default is %(default)s')
+    parser.add_argument('--quick', action='store_true',
+                        help='generate a tenth of the lines of each case')
+    parser.add_argument('--output', type=Path,
+                        help='write results to file instead of stdout')
+    parser.add_argument('--compare', type=Path, metavar='FILE',
+                        help='compare throughput with results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative throughput loss when '
+                             'comparing, default is %(default)s')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in args.case or sorted(CASES):
+            case = dict(CASES[name])
+            if args.quick:
+                case['lines'] = max(case['lines'] // 10, 1)
+            results[name] = run_case(case, args.repeat, Path(tmp_dir))
+    report = {
+        'dotsecrets': __version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    failed = not all(result['verified'] for result in results.values())
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())['results']
+        report['changes'], regressed = compare(results, baseline,
+                                               args.tolerance)
+        failed = failed or regressed
+    data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output is not None:
+        args.output.write_text(data)
+    else:
+        sys.stdout.write(data)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+
+from pathlib import Path
+
+from dotsecrets.params import (DOTSECRETS_AGENT_SOCK,
+                               DOTSECRETS_AGENT_TIMEOUT,
+                               DOTSECRETS_AGENT_REQUEST_MAX)
+from dotsecrets.patterns import resolve_name
+
+
+logger = logging.getLogger(__name__)
+
+
+class AgentError(Exception):
+    pass
+
+
+def get_peer_uid(sock):
+    """Return the user id of the connected peer, None when unknown."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        peer_uid = get_peer_uid(self.connection)
+        if peer_uid is not None and peer_uid != os.getuid():
+            logger.warning("Refusing agent connection from uid %d.",
+                           peer_uid)
+            return
+        line = self.rfile.readline(DOTSECRETS_AGENT_REQUEST_MAX)
+        try:
+            request = json.loads(line.decode('utf-8'))
+            response = self.server.lookup(request['filter'])
+        except (ValueError, KeyError, TypeError) as exc:
+            response = {'error': 'invalid request: %s' % exc}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class AgentServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """Serve secrets of a single filter on request.
+
+    The secrets store is loaded once and kept in memory of the agent.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_file, secrets_file=None, secrets_dict=None):
+        self.socket_file = socket_file
+        self.secrets_file = secrets_file
+        self.secrets_dict = secrets_dict
+        if self.secrets_dict is None:
+            self.reload()
+        # Socket is created readable and writable for the user only
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(str(socket_file), AgentHandler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(str(socket_file), 0o600)
+
+    def reload(self):
+        # Imported here as the smudge module uses the agent client
+        from dotsecrets.smudge import load_all_secrets
+        self.secrets_dict, self.secrets_file = \
+            load_all_secrets(self.secrets_file)
+        logger.info("Agent loaded secrets store '%s'.", self.secrets_file)
+
+    def lookup(self, name):
+        try:
+            filters = self.secrets_dict['filters']
+            secrets_def = filters[resolve_name(name, filters)]
+        except KeyError:
+            return {'found': False, 'store': str(self.secrets_file)}
+        return {'found': True, 'store': str(self.secrets_file),
+                'definition': secrets_def}
+
+    def server_close(self):
+        super().server_close()
+        try:
+            self.socket_file.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def query_agent(socket_file, name):
+    """Ask the agent for the secrets of a filter.
+
+    Returns the filter definition and the store name of the agent, raises
+    KeyError when the store has no such filter and AgentError when the
+    agent can not be reached.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DOTSECRETS_AGENT_TIMEOUT)
+            sock.connect(str(socket_file))
+            sock.sendall(json.dumps({'filter': name}).encode('utf-8') +
+                         b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        response = json.loads(b''.join(chunks).decode('utf-8'))
+    except (OSError, ValueError) as exc:
+        raise AgentError("Unable to query agent '%s': %s" %
+                         (socket_file, exc))
+    if 'error' in response:
+        raise AgentError("Agent '%s' refused request: %s" %
+                         (socket_file, response['error']))
+    if not response['found']:
+        raise KeyError(name)
+    return response['definition'], response['store']
+
+
+def print_agent_env(socket_file, pid):
+    print("{0}={1}; export {0};".format(DOTSECRETS_AGENT_SOCK, socket_file))
+    print("echo Agent pid {};".format(pid))
+    sys.stdout.flush()
+
+
+def serve(server, socket_dir=None):
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    def reload(signum, frame):
+        try:
+            server.reload()
+        except Exception as exc:
+            logger.error("Agent failed to reload secrets store: %s", exc)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, reload)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if socket_dir is not None:
+            socket_dir.rmdir()
+    return 0
+
+
+def agent(args):
+    socket_dir = None
+    if args.socket is None:
+        socket_dir = Path(tempfile.mkdtemp(prefix='dotsecrets-'))
+        socket_file = socket_dir.joinpath('agent.{}'.format(os.getpid()))
+    else:
+        socket_file = args.socket
+    try:
+        server = AgentServer(socket_file, args.store)
+    except BaseException:
+        if socket_dir is not None:
+            socket_dir.rmdir()
+        raise
+    if args.foreground:
+        print_agent_env(socket_file, os.getpid())
+        return serve(server, socket_dir)
+    pid = os.fork()
+    if pid:
+        # Parent only reports where to find the agent
+        server.socket.close()
+        print_agent_env(socket_file, pid)
+        return 0
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    os._exit(serve(server, socket_dir))
@@ -0,0 +1,302 @@
+import logging
+import os
+import re
+import subprocess
+
+from dotsecrets.clean import CleanFilter, TimeBudget, load_all_filters
+from dotsecrets.params import (AUDIT_BATCH_SIZE,
+                               AUDIT_READ_SIZE,
+                               TAG_SECRET_START,
+                               TAG_SECRET_END)
+from dotsecrets.patterns import resolve_name
+from dotsecrets.redact import Redactor
+from dotsecrets.smudge import load_all_secrets
+from dotsecrets.utils import get_dotfiles_path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Object id of a missing side in a raw diff
+NULL_OID = b'0' * 40
+
+# Git links point to commits of submodules, not to blobs
+GITLINK_MODE = b'160000'
+
+# Scanners already set up in this process, by token
+scanners = {}
+
+# Secret tags written by clean, whatever their key or number
+tag_regex = re.compile(re.escape(TAG_SECRET_START) + r'\S+?' +
+                       re.escape(TAG_SECRET_END))
+EMPTY_TAG = TAG_SECRET_START + TAG_SECRET_END
+
+
+class AuditError(Exception):
+    pass
+
+
+class AuditScanner(object):
+    """Find secret values and uncleaned rule matches in blobs.
+
+    Values of all secrets in the store are searched in every blob. The
+    rules of a filter are only applied to blobs at a path using the
+    filter, a match is not cleaned when its substitute differs from it
+    other than in the key of a tag. Only the secrets and filter
+    definitions are sent to other processes, each process sets up the
+    search once.
+    """
+    def __init__(self, secrets, filters, token=None):
+        # Secret values by filter name and key
+        self.secrets = secrets
+        self.filters = filters
+        self.token = token or os.urandom(8).hex()
+        self.redactor = None
+        self.clean_filters = {}
+
+    def __getstate__(self):
+        return {'secrets': self.secrets, 'filters': self.filters,
+                'token': self.token}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_redactor(self):
+        if self.redactor is None:
+            self.redactor = Redactor(self.secrets)
+        return self.redactor
+
+    def filter_name(self, path):
+        """Return the name of the filter applying to path, else None."""
+        name = resolve_name(path, self.filters)
+        if name not in self.filters:
+            return None
+        return name
+
+    def get_clean_filter(self, path):
+        name = self.filter_name(path)
+        if name is None:
+            return None
+        if name not in self.clean_filters:
+            self.clean_filters[name] = CleanFilter(name, self.filters[name])
+        clean_filter = self.clean_filters[name]
+        # Number tags from the start of each blob, like clean does
+        clean_filter.reset()
+        return clean_filter
+
+    def scan(self, path, data, values=True, rules=True):
+        """Return line number, kind, filter and key of each hit."""
+        text = data.decode('utf-8', 'replace')
+        hits = []
+        redactor = self.get_redactor()
+        if values and redactor.keys:
+            for start, length, value in sorted(redactor.find(text)):
+                name, key = redactor.keys[value]
+                hits.append((text.count('\n', 0, start) + 1, 'secret',
+                             name, key))
+        clean_filter = self.get_clean_filter(path) if rules else None
+        if clean_filter is not None:
+            for lineno, line in enumerate(text.splitlines(True), 1):
+                for rule in clean_filter.rules.values():
+                    if is_uncleaned(rule, line):
+                        hits.append((lineno, 'rule', clean_filter.name,
+                                     rule.key))
+        return sorted(hits)
+
+
+def is_uncleaned(rule, line):
+    """Check whether a clean rule would replace more than a tag in line."""
+    if rule.literal is not None and rule.literal not in line:
+        return False
+    if rule.time_budget:
+        with TimeBudget(rule, line):
+            return has_uncleaned_match(rule, line)
+    return has_uncleaned_match(rule, line)
+
+
+def has_uncleaned_match(rule, line):
+    found = False
+    for m in rule.regex.finditer(line):
+        # Counted like CleanSecret.expand, which would log the secret
+        rule.n += 1
+        subs = m.expand(rule.substitute)
+        if tag_regex.sub(EMPTY_TAG, subs) != \
+                tag_regex.sub(EMPTY_TAG, m.group(0)):
+            found = True
+    return found
+
+
+def scan_blobs(scanner, blobs):
+    """Scan a batch of blobs read by iter_blob_batches."""
+    scanner = scanners.setdefault(scanner.token, scanner)
+    results = []
+    for seq, commit, path, data, values, rules in blobs:
+        try:
+            hits = scanner.scan(path, data, values, rules)
+        except Exception as exc:
+            hits = [(0, 'error', None, str(exc))]
+        results.extend((seq, commit, path) + hit for hit in hits)
+    return results
+
+
+def iter_nul_tokens(stream):
+    pending = b''
+    while True:
+        chunk = stream.read(AUDIT_READ_SIZE)
+        if not chunk:
+            break
+        tokens = (pending + chunk).split(b'\0')
+        pending = tokens.pop()
+        yield from tokens
+    if pending:
+        yield pending
+
+
+def iter_new_blobs(stream):
+    """Yield commit, path and blob id added by commits in a raw log.
+
+    The log is written by git log with a raw diff per commit, separated
+    by NUL characters and every commit id prefixed by \\x01.
+    """
+    commit = None
+    tokens = iter_nul_tokens(stream)
+    for token in tokens:
+        token = token.lstrip(b'\n')
+        if token.startswith(b'\x01'):
+            commit = token[1:].decode('ascii')
+        elif token.startswith(b':'):
+            old_mode, new_mode, old_oid, new_oid, status = \
+                token[1:].split(b' ')
+            path = os.fsdecode(next(tokens))
+            if new_oid != NULL_OID and new_mode != GITLINK_MODE:
+                yield commit, path, new_oid
+
+
+class BlobReader(object):
+    """Read blob contents from a single git cat-file --batch process."""
+    def __init__(self, cwd):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     cwd=cwd)
+
+    def read(self, oid):
+        self.proc.stdin.write(oid + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise AuditError("Unable to read blob %s" % oid.decode('ascii'))
+        size = int(header[2])
+        data = self.proc.stdout.read(size + 1)
+        return data[:size]
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def iter_blob_batches(dotfiles_path, revs, scanner):
+    """Yield batches of the blobs added in the history of revs.
+
+    Commits are listed oldest first. Values are searched in a blob once,
+    at the first commit adding it. Rules are applied once per blob and
+    filter, at the first commit adding it at a path using the filter. A
+    batch holds blobs of about AUDIT_BATCH_SIZE bytes in total.
+    """
+    log = subprocess.Popen(['git', 'log', '--raw', '--no-abbrev',
+                            '--no-renames', '-m', '--root', '-z',
+                            '--reverse', '--date-order',
+                            '--format=%x01%H'] + revs + ['--'],
+                           stdout=subprocess.PIPE,
+                           cwd=str(dotfiles_path))
+    reader = BlobReader(str(dotfiles_path))
+    seen = set()
+    seen_rules = set()
+    batch = []
+    batch_size = 0
+    try:
+        for seq, (commit, path, oid) in enumerate(
+                iter_new_blobs(log.stdout)):
+            # Binary ids keep the sets of seen blobs small
+            key = bytes.fromhex(oid.decode('ascii'))
+            values = key not in seen
+            name = scanner.filter_name(path)
+            rules = name is not None and (key, name) not in seen_rules
+            if not values and not rules:
+                continue
+            seen.add(key)
+            if rules:
+                seen_rules.add((key, name))
+            data = reader.read(oid)
+            batch.append((seq, commit, path, data, values, rules))
+            batch_size += len(data)
+            if batch_size >= AUDIT_BATCH_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+    finally:
+        reader.close()
+        log.stdout.close()
+        returncode = log.wait()
+    if returncode != 0:
+        raise AuditError("Git log of %s failed" % ' '.join(revs))
+    logger.info("Audited %d blobs.", len(seen))
+
+
+def audit_history(dotfiles_path, revs, scanner, jobs=None):
+    """Return a sorted list of the hits in all blobs in history."""
+    results = []
+    if jobs == 1:
+        for batch in iter_blob_batches(dotfiles_path, revs, scanner):
+            results.extend(scan_blobs(scanner, batch))
+        return sorted(results)
+    # The process pool machinery is only needed for parallel audits
+    from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                    wait)
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # The first task forks all workers, before Git is started. Workers
+        # inheriting the input of cat-file keep it from seeing its end.
+        executor.submit(os.getpid).result()
+        # Bound the number of batches in memory
+        max_pending = jobs * 2
+        pending = set()
+        for batch in iter_blob_batches(dotfiles_path, revs, scanner):
+            pending.add(executor.submit(scan_blobs, scanner, batch))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results.extend(future.result())
+        for future in pending:
+            results.extend(future.result())
+    return sorted(results)
+
+
+def get_audit_scanner(filters_file=None, secrets_file=None):
+    filters_dict, filters_file = load_all_filters(filters_file)
+    secrets_dict, secrets_file = load_all_secrets(secrets_file)
+    secrets = {}
+    for name, secrets_def in (secrets_dict.get('filters') or {}).items():
+        for key, secret_def in ((secrets_def or {}).get('secrets') or
+                                {}).items():
+            secrets[(name, key)] = (secret_def or {}).get('secret')
+    return AuditScanner(secrets, filters_dict.get('filters') or {})
+
+
+def audit(args):
+    scanner = get_audit_scanner(args.filters, args.store)
+    revs = args.revs or ['--all']
+    results = audit_history(get_dotfiles_path(), revs, scanner, args.jobs)
+    for seq, commit, path, lineno, kind, name, key in results:
+        # Never show the secret itself, only where it was found
+        if kind == 'error':
+            print("{}:{}: error: {}".format(commit, path, key))
+        else:
+            print("{}:{}:{}: {} '{}' of filter '{}'".format(
+                commit, path, lineno, kind, key, name))
+    if results:
+        logger.error("Found %d secrets in history.", len(results))
+        return 1
+    return 0
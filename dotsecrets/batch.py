@@ -0,0 +1,162 @@
+import logging
+import os
+import random
+import shutil
+import string
+import sys
+
+from pathlib import Path
+
+from dotsecrets.clean import load_all_filters, get_clean_filter
+from dotsecrets.compat import resolve
+from dotsecrets.redact import configure_redaction
+from dotsecrets.smudge import (load_all_secrets,
+                               get_smudge_filter,
+                               configure_smudge_filter)
+from dotsecrets.stream import sub_file
+from dotsecrets.utils import get_dotfiles_path, is_sub_path
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_paths(path_file, null_separated=False):
+    """Read paths from a file, '-' means stdin."""
+    if path_file == '-':
+        content = sys.stdin.buffer.read()
+    else:
+        content = Path(path_file).read_bytes()
+    separator = b'\0' if null_separated else b'\n'
+    return [os.fsdecode(path) for path in content.split(separator) if path]
+
+
+def get_name(dotfiles_path, path):
+    """Return the name of a path within the dotfiles repository.
+
+    Symbolic links, such as the ones created by stow, are followed into
+    the repository. Raises ValueError for paths outside the repository.
+    """
+    source_file = resolve(Path(path).absolute())
+    dotfiles_path = resolve(dotfiles_path)
+    if not is_sub_path(source_file, dotfiles_path) or \
+            source_file == dotfiles_path:
+        raise ValueError("'{}' is not within dotfiles repository "
+                         "'{}'".format(path, dotfiles_path))
+    return source_file.relative_to(dotfiles_path).as_posix(), source_file
+
+
+def filter_file(input_file, output_file, text_filter):
+    """Filter input file to output file through a temporary file.
+
+    The output file is replaced at once and gets the mode of the input.
+    """
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    random_string = ''.join([random.choice(string.ascii_lowercase)
+                             for i in range(16)])
+    tmp_file = output_file.with_name(output_file.name + '.' +
+                                     random_string)
+    try:
+        sub_file(input_file, tmp_file, text_filter)
+        shutil.copymode(str(input_file), str(tmp_file))
+        tmp_file.replace(output_file)
+    except BaseException:
+        try:
+            tmp_file.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def get_batch_filter(command, name, filters_file, filters_dict,
+                     secrets_file, secrets_dict):
+    clean_filter = get_clean_filter(name, filters_file, filters_dict)
+    if command == 'clean' and not getattr(clean_filter, 'redact', False):
+        return clean_filter
+    smudge_filter = get_smudge_filter(name, secrets_file, secrets_dict)
+    if command == 'clean':
+        configure_redaction(clean_filter, smudge_filter)
+        return clean_filter
+    configure_smudge_filter(smudge_filter, clean_filter)
+    return smudge_filter
+
+
+def filter_files(jobs_list, jobs=None):
+    """Filter files on a process pool.
+
+    The jobs list holds tuples of name, input file, output file and
+    filter. Returns a dictionary of name to None for success or to the
+    error message of a failure.
+    """
+    status = {}
+    if jobs == 1 or len(jobs_list) < 2:
+        for name, input_file, output_file, text_filter in jobs_list:
+            try:
+                filter_file(input_file, output_file, text_filter)
+                status[name] = None
+            except Exception as exc:
+                status[name] = str(exc)
+        return status
+    # The process pool machinery is only needed for many files
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(filter_file, input_file,
+                                   output_file, text_filter): name
+                   for name, input_file, output_file, text_filter
+                   in jobs_list}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                status[name] = None
+            except Exception as exc:
+                status[name] = str(exc)
+    return status
+
+
+def batch(args):
+    paths = list(args.paths)
+    if args.paths_from is not None:
+        paths.extend(read_paths(args.paths_from, args.null))
+    if not paths:
+        logger.error("No paths to %s.", args.batch_command)
+        return 1
+    filters_dict, filters_file = load_all_filters(args.filters)
+    secrets_dict = secrets_file = None
+    if args.batch_command == 'smudge' or \
+            any(filters_def and filters_def.get('redact')
+                for filters_def in (filters_dict.get('filters') or
+                                    {}).values()):
+        secrets_dict, secrets_file = load_all_secrets(args.store)
+    dotfiles_path = get_dotfiles_path()
+    status = {}
+    jobs_list = []
+    for path in paths:
+        try:
+            name, input_file = get_name(dotfiles_path, path)
+        except (ValueError, OSError) as exc:
+            status[path] = str(exc)
+            continue
+        if name in status:
+            continue
+        status[name] = None
+        if args.in_place:
+            output_file = input_file
+        else:
+            output_file = args.output_dir.joinpath(name)
+        text_filter = get_batch_filter(args.batch_command, name,
+                                       filters_file, filters_dict,
+                                       secrets_file, secrets_dict)
+        jobs_list.append((name, input_file, output_file, text_filter))
+    status.update(filter_files(jobs_list, args.jobs))
+    failed = 0
+    for name in sorted(status):
+        if status[name] is None:
+            print('ok\t{}'.format(name))
+        else:
+            failed += 1
+            print('error\t{}\t{}'.format(name, status[name]))
+    if failed:
+        logger.error("Failed to %s %d of %d files.", args.batch_command,
+                     failed, len(status))
+        return 1
+    return 0
@@ -0,0 +1,356 @@
+import io
+import json
+import logging
+import os
+import sys
+
+from dotsecrets.metadata import VERSION
+from dotsecrets.params import (DOTFILTERS_CACHE_SIZE,
+                               DOTFILTERS_CACHE_CLEAN_MIN_SIZE,
+                               DOTFILTERS_COPY_SIZE,
+                               DOTSECRETS_COMPILED_SUFFIX)
+from dotsecrets.stream import (copy_stream, get_stream_size,
+                               sub_binary_stream, sub_bytes)
+from dotsecrets.utils import get_clean_cache_path, get_dotsecrets_runtime_path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Length in bytes of the random key of the cache entry names
+CACHE_KEY_SIZE = 32
+
+
+class CleanCache(object):
+    """Clean filter output addressed by filter definition and content.
+
+    Entries are files in the entries directory named after a keyed hash
+    (HMAC-SHA256) of the dotsecrets version, the filter definition and
+    the input. The random key is kept next to the entries, so the names
+    alone do not allow to test guesses of secrets in the input. Only
+    output that differs from its input is stored, an input left untouched
+    may hold secrets the rules missed.
+
+    Reading an entry updates its modification time. When the entries
+    exceed the maximum size, the least recently used ones are removed.
+    """
+    def __init__(self, cache_path, max_size=DOTFILTERS_CACHE_SIZE):
+        self.cache_path = cache_path
+        self.entries_path = cache_path.joinpath('entries')
+        self.key_file = cache_path.joinpath('key')
+        self.max_size = max_size
+        self.key = None
+
+    def load_key(self):
+        if self.key is not None:
+            return self.key
+        try:
+            self.key = self.key_file.read_bytes()
+        except FileNotFoundError:
+            self.key = b''
+        if len(self.key) != CACHE_KEY_SIZE:
+            self.key = os.urandom(CACHE_KEY_SIZE)
+            self.write_file(self.key_file, self.key)
+        return self.key
+
+    def write_file(self, dest_file, data):
+        # Only needed when writing, keep it out of the startup time
+        import tempfile
+        dest_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=str(dest_file.parent),
+                                        prefix='.' + dest_file.name + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, str(dest_file))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def entry_digest(self, clean_filter):
+        """Return the keyed hash of an entry, the input still to add."""
+        # Hashing takes a considerable part of the startup time, only
+        # import it when the cache is used
+        import hmac
+        definition = json.dumps(clean_filter.definition, sort_keys=True,
+                                default=str)
+        digest = hmac.new(self.load_key(), digestmod='sha256')
+        digest.update(VERSION.encode('utf-8') + b'\0')
+        digest.update(definition.encode('utf-8') + b'\0')
+        redactor = getattr(clean_filter, 'redactor', None)
+        if redactor is not None:
+            # Output depends on the secret values too
+            digest.update(json.dumps(redactor.fingerprint())
+                          .encode('utf-8') + b'\0')
+        return digest
+
+    def entry_name(self, clean_filter, data):
+        digest = self.entry_digest(clean_filter)
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, name):
+        entry_file = self.entries_path.joinpath(name)
+        try:
+            output = entry_file.read_bytes()
+            os.utime(str(entry_file))
+        except FileNotFoundError:
+            return None
+        return output
+
+    def put(self, name, output):
+        self.write_file(self.entries_path.joinpath(name), output)
+        self.evict()
+
+    def list_entries(self):
+        """Return name, size and modification time of all entries."""
+        entries = []
+        try:
+            dir_entries = list(os.scandir(str(self.entries_path)))
+        except FileNotFoundError:
+            return entries
+        for dir_entry in dir_entries:
+            if dir_entry.name.startswith('.'):
+                continue
+            try:
+                st = dir_entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((dir_entry.name, st.st_size, st.st_mtime_ns))
+        return entries
+
+    def remove(self, name):
+        try:
+            self.entries_path.joinpath(name).unlink()
+        except FileNotFoundError:
+            # Removed by another process
+            pass
+
+    def evict(self):
+        entries = self.list_entries()
+        size = sum(entry[1] for entry in entries)
+        if size <= self.max_size:
+            return
+        for name, entry_size, mtime_ns in sorted(entries,
+                                                 key=lambda e: e[2]):
+            logger.debug("Evicting clean cache entry '%s'.", name)
+            self.remove(name)
+            size -= entry_size
+            if size <= self.max_size:
+                break
+
+    def clear(self):
+        for name, size, mtime_ns in self.list_entries():
+            self.remove(name)
+        # Entries written with the old key become unreachable
+        try:
+            self.key_file.unlink()
+        except FileNotFoundError:
+            pass
+        self.key = None
+
+    def clean(self, data, clean_filter):
+        """Return the clean filter output of data, cached when possible."""
+        try:
+            name = self.entry_name(clean_filter, data)
+            output = self.get(name)
+        except OSError as exc:
+            logger.debug("Unable to read clean cache '%s': %s",
+                         self.cache_path, exc)
+            return sub_bytes(data, clean_filter)
+        if output is not None:
+            logger.debug("Clean cache hit for filter '%s'.",
+                         clean_filter.name)
+            return output
+        output = sub_bytes(data, clean_filter)
+        if output != data:
+            try:
+                self.put(name, output)
+            except OSError as exc:
+                logger.debug("Unable to write clean cache '%s': %s",
+                             self.cache_path, exc)
+        return output
+
+    def spool(self, data, input_stream, digest):
+        """Hash the input and return it as a file read from its start.
+
+        data is what was already read from the input stream. Regular files
+        are read again, other input is copied to an unnamed temporary file
+        in the private cache directory while hashing it, or to memory when
+        that fails. Without a digest the input is only spooled.
+        """
+        if get_stream_size(input_stream) is not None and \
+                input_stream.seekable():
+            start = input_stream.tell() - len(data)
+            spool_stream = None
+        else:
+            # Only needed when cleaning large inputs from a pipe
+            import tempfile
+            try:
+                self.cache_path.mkdir(mode=0o700, parents=True,
+                                      exist_ok=True)
+                spool_stream = tempfile.TemporaryFile(
+                    dir=str(self.cache_path))
+            except OSError as exc:
+                logger.debug("Unable to spool input in '%s': %s",
+                             self.cache_path, exc)
+                spool_stream = io.BytesIO()
+        while True:
+            if digest is not None:
+                digest.update(data)
+            if spool_stream is not None:
+                spool_stream.write(data)
+            data = input_stream.read(DOTFILTERS_COPY_SIZE)
+            if not data:
+                break
+        if spool_stream is None:
+            input_stream.seek(start)
+            return input_stream
+        spool_stream.seek(0)
+        return spool_stream
+
+    def clean_stream(self, data, input_stream, output_stream, clean_filter):
+        """Clean a large input stream, cached when possible.
+
+        The input is hashed while it is read and the output goes through
+        a file, neither is held in memory as a whole. data is what was
+        already read from the input stream.
+        """
+        try:
+            digest = self.entry_digest(clean_filter)
+        except OSError as exc:
+            logger.debug("Unable to read clean cache '%s': %s",
+                         self.cache_path, exc)
+            digest = None
+        input_stream = self.spool(data, input_stream, digest)
+        try:
+            if digest is None:
+                sub_binary_stream(input_stream, output_stream, clean_filter)
+                return
+            entry_file = self.entries_path.joinpath(digest.hexdigest())
+            try:
+                os.utime(str(entry_file))
+                entry_stream = entry_file.open(mode='rb')
+            except OSError as exc:
+                if not isinstance(exc, FileNotFoundError):
+                    logger.debug("Unable to read clean cache '%s': %s",
+                                 self.cache_path, exc)
+                self.clean_miss(input_stream, output_stream, clean_filter,
+                                entry_file)
+                return
+            logger.debug("Clean cache hit for filter '%s'.",
+                         clean_filter.name)
+            with entry_stream:
+                copy_stream(entry_stream, output_stream)
+        finally:
+            input_stream.close()
+
+    def clean_miss(self, input_stream, output_stream, clean_filter,
+                   entry_file):
+        """Clean input into a new entry and copy it to the output."""
+        # Only needed when writing, keep it out of the startup time
+        import tempfile
+        try:
+            self.entries_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=str(self.entries_path),
+                                            prefix='.' + entry_file.name +
+                                            '.')
+        except OSError as exc:
+            logger.debug("Unable to write clean cache '%s': %s",
+                         self.cache_path, exc)
+            sub_binary_stream(input_stream, output_stream, clean_filter)
+            return
+        start = input_stream.tell()
+        try:
+            with os.fdopen(fd, 'w+b') as tmp_stream:
+                sub_binary_stream(input_stream, tmp_stream, clean_filter)
+                tmp_stream.flush()
+                input_stream.seek(start)
+                tmp_stream.seek(0)
+                changed = not same_content(input_stream, tmp_stream)
+                tmp_stream.seek(0)
+                copy_stream(tmp_stream, output_stream)
+            if changed:
+                os.replace(tmp_name, str(entry_file))
+                self.evict()
+            else:
+                os.unlink(tmp_name)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except FileNotFoundError:
+                pass
+            raise
+
+
+def same_content(stream, other_stream):
+    """Compare two binary streams block by block."""
+    while True:
+        data = stream.read(DOTFILTERS_COPY_SIZE)
+        if data != other_stream.read(DOTFILTERS_COPY_SIZE):
+            return False
+        if not data:
+            return True
+
+
+def clean_file_cached(input_file, output_file, clean_filter):
+    """Clean input file to output file, '-' means stdio.
+
+    Inputs of at least DOTFILTERS_CACHE_CLEAN_MIN_SIZE bytes go through
+    the clean cache, smaller inputs are cleaned faster than that.
+    """
+    with (input_file.open(mode='rb') if input_file != '-'
+          else sys.stdin.buffer) as input_stream:
+        data = input_stream.read(DOTFILTERS_CACHE_CLEAN_MIN_SIZE)
+        with (output_file.open(mode='wb') if output_file != '-'
+              else sys.stdout.buffer) as output_stream:
+            if len(data) < DOTFILTERS_CACHE_CLEAN_MIN_SIZE:
+                output_stream.write(sub_bytes(data, clean_filter))
+                return
+            clean_cache = CleanCache(get_clean_cache_path())
+            clean_cache.clean_stream(data, input_stream, output_stream,
+                                     clean_filter)
+
+
+def list_shared_secrets():
+    """Return the shared secrets stores in the runtime directory."""
+    runtime_path = get_dotsecrets_runtime_path()
+    if runtime_path is None:
+        return []
+    return sorted(runtime_path.glob('secrets-*' +
+                                    DOTSECRETS_COMPILED_SUFFIX))
+
+
+def remove_shared_secrets():
+    """Remove the shared secrets stores, returns how many were removed."""
+    removed = 0
+    for shared_file in list_shared_secrets():
+        try:
+            shared_file.unlink()
+        except FileNotFoundError:
+            # Expired by another process
+            continue
+        logger.debug("Removed shared secrets '%s'.", shared_file)
+        removed += 1
+    return removed
+
+
+def cache(args):
+    clean_cache = CleanCache(get_clean_cache_path())
+    entries = clean_cache.list_entries()
+    size = sum(entry[1] for entry in entries)
+    if args.cache_command == 'clear':
+        clean_cache.clear()
+        logger.info("Removed %d entries of %d bytes from clean cache '%s'.",
+                    len(entries), size, clean_cache.cache_path)
+        # The plaintext secrets shared between smudge processes as well
+        removed = remove_shared_secrets()
+        if removed:
+            logger.info("Removed %d shared secrets stores.", removed)
+        return 0
+    print('location\t{}'.format(clean_cache.cache_path))
+    print('entries\t{}'.format(len(entries)))
+    print('size\t{}'.format(size))
+    print('max_size\t{}'.format(clean_cache.max_size))
+    print('shared_stores\t{}'.format(len(list_shared_secrets())))
+    return 0
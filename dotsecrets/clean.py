@@ -1,19 +1,20 @@
-import io
 import logging
 import re
-import sys
-
-from ruamel.yaml import YAML
 
 from dotsecrets.params import (TAG_SECRET_START,
                                TAG_SECRET_END,
                                TAG_SECRET_KEY,
                                DOTFILTERS_KEYWORD_DICT)
+from dotsecrets.index import IndexCache
+from dotsecrets.patterns import resolve_name
+from dotsecrets.scanner import RuleScanner, required_literal
+from dotsecrets.stream import sub_file
 from dotsecrets.textsub import Textsub, CopyFilter
-from dotsecrets.utils import get_dotfilters_file
+from dotsecrets.utils import (get_dotfilters_file,
+                              get_dotfilters_index_file,
+                              load_yaml)
 
 
-yaml = YAML(typ='safe')
 logger = logging.getLogger(__name__)
 
 
@@ -21,47 +22,174 @@ keyword_sub = Textsub(DOTFILTERS_KEYWORD_DICT)
 keyword_sub.compile()
 
 
+class RuleTimeoutError(Exception):
+    """Raised when a rule exceeds its time budget on a line."""
+
+
+class TimeBudget(object):
+    """Interrupt a rule that exceeds its time budget on a line.
+
+    A real time interval timer raises RuleTimeoutError from its signal
+    handler, which CPython also runs while the regex engine is matching.
+    Timers are only available on the main thread and on platforms with
+    setitimer, elsewhere the rule runs without a budget.
+    """
+    warned = False
+
+    def __init__(self, rule, line):
+        self.rule = rule
+        self.line = line
+        self.previous = None
+        self.active = False
+
+    def expired(self, signum, frame):
+        raise RuleTimeoutError("Rule '{}' exceeded its time budget of "
+                               "{:g} seconds on a line of {} characters"
+                               .format(self.rule.key, self.rule.time_budget,
+                                       len(self.line)))
+
+    def __enter__(self):
+        # Only needed for rules with a time budget
+        import signal
+        try:
+            self.previous = signal.signal(signal.SIGALRM, self.expired)
+        except (AttributeError, ValueError) as exc:
+            if not TimeBudget.warned:
+                logger.warning("Unable to enforce time budget of "
+                               "rule '%s': %s", self.rule.key, exc)
+                TimeBudget.warned = True
+            return self
+        self.active = True
+        signal.setitimer(signal.ITIMER_REAL, self.rule.time_budget)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.active:
+            import signal
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            if self.previous is None:
+                # Handler was not installed from Python
+                self.previous = signal.SIG_DFL
+            signal.signal(signal.SIGALRM, self.previous)
+
+
 class CleanFilter(object):
     def __init__(self, name, definition=None):
         if definition is None:
             definition = {'rules': {}}
         self.name = name
+        # Kept to address the output in the clean cache
+        self.definition = definition
         self.rules = {}
+        self.scanner = None
+        self.literals = None
         self.read_mode = 'r'
         self.write_mode = 'w'
         self.encoding = 'utf-8'
+        self.buffered = None
+        self.parallel = None
+        self.time_budget = None
+        # Replaces known secret values, set up from the secrets store
+        self.redact = False
+        self.redactor = None
         self.parse_definition(definition)
 
     def parse_definition(self, definition):
         self.rules = {}
         if 'encoding' in definition:
             self.encoding = definition['encoding']
+        if 'buffered' in definition:
+            self.buffered = definition['buffered']
+        if 'parallel' in definition:
+            self.parallel = definition['parallel']
+        if 'time_budget' in definition:
+            self.time_budget = definition['time_budget']
+        if 'redact' in definition:
+            self.redact = definition['redact']
         if 'rules' in definition:
             rules = definition['rules']
         else:
             rules = {}
         for key, rule_def in rules.items():
-            self.rules[key] = CleanSecret(key=key, **rule_def)
+            rule = CleanSecret(key=key, **rule_def)
+            if rule.time_budget is None:
+                rule.time_budget = self.time_budget
+            self.rules[key] = rule
+        if any(rule.time_budget for rule in self.rules.values()):
+            # The combined regex can not tell which rule is too slow
+            logger.debug("Filter '%s' has a time budget, "
+                         "scanning rules sequentially.", self.name)
+            self.scanner = None
+        else:
+            self.scanner = RuleScanner.compile(self.rules.values())
+        # Lines without any of these literals are not touched by the rules
+        self.literals = [rule.literal for rule in self.rules.values()]
+        if None in self.literals:
+            self.literals = None
+
+    def reset(self):
+        # Restart numbering of secrets, needed when the filter is reused
+        # for another file
+        for rule in self.rules.values():
+            rule.n = 0
+
+    def counters(self):
+        """Return the number of matches of each numbered rule."""
+        return {key: rule.n for key, rule in self.rules.items()
+                if rule.numbered}
+
+    def set_counters(self, counters):
+        # Continue numbering from another part of the same file
+        for key, n in counters.items():
+            self.rules[key].n = n
+
+    def set_redactor(self, redactor):
+        self.redactor = redactor
+        if redactor.keys:
+            # Known values may occur on any line
+            self.literals = None
 
     def sub(self, line):
+        if self.scanner is not None:
+            # The combined regex rejects lines faster than checking the
+            # literal of every rule
+            line = self.scanner.sub(line, self.sub_sequential)
+        else:
+            line = self.sub_sequential(line)
+        if self.redactor is not None:
+            line = self.redactor.sub(line)
+        return line
+
+    def sub_sequential(self, line):
         for rule in self.rules.values():
             line = rule.sub(line)
         return line
 
+    def log_stats(self):
+        for rule in self.rules.values():
+            logger.debug("Prefilter of rule '%s' skipped %d of %d lines.",
+                         rule.key, rule.skipped, rule.skipped + rule.scanned)
+
 
 class CleanSecret(object):
     # kwargs allows for additional keyword arguments passed
     # through YAML dictionaries
     def __init__(self, key, regex, substitute, description='', numbered=False,
-                 **kwargs):
+                 time_budget=None, **kwargs):
         # Define property internals
         self._substitute = None
         self._regex = None
         self._orig_regex = None
+        self.literal = None
+        # Regex scans done and avoided by the literal prefilter
+        self.scanned = 0
+        self.skipped = 0
         # Initialize object with arguments
         self.key = key
         self.description = description
         self.numbered = numbered
+        # Maximum seconds spent on a single line, None is unlimited
+        self.time_budget = time_budget
         self.regex = regex
         self.substitute = substitute
         self.n = 0
@@ -71,32 +199,41 @@ class CleanSecret(object):
 
     def set_regex(self, regex):
         self._orig_regex = regex
+        # Expanding an already expanded regex leaves it as is
         regex = keyword_sub.sub(regex)
         self._regex = re.compile(regex)
+        # Lines without this literal can not match the regex
+        self.literal = required_literal(self._regex)
 
     regex = property(get_regex, set_regex)
 
+    def expand(self, m):
+        self.n += 1
+        subs = m.expand(self.substitute)
+        logger.debug("Replacing '%s' with '%s'.", m.group(0), subs)
+        return subs
+
     def sub(self, line):
-        out = ''
-        prev_start = -1
-        prev_end = -1
+        if self.literal is not None and self.literal not in line:
+            self.skipped += 1
+            return line
+        self.scanned += 1
+        if self.time_budget:
+            with TimeBudget(self, line):
+                return self.sub_matches(line)
+        return self.sub_matches(line)
+
+    def sub_matches(self, line):
+        pieces = []
+        prev_end = 0
         for m in self.regex.finditer(line):
-            if prev_start == -1:
-                out += line[:m.start()]
-            else:
-                if m.start() > prev_end:
-                    out += line[prev_end:m.start()]
-            self.n += 1
-            subs = m.expand(self.substitute)
-            logger.debug("Replacing '%s' with '%s'.", m.group(0), subs)
-            out += subs
-            prev_start = m.start()
+            pieces.append(line[prev_end:m.start()])
+            pieces.append(self.expand(m))
             prev_end = m.end()
-        if prev_end != -1:
-            out += line[prev_end:]
-            return out
-        else:
+        if not pieces:
             return line
+        pieces.append(line[prev_end:])
+        return ''.join(pieces)
 
     def get_substitute(self):
         key = ''
@@ -120,16 +257,47 @@ def load_all_filters(filters_file=None):
         filters_file = get_dotfilters_file()
     logger.debug("Opening filters file '%s'.", filters_file)
     with filters_file.open(mode='r', encoding='utf-8') as f:
-        filters_dict = yaml.load(f)
+        filters_dict = load_yaml(f)
     logger.debug("Closed filters file '%s'.", filters_file)
     return filters_dict, filters_file
 
 
+def expand_filters(content):
+    """Parse filters file content and expand keywords in rule regexes."""
+    filters_dict = load_yaml(content.decode('utf-8'))
+    filters = filters_dict.get('filters') or {}
+    for filters_def in filters.values():
+        if not filters_def or not filters_def.get('rules'):
+            continue
+        for rule_def in filters_def['rules'].values():
+            if 'regex' in rule_def:
+                rule_def['regex'] = keyword_sub.sub(rule_def['regex'])
+    return filters
+
+
+def load_filter(name, filters_file=None):
+    """Load a single filter definition through the filters index.
+
+    The index caches the parsed and expanded filter definitions, so only
+    the requested filter is decoded as long as the filters file does not
+    change. Raises KeyError when no filter is defined for name.
+    """
+    if filters_file is None:
+        filters_file = get_dotfilters_file()
+    index_cache = IndexCache(filters_file,
+                             get_dotfilters_index_file(filters_file))
+    return index_cache.get(name, expand_filters, resolve_name), filters_file
+
+
 def get_clean_filter(name, filters_file=None, filters_dict=None):
-    if filters_dict is None:
-        filters_dict, filters_file = load_all_filters(filters_file)
     try:
-        filters_def = filters_dict['filters'][name]
+        if filters_dict is None:
+            if filters_file is None:
+                filters_file = get_dotfilters_file()
+            filters_def, filters_file = load_filter(name, filters_file)
+        else:
+            filters = filters_dict['filters']
+            filters_def = filters[resolve_name(name, filters)]
     except KeyError:
         logger.info("No filter named '%s' found in file '%s', "
                     "using copy filter.", name, filters_file)
@@ -138,51 +306,35 @@ def get_clean_filter(name, filters_file=None, filters_dict=None):
 
 
 def clean_stream(input_file, output_file, clean_filter):
-    if 'b' in clean_filter.read_mode:
-        # Binary mode
-        with (output_file.open(
-                   mode=clean_filter.write_mode) if output_file != '-'
-              else sys.stdout.buffer) as output_stream:
-            with (input_file.open(
-                       mode=clean_filter.read_mode) if input_file != '-'
-                  else sys.stdin.buffer) as input_stream:
-                while True:
-                    try:
-                        data = input_stream.read(io.DEFAULT_BUFFER_SIZE)
-                    except KeyboardInterrupt:
-                        break
-                    if not data:
-                        break
-                    output_stream.write(clean_filter.sub(data))
-    else:
-        # Text mode
-        if output_file == '-':
-            sys_stdout = io.TextIOWrapper(sys.stdout.buffer,
-                    encoding=clean_filter.encoding)
-            # sys.stdout.reconfigure(encoding=clean_filter.encoding)
-        if input_file == '-':
-            sys_stdin = io.TextIOWrapper(sys.stdin.buffer,
-                    encoding=clean_filter.encoding)
-            # sys.stdin.reconfigure(encoding=clean_filter.encoding)
-        with (output_file.open(
-                   mode=clean_filter.write_mode,
-                   encoding=clean_filter.encoding) if output_file != '-'
-              else sys_stdout) as output_stream:
-            with (input_file.open(
-                       mode=clean_filter.read_mode,
-                       encoding=clean_filter.encoding) if input_file != '-'
-                  else sys_stdin) as input_stream:
-                while True:
-                    try:
-                        line = input_stream.readline()
-                    except KeyboardInterrupt:
-                        break
-                    if not line:
-                        break
-                    output_stream.write(clean_filter.sub(line))
+    sub_file(input_file, output_file, clean_filter)
+    if logger.isEnabledFor(logging.DEBUG) and \
+            hasattr(clean_filter, 'log_stats'):
+        clean_filter.log_stats()
 
 
 def clean(args):
     clean_filter = get_clean_filter(args.name, args.filters)
-    clean_stream(args.input, args.output, clean_filter)
+    if getattr(clean_filter, 'redact', False):
+        # Only needed when redacting known secret values
+        from dotsecrets.redact import configure_redaction
+        from dotsecrets.smudge import get_smudge_filter
+        configure_redaction(clean_filter,
+                            get_smudge_filter(args.name, args.store))
+    profile = None
+    if args.profile or args.profile_json is not None:
+        # Only needed when profiling
+        from dotsecrets.profiler import Profile
+        profile = Profile()
+        profile.add('clean', clean_filter)
+        clean_stream(args.input, args.output, clean_filter)
+    elif hasattr(clean_filter, 'definition'):
+        # Only needed when cleaning large inputs
+        from dotsecrets.cache import clean_file_cached
+        clean_file_cached(args.input, args.output, clean_filter)
+        if logger.isEnabledFor(logging.DEBUG):
+            clean_filter.log_stats()
+    else:
+        clean_stream(args.input, args.output, clean_filter)
+    if profile is not None:
+        profile.write(args.profile_json)
     return 0
@@ -11,3 +11,10 @@ else:
     # Python 3.6+ changes strict resolving to false
     def resolve(src: Path, strict=False):
         return src.resolve(strict)
+
+
+try:
+    # Python 3.11+ deprecates the sre_parse module
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Version 2 holds the expansion of the non backtracking whitespace keywords
+INDEX_VERSION = 2
+
+# Modification times this close to the index creation time cannot be
+# trusted on file systems with a coarse timestamp resolution
+RACY_NS = 2 * 10**9
+
+
+def write_index(index_file, header, entries):
+    """Atomically write entries as JSON blobs behind a JSON header line.
+
+    The header holds an index of entry name to offset and length, so a
+    reader only decodes the entry it needs.
+    """
+    blobs = []
+    index = {}
+    offset = 0
+    for name, entry in entries.items():
+        blob = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+        index[name] = [offset, len(blob)]
+        offset += len(blob)
+        blobs.append(blob)
+    header = dict(header, version=INDEX_VERSION, index=index)
+    # Only needed when writing, keep it out of the startup time
+    import tempfile
+    index_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=str(index_file.parent),
+                                    prefix=index_file.name + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(header, separators=(',', ':'))
+                    .encode('utf-8') + b'\n')
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp_name, str(index_file))
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+class IndexReader(object):
+    def __init__(self, stream):
+        self.stream = stream
+        line = stream.readline()
+        self.data_offset = len(line)
+        self.header = json.loads(line.decode('utf-8'))
+        if self.header.get('version') != INDEX_VERSION:
+            raise ValueError("Unsupported index version %r" %
+                             self.header.get('version'))
+        self.index = self.header['index']
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def read_blob(self, name):
+        offset, length = self.index[name]
+        self.stream.seek(self.data_offset + offset)
+        return self.stream.read(length)
+
+    def get(self, name):
+        """Return decoded entry, raises KeyError when not present."""
+        return json.loads(self.read_blob(name).decode('utf-8'))
+
+
+class IndexCache(object):
+    """Index of a source file that is rebuilt when the source changes.
+
+    The index is valid while size and modification time of the source
+    match. On a mismatch the content hash is compared before rebuilding,
+    so touching the source only refreshes the index header. As in Git,
+    a source modified around the time the index was written is racy and
+    always verified by its hash.
+    """
+    def __init__(self, source_file, index_file):
+        self.source_file = source_file
+        self.index_file = index_file
+
+    def stat_key(self):
+        st = self.source_file.stat()
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def open_valid(self, stat_key):
+        try:
+            stream = self.index_file.open(mode='rb')
+        except FileNotFoundError:
+            return None
+        try:
+            reader = IndexReader(stream)
+            header = reader.header
+            if (header.get('source') == str(self.source_file) and
+                    header.get('size') == stat_key['size'] and
+                    header.get('mtime_ns') == stat_key['mtime_ns'] and
+                    header['mtime_ns'] < header['written_ns'] - RACY_NS):
+                return reader
+        except (ValueError, KeyError) as exc:
+            logger.debug("Ignoring invalid index '%s': %s",
+                         self.index_file, exc)
+        stream.close()
+        return None
+
+    def refresh(self, stat_key, parse):
+        # Hashing is only needed when the index is not valid, importing
+        # hashlib takes a considerable part of the startup time
+        import hashlib
+        content = self.source_file.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()
+        entries = None
+        try:
+            with self.index_file.open(mode='rb') as f:
+                reader = IndexReader(f)
+                if (reader.header.get('source') == str(self.source_file) and
+                        reader.header.get('sha256') == digest):
+                    logger.debug("Source '%s' unchanged, "
+                                 "refreshing index header.",
+                                 self.source_file)
+                    entries = {name: reader.get(name) for name in reader}
+        except (OSError, ValueError, KeyError):
+            pass
+        if entries is None:
+            logger.debug("Rebuilding index '%s' for '%s'.",
+                         self.index_file, self.source_file)
+            entries = parse(content)
+        header = dict(stat_key, sha256=digest,
+                      source=str(self.source_file),
+                      written_ns=int(time.time() * 10**9))
+        write_index(self.index_file, header, entries)
+        return entries
+
+    def get(self, name, parse, resolve=None):
+        """Return the entry for name, raises KeyError when not present.
+
+        The parse callable receives the source content as bytes and
+        returns a dictionary with all entries. The optional resolve
+        callable receives name and the entry names, and returns the name
+        of the entry to use.
+        """
+        stat_key = self.stat_key()
+        reader = self.open_valid(stat_key)
+        if reader is not None:
+            with reader.stream:
+                if resolve is not None:
+                    name = resolve(name, reader.index)
+                return reader.get(name)
+        try:
+            entries = self.refresh(stat_key, parse)
+        except (OSError, TypeError, ValueError) as exc:
+            # Unable to write the index, do without
+            logger.debug("Unable to write index '%s': %s",
+                         self.index_file, exc)
+            entries = parse(self.source_file.read_bytes())
+        if resolve is not None:
+            name = resolve(name, entries)
+        return entries[name]
@@ -1,24 +1,36 @@
+import hashlib
+import json
 import logging
+import os
 import random
 import re
 import shutil
 import string
 import subprocess
+import time
 
 from pathlib import Path
 
 from dotsecrets.clean import load_all_filters, get_clean_filter
+from dotsecrets.index import RACY_NS
+from dotsecrets.patterns import list_filtered_files, resolve_name
 from dotsecrets.smudge import (load_all_secrets,
                                get_smudge_filter,
-                               smudge_stream)
-from dotsecrets.params import GIT_ATTR_DOTSECRETS, DOTFILTERS_V2_YAML
+                               configure_smudge_filter)
+from dotsecrets.params import (GIT_ATTR_DOTSECRETS,
+                               DOTFILTERS_V2_YAML,
+                               GIT_PATHSPEC_MAX)
+from dotsecrets.stream import sub_bytes
 from dotsecrets.utils import (get_dotfiles_path,
                               get_dotfilters_file,
+                              get_smudge_state_file,
                               is_sub_path)
 
 
 logger = logging.getLogger(__name__)
 
+STATE_VERSION = 1
+
 
 def check_dotfilters():
     filters_file = get_dotfilters_file()
@@ -28,44 +40,29 @@ def check_dotfilters():
     return True
 
 
-def check_git_config():
-    cwd_path = Path.cwd()
-    dotfiles_path = get_dotfiles_path()
-    if not is_sub_path(cwd_path, dotfiles_path):
-        return False
-    try:
-        subprocess.run(['git', 'config',
-                        '--get', 'filter.dotsecrets.clean'],
-                       stdout=subprocess.DEVNULL,
-                       check=True)
-    except subprocess.CalledProcessError:
-        subprocess.run(['git', 'config', '--local',
-                        'filter.dotsecrets.clean',
-                        'dotsecrets clean %f'],
-                       stdout=subprocess.DEVNULL,
-                       check=True)
-    try:
-        subprocess.run(['git', 'config',
-                        '--get', 'filter.dotsecrets.smudge'],
-                       stdout=subprocess.DEVNULL,
-                       check=True)
-    except subprocess.CalledProcessError:
-        subprocess.run(['git', 'config', '--local',
-                        'filter.dotsecrets.smudge',
-                        'dotsecrets smudge %f'],
-                       stdout=subprocess.DEVNULL,
-                       check=True)
+def check_git_config_key(key, value):
     try:
-        subprocess.run(['git', 'config',
-                        '--get', 'filter.dotsecrets.required'],
+        subprocess.run(['git', 'config', '--get', key],
                        stdout=subprocess.DEVNULL,
                        check=True)
     except subprocess.CalledProcessError:
-        subprocess.run(['git', 'config', '--local',
-                        'filter.dotsecrets.required',
-                        'true'],
+        subprocess.run(['git', 'config', '--local', key, value],
                        stdout=subprocess.DEVNULL,
                        check=True)
+
+
+def check_git_config():
+    cwd_path = Path.cwd()
+    dotfiles_path = get_dotfiles_path()
+    if not is_sub_path(cwd_path, dotfiles_path):
+        return False
+    # Git 2.11+ uses the long running process and ignores the per file
+    # clean and smudge commands, which are kept for older Git versions
+    check_git_config_key('filter.dotsecrets.process',
+                         'dotsecrets filter-process')
+    check_git_config_key('filter.dotsecrets.clean', 'dotsecrets clean %f')
+    check_git_config_key('filter.dotsecrets.smudge', 'dotsecrets smudge %f')
+    check_git_config_key('filter.dotsecrets.required', 'true')
     return True
 
 
@@ -97,37 +94,174 @@ def check_git_attributes():
     return True
 
 
-def initial_smudge(filters_file, secrets_file):
-    filters_dict, filters_file = load_all_filters(filters_file)
-    secrets_dict, secrets_file = load_all_secrets(secrets_file)
-    dotfiles_path = get_dotfiles_path()
-    for name in filters_dict['filters']:
-        clean_filter = get_clean_filter(name, filters_file, filters_dict)
-        smudge_filter = get_smudge_filter(name, secrets_file, secrets_dict)
-        smudge_filter.read_mode = clean_filter.read_mode
-        smudge_filter.write_mode = clean_filter.write_mode
-        smudge_filter.encoding = clean_filter.encoding
-        source_file = dotfiles_path.joinpath(name)
-        source_stat = source_file.stat()
-        random_string = ''.join([random.choice(string.ascii_lowercase)
-                                 for i in range(16)])
-        dest_file = source_file.with_name(source_file.name + '.' +
-                                          random_string)
-        smudge_stream(source_file, dest_file, smudge_filter)
+def hash_definition(definition):
+    data = json.dumps(definition, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class SmudgeState(object):
+    """State of the files smudged by a previous init.
+
+    For each file the size and modification time after smudging are kept,
+    together with hashes of the filter and secrets it was smudged with. A
+    file is only smudged again when one of those changed. As with the
+    filters index, a file modified around the time the state was written
+    is racy and always smudged again.
+    """
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.files = {}
+        self.written_ns = 0
+
+    def load(self):
+        try:
+            with self.state_file.open(mode='r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') != STATE_VERSION:
+                raise ValueError("unsupported version %r" %
+                                 state.get('version'))
+            self.files = state['files']
+            self.written_ns = state['written_ns']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError) as exc:
+            logger.warning("Ignoring invalid smudge state '%s': %s",
+                           self.state_file, exc)
+            self.files = {}
+            self.written_ns = 0
+
+    def save(self):
+        state = {'version': STATE_VERSION,
+                 'written_ns': int(time.time() * 10**9),
+                 'files': self.files}
+        tmp_file = self.state_file.with_name(self.state_file.name + '.' +
+                                             str(os.getpid()))
+        try:
+            self.state_file.parent.mkdir(mode=0o700, parents=True,
+                                         exist_ok=True)
+            with tmp_file.open(mode='w', encoding='utf-8') as f:
+                json.dump(state, f, sort_keys=True)
+            tmp_file.replace(self.state_file)
+        except OSError as exc:
+            logger.warning("Unable to save smudge state '%s': %s",
+                           self.state_file, exc)
+
+    @staticmethod
+    def make_entry(source_file, filter_hash, secrets_hash):
+        st = source_file.stat()
+        return {'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'filter': filter_hash,
+                'secrets': secrets_hash}
+
+    def is_current(self, name, source_file, filter_hash, secrets_hash):
+        try:
+            entry = self.make_entry(source_file, filter_hash, secrets_hash)
+        except OSError:
+            return False
+        return (self.files.get(name) == entry and
+                entry['mtime_ns'] < self.written_ns - RACY_NS)
+
+    def update(self, name, source_file, filter_hash, secrets_hash):
+        try:
+            self.files[name] = self.make_entry(source_file, filter_hash,
+                                               secrets_hash)
+        except OSError:
+            self.files.pop(name, None)
+
+
+def smudge_file(dotfiles_path, name, smudge_filter):
+    """Smudge a file in place, returns whether the file was rewritten."""
+    source_file = dotfiles_path.joinpath(name)
+    source_stat = source_file.stat()
+    content = source_file.read_bytes()
+    smudged = sub_bytes(content, smudge_filter)
+    if smudged == content:
+        # Leave the file and its stat info untouched
+        return False
+    random_string = ''.join([random.choice(string.ascii_lowercase)
+                             for i in range(16)])
+    dest_file = source_file.with_name(source_file.name + '.' +
+                                      random_string)
+    try:
+        dest_file.write_bytes(smudged)
         shutil.copystat(str(source_file), str(dest_file))
         shutil.chown(str(dest_file), source_stat.st_uid, source_stat.st_gid)
         dest_file.rename(source_file)
+    except BaseException:
+        # Leave the source untouched and clean up the partial result
+        try:
+            dest_file.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    return True
+
+
+def smudge_files(dotfiles_path, smudge_filters, jobs=None):
+    """Smudge files in place on a process pool.
+
+    Returns a list of the files that were rewritten and a set of the files
+    that failed to smudge, a failure does not stop smudging the other
+    files.
+    """
+    written = []
+    failed = set()
+    if jobs == 1 or len(smudge_filters) < 2:
+        for name, smudge_filter in smudge_filters.items():
+            try:
+                if smudge_file(dotfiles_path, name, smudge_filter):
+                    logger.info("Smudged '%s'.", name)
+                    written.append(name)
+            except Exception as exc:
+                logger.error("Failed to smudge '%s': %s", name, exc)
+                failed.add(name)
+        return written, failed
+    # The process pool machinery is only needed for many files, importing
+    # it keeps init within its import budget
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(smudge_file, dotfiles_path,
+                                   name, smudge_filter): name
+                   for name, smudge_filter in smudge_filters.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                if future.result():
+                    logger.info("Smudged '%s'.", name)
+                    written.append(name)
+            except Exception as exc:
+                logger.error("Failed to smudge '%s': %s", name, exc)
+                failed.add(name)
+    return written, failed
+
+
+def git_pathspec(dotfiles_path, names):
+    # Too many paths exceed the command line, then act on the whole tree
+    if len(names) > GIT_PATHSPEC_MAX:
+        return []
+    return ['--'] + [':(top,literal)' + name for name in sorted(names)]
+
+
+def add_smudged(dotfiles_path, names):
+    """Check smudged files clean to the index and update their entries."""
+    if not names:
+        # Nothing was smudged
+        return 0
+    pathspec = git_pathspec(dotfiles_path, names)
     try:
-        subprocess.run(['git', 'diff', '--exit-code'],
+        subprocess.run(['git', 'diff', '--exit-code'] + pathspec,
                        stdout=subprocess.DEVNULL,
+                       cwd=str(dotfiles_path),
                        check=True)
     except subprocess.CalledProcessError:
         # Git diff detected differences
         return 1
     # Git diff did not see any difference after cleaning
     try:
-        subprocess.run(['git', 'add', '--update'],
+        subprocess.run(['git', 'add', '--update'] + pathspec,
                        stdout=subprocess.DEVNULL,
+                       cwd=str(dotfiles_path),
                        check=True)
     except subprocess.CalledProcessError:
         return 1
@@ -135,6 +269,56 @@ def initial_smudge(filters_file, secrets_file):
     return 0
 
 
+def initial_smudge(filters_file, secrets_file, jobs=None, force=False):
+    filters_dict, filters_file = load_all_filters(filters_file)
+    secrets_dict, secrets_file = load_all_secrets(secrets_file)
+    dotfiles_path = get_dotfiles_path()
+    state = SmudgeState(get_smudge_state_file(dotfiles_path))
+    if not force:
+        state.load()
+    smudge_filters = {}
+    hashes = {}
+    secrets_filters = secrets_dict.get('filters') or {}
+    filtered_files = list_filtered_files(dotfiles_path,
+                                         filters_dict['filters'])
+    for name, filter_name in filtered_files.items():
+        source_file = dotfiles_path.joinpath(name)
+        filter_hash = hash_definition(filters_dict['filters'][filter_name])
+        secrets_hash = hash_definition(secrets_filters.get(
+            resolve_name(name, secrets_filters)))
+        if state.is_current(name, source_file, filter_hash, secrets_hash):
+            logger.debug("Skipping '%s', already smudged.", name)
+            continue
+        clean_filter = get_clean_filter(name, filters_file, filters_dict)
+        smudge_filter = get_smudge_filter(name, secrets_file, secrets_dict)
+        configure_smudge_filter(smudge_filter, clean_filter)
+        smudge_filters[name] = smudge_filter
+        hashes[name] = (filter_hash, secrets_hash)
+    written, failed = smudge_files(dotfiles_path, smudge_filters, jobs)
+    logger.info("Rewrote %d of %d files.", len(written), len(smudge_filters))
+    for name, (filter_hash, secrets_hash) in hashes.items():
+        if name not in failed:
+            state.update(name, dotfiles_path.joinpath(name),
+                         filter_hash, secrets_hash)
+    # Files already smudged by a failed init are checked again as well,
+    # even though they are not rewritten
+    smudged = [name for name in smudge_filters if name not in failed]
+    if failed:
+        logger.error("Failed to smudge %d of %d files.",
+                     len(failed), len(smudge_filters))
+        result = 1
+    else:
+        result = add_smudged(dotfiles_path, smudged)
+    if result != 0:
+        # Files are only current once they clean to the index, until then
+        # the next init smudges and checks them again
+        for name in smudged:
+            state.files.pop(name, None)
+    state.save()
+    return result
+
+
 def init(args):
     if check_dotfilters() and check_git_config() and check_git_attributes():
-        return initial_smudge(args.filters, args.store)
+        return initial_smudge(args.filters, args.store, args.jobs,
+                              args.force)
@@ -0,0 +1,230 @@
+import logging
+import re
+
+from dotsecrets.clean import keyword_sub, load_all_filters
+from dotsecrets.compat import sre_parse
+from dotsecrets.params import TAG_SECRET_KEY_MAX
+from dotsecrets.scanner import iter_subpatterns
+
+
+logger = logging.getLogger(__name__)
+
+
+# Repeats that give back characters when the rest of the regex fails,
+# possessive repeats never do
+BACKTRACK_REPEAT_OPS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+# Characters used to decide whether two character classes overlap
+SAMPLE_CHARS = frozenset([chr(i) for i in range(256)] +
+                         ['\u0660', '\u2028', '\u3000', '\u4e00'])
+
+CATEGORY_TESTS = {
+    sre_parse.CATEGORY_DIGIT: str.isdecimal,
+    sre_parse.CATEGORY_SPACE: str.isspace,
+    sre_parse.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+}
+
+NOT_CATEGORIES = {
+    sre_parse.CATEGORY_NOT_DIGIT: sre_parse.CATEGORY_DIGIT,
+    sre_parse.CATEGORY_NOT_SPACE: sre_parse.CATEGORY_SPACE,
+    sre_parse.CATEGORY_NOT_WORD: sre_parse.CATEGORY_WORD,
+}
+
+
+def make_subpattern(parent, data):
+    # Python 3.8+ renamed the pattern attribute to state
+    state = getattr(parent, 'state', None) or parent.pattern
+    return sre_parse.SubPattern(state, data)
+
+
+def is_unbounded(width):
+    return width[1] >= sre_parse.MAXREPEAT
+
+
+def in_chars(items):
+    """Return the sample characters matched by a character set."""
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.RANGE:
+            chars.update(c for c in SAMPLE_CHARS if av[0] <= ord(c) <= av[1])
+        elif op is sre_parse.CATEGORY and av in CATEGORY_TESTS:
+            chars.update(filter(CATEGORY_TESTS[av], SAMPLE_CHARS))
+        elif op is sre_parse.CATEGORY and av in NOT_CATEGORIES:
+            test = CATEGORY_TESTS[NOT_CATEGORIES[av]]
+            chars.update(c for c in SAMPLE_CHARS if not test(c))
+        else:
+            # Assume the worst for anything else
+            return set(SAMPLE_CHARS)
+    if negate:
+        return SAMPLE_CHARS - chars
+    return chars
+
+
+def single_chars(subpattern):
+    """Return the characters of a single character regex, else None."""
+    data = subpattern.data
+    while len(data) == 1 and data[0][0] is sre_parse.SUBPATTERN:
+        data = data[0][1][-1].data
+    if len(data) != 1:
+        return None
+    op, av = data[0]
+    if op is sre_parse.LITERAL:
+        return {chr(av)}
+    if op is sre_parse.NOT_LITERAL:
+        return SAMPLE_CHARS - {chr(av)}
+    if op is sre_parse.ANY:
+        return SAMPLE_CHARS - {'\n'}
+    if op is sre_parse.IN:
+        return in_chars(av)
+    return None
+
+
+def unbounded_chars(subpattern, item):
+    """Return the characters of an unbounded single character repeat."""
+    op, av = item
+    while op is sre_parse.SUBPATTERN and len(av[-1].data) == 1:
+        op, av = av[-1].data[0]
+    if op not in BACKTRACK_REPEAT_OPS or av[1] < sre_parse.MAXREPEAT:
+        return None
+    return single_chars(av[2])
+
+
+def is_ambiguous_body(body):
+    """Check whether repeating body can split a string in many ways.
+
+    That is the case when the body is a single unbounded element, apart
+    from elements that can match nothing, when it holds adjacent repeats
+    of overlapping characters, or when it is a branch of which one
+    alternative is such a body or two alternatives match a common single
+    character.
+    """
+    data = body.data
+    while len(data) == 1 and data[0][0] is sre_parse.SUBPATTERN:
+        body = data[0][1][-1]
+        data = body.data
+    if len(data) == 1 and data[0][0] is sre_parse.BRANCH:
+        branches = data[0][1][1]
+        for branch in branches:
+            if is_ambiguous_body(branch):
+                return True
+        chars = [single_chars(branch) for branch in branches]
+        chars = [c for c in chars if c is not None]
+        for i, a in enumerate(chars):
+            for b in chars[i + 1:]:
+                if a & b:
+                    return True
+        return False
+    if has_adjacent_repeats(body):
+        return True
+    widths = [make_subpattern(body, [item]).getwidth() for item in data]
+    for i, width in enumerate(widths):
+        if not is_unbounded(width):
+            continue
+        others = widths[:i] + widths[i + 1:]
+        if all(other[0] == 0 for other in others):
+            return True
+    return False
+
+
+def has_adjacent_repeats(subpattern):
+    """Check for unbounded repeats of overlapping characters in a row.
+
+    Only elements that can match nothing may separate the repeats.
+    """
+    data = subpattern.data
+    for i, item in enumerate(data):
+        chars = unbounded_chars(subpattern, item)
+        if chars is None:
+            continue
+        for next_item in data[i + 1:]:
+            next_chars = unbounded_chars(subpattern, next_item)
+            if next_chars is not None and chars & next_chars:
+                return True
+            if make_subpattern(subpattern, [next_item]).getwidth()[0]:
+                break
+    return False
+
+
+def check_subpattern(subpattern, findings):
+    if has_adjacent_repeats(subpattern):
+        findings.append(('warning', "adjacent repeats of overlapping "
+                                    "characters backtrack quadratically"))
+    for op, av in subpattern.data:
+        if op in BACKTRACK_REPEAT_OPS and av[1] >= sre_parse.MAXREPEAT and \
+                is_ambiguous_body(av[2]):
+            findings.append(('error', "nested or overlapping repeats can "
+                                      "backtrack catastrophically"))
+        for child in iter_subpatterns(av):
+            check_subpattern(child, findings)
+
+
+def lint_regex(regex):
+    """Return a list of level and message of the problems of a regex."""
+    try:
+        compiled = re.compile(regex)
+    except (re.error, TypeError) as exc:
+        return [('error', 'invalid regex: {}'.format(exc))]
+    findings = []
+    check_subpattern(sre_parse.parse(compiled.pattern, compiled.flags),
+                     findings)
+    return findings
+
+
+def lint_time_budget(definition):
+    time_budget = definition.get('time_budget')
+    if time_budget is None:
+        return []
+    if isinstance(time_budget, bool) or \
+            not isinstance(time_budget, (int, float)) or time_budget <= 0:
+        return [('error', 'time budget must be a positive number of '
+                          'seconds')]
+    return []
+
+
+def lint_filter(filters_def):
+    """Return a list of rule key, level and message of a filter."""
+    findings = [(None, level, message)
+                for level, message in lint_time_budget(filters_def)]
+    for key, rule_def in (filters_def.get('rules') or {}).items():
+        if 'regex' not in rule_def:
+            findings.append((key, 'error', 'missing regex'))
+            continue
+        if len(str(key).encode('utf-8')) > TAG_SECRET_KEY_MAX:
+            findings.append((key, 'error', 'key longer than {} bytes is '
+                             'never smudged'.format(TAG_SECRET_KEY_MAX)))
+        regex = keyword_sub.sub(rule_def['regex'])
+        for level, message in lint_regex(regex) + \
+                lint_time_budget(rule_def):
+            findings.append((key, level, message))
+    return findings
+
+
+def lint(args):
+    filters_dict, filters_file = load_all_filters(args.filters)
+    filters = filters_dict.get('filters') or {}
+    names = args.names or sorted(filters)
+    errors = 0
+    for name in names:
+        if name not in filters:
+            logger.error("No filter named '%s' found in file '%s'.",
+                         name, filters_file)
+            errors += 1
+            continue
+        for key, level, message in lint_filter(filters[name] or {}):
+            if key is None:
+                print('{}: {}: {}'.format(name, level, message))
+            else:
+                print("{}: rule '{}': {}: {}".format(name, key, level,
+                                                      message))
+            if level == 'error':
+                errors += 1
+    if errors:
+        logger.error("Found %d errors in filters file '%s'.",
+                     errors, filters_file)
+        return 1
+    return 0
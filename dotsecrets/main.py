@@ -1,16 +1,12 @@
 #!/usr/bin/env python3
 import argparse
+import importlib
 import logging
 import sys
 
 from pathlib import Path
 
-from dotsecrets.clean import clean
-from dotsecrets.init import init
 from dotsecrets.metadata import VERSION
-from dotsecrets.smudge import smudge
-from dotsecrets.stow import stow, unstow
-from dotsecrets.test import test
 
 
 logger = logging.getLogger()
@@ -26,6 +22,32 @@ log_levels = {
 }
 
 
+# Git starts a new process for each filtered file, so each command only
+# imports the modules it needs
+commands = {
+    'agent': 'dotsecrets.agent:agent',
+    'audit': 'dotsecrets.audit:audit',
+    'batch': 'dotsecrets.batch:batch',
+    'cache': 'dotsecrets.cache:cache',
+    'clean': 'dotsecrets.clean:clean',
+    'filter-process': 'dotsecrets.process:filter_process',
+    'init': 'dotsecrets.init:init',
+    'lint': 'dotsecrets.lint:lint',
+    'reclean': 'dotsecrets.reclean:reclean',
+    'smudge': 'dotsecrets.smudge:smudge',
+    'stow': 'dotsecrets.stow:stow',
+    'store': 'dotsecrets.store:store',
+    'test': 'dotsecrets.test:test',
+    'unstow': 'dotsecrets.stow:unstow',
+}
+
+
+def load_command(name):
+    module_name, func_name = commands[name].split(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, func_name)
+
+
 def configure_logging(args):
     global logging_configured
     if not logging_configured:
@@ -62,31 +84,115 @@ def main():
     store_parser.add_argument('--store', metavar='FILE',
                               help='load secrets from FILE', type=Path)
 
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument('--profile', action='store_true',
+                                help='print per rule statistics to stderr')
+    profile_parser.add_argument('--profile-json', metavar='FILE',
+                                type=Path,
+                                help='write per rule statistics as JSON '
+                                     'to FILE')
+
     init_cmd_parser = subparsers.add_parser('init',
                                             help='initialize fresh Git '
                                                  'checkout',
                                             parents=[filter_parser,
                                                      store_parser])
-    init_cmd_parser.set_defaults(func=init)
+    init_cmd_parser.add_argument('--jobs', metavar='N', type=int,
+                                 help='smudge N files in parallel, '
+                                      'default is the number of CPUs')
+    init_cmd_parser.add_argument('--force', action='store_true',
+                                 help='smudge all files, including files '
+                                      'already smudged by a previous init')
+    init_cmd_parser.set_defaults(command='init')
 
     clean_cmd_parser = subparsers.add_parser('clean',
                                              help='clean filter used '
                                                   'by Git',
                                              parents=[file_parser,
-                                                      filter_parser])
+                                                      filter_parser,
+                                                      store_parser,
+                                                      profile_parser])
     clean_cmd_parser.add_argument('name',
                                   help='file within repository to filter')
-    clean_cmd_parser.set_defaults(func=clean)
+    clean_cmd_parser.set_defaults(command='clean')
 
     smudge_cmd_parser = subparsers.add_parser('smudge',
                                               help='smudge filter used '
                                                    'by Git',
                                               parents=[file_parser,
                                                        filter_parser,
-                                                       store_parser])
+                                                       store_parser,
+                                                       profile_parser])
     smudge_cmd_parser.add_argument('name',
                                    help='file within repository to filter')
-    smudge_cmd_parser.set_defaults(func=smudge)
+    smudge_cmd_parser.set_defaults(command='smudge')
+
+    batch_cmd_parser = subparsers.add_parser('batch',
+                                             help='clean or smudge many '
+                                                  'files at once',
+                                             parents=[filter_parser,
+                                                      store_parser])
+    batch_cmd_parser.add_argument('batch_command',
+                                  choices=['clean', 'smudge'],
+                                  help='filter to apply')
+    batch_cmd_parser.add_argument('paths', metavar='path', nargs='*',
+                                  help='file within repository to filter')
+    batch_cmd_parser.add_argument('--paths-from', metavar='FILE',
+                                  help="read paths from FILE, one per "
+                                       "line, '-' is stdin")
+    batch_cmd_parser.add_argument('-z', '--null', action='store_true',
+                                  help='paths read from FILE are separated '
+                                       'by NUL characters')
+    batch_cmd_parser.add_argument('--jobs', metavar='N', type=int,
+                                  help='filter N files in parallel, '
+                                       'default is the number of CPUs')
+    batch_output_group = batch_cmd_parser.add_mutually_exclusive_group(
+        required=True)
+    batch_output_group.add_argument('--output-dir', metavar='DIR',
+                                    type=Path,
+                                    help='write each output to its path '
+                                         'within DIR')
+    batch_output_group.add_argument('--in-place', action='store_true',
+                                    help='replace each file with its '
+                                         'output')
+    batch_cmd_parser.set_defaults(command='batch')
+
+    reclean_cmd_parser = subparsers.add_parser('reclean',
+                                               help='clean files with a '
+                                                    'changed filter into '
+                                                    'the index',
+                                               parents=[filter_parser,
+                                                        store_parser])
+    reclean_cmd_parser.add_argument('--since', metavar='REV', default='HEAD',
+                                    help='clean files whose filter changed '
+                                         'since REV, default is HEAD')
+    reclean_cmd_parser.add_argument('--all', action='store_true',
+                                    help='clean all files with a filter')
+    reclean_cmd_parser.add_argument('--jobs', metavar='N', type=int,
+                                    help='clean N files in parallel, '
+                                         'default is the number of CPUs')
+    reclean_cmd_parser.add_argument('-n', '--dry-run', action='store_true',
+                                    help='report changed files without '
+                                         'updating the index')
+    reclean_cmd_parser.set_defaults(command='reclean')
+
+    process_cmd_parser = subparsers.add_parser('filter-process',
+                                               help='long running filter '
+                                                    'process used by Git',
+                                               parents=[filter_parser,
+                                                        store_parser])
+    process_cmd_parser.set_defaults(command='filter-process')
+
+    agent_cmd_parser = subparsers.add_parser('agent',
+                                             help='serve secrets to smudge '
+                                                  'from memory',
+                                             parents=[store_parser])
+    agent_cmd_parser.add_argument('--socket', metavar='FILE', type=Path,
+                                  help='listen on socket FILE, default is '
+                                       'a new temporary directory')
+    agent_cmd_parser.add_argument('--foreground', action='store_true',
+                                  help='do not fork into the background')
+    agent_cmd_parser.set_defaults(command='agent')
 
     dploy_parser = argparse.ArgumentParser(add_help=False)
     dploy_parser.add_argument('--all', dest='source_all',
@@ -102,35 +208,80 @@ def main():
                                             help='symlink topic to '
                                                  'home directory',
                                             parents=[dploy_parser])
-    stow_cmd_parser.set_defaults(func=stow)
+    stow_cmd_parser.set_defaults(command='stow')
 
     unstow_cmd_parser = subparsers.add_parser('unstow',
                                               help='remove topic symlink '
                                                    'from home directory',
                                               parents=[dploy_parser])
-    unstow_cmd_parser.set_defaults(func=unstow)
+    unstow_cmd_parser.set_defaults(command='unstow')
+
+    cache_cmd_parser = subparsers.add_parser('cache',
+                                             help='inspect or clear the '
+                                                  'clean output cache')
+    cache_cmd_parser.add_argument('cache_command', nargs='?',
+                                  choices=['info', 'clear'], default='info',
+                                  help='show cache statistics or remove '
+                                       'all entries, default is info')
+    cache_cmd_parser.set_defaults(command='cache')
+
+    store_cmd_parser = subparsers.add_parser('store',
+                                             help='manage the secrets '
+                                                  'store',
+                                             parents=[store_parser])
+    store_cmd_parser.add_argument('store_command', choices=['compile'],
+                                  help='compile the store into an index '
+                                       'read per filter by smudge')
+    store_cmd_parser.set_defaults(command='store')
+
+    audit_cmd_parser = subparsers.add_parser('audit',
+                                             help='search Git history for '
+                                                  'committed secrets',
+                                             parents=[filter_parser,
+                                                      store_parser])
+    audit_cmd_parser.add_argument('--jobs', metavar='N', type=int,
+                                  help='scan in N processes, default is '
+                                       'the number of CPUs')
+    audit_cmd_parser.add_argument('revs', metavar='rev', nargs='*',
+                                  help='revisions whose history to search, '
+                                       'default is all refs')
+    audit_cmd_parser.set_defaults(command='audit')
+
+    lint_cmd_parser = subparsers.add_parser('lint',
+                                            help='check filter definitions '
+                                                 'for slow regexes',
+                                            parents=[filter_parser])
+    lint_cmd_parser.add_argument('names', metavar='name', nargs='*',
+                                 help='filter to check, default is all '
+                                      'filters')
+    lint_cmd_parser.set_defaults(command='lint')
 
     test_cmd_parser = subparsers.add_parser('test',
                                             help='test filter definition',
                                             parents=[filter_parser,
-                                                     store_parser])
+                                                     store_parser,
+                                                     profile_parser])
     test_cmd_parser.add_argument('--keep', action='store_true',
                                  help='keep intermediate files')
-    test_cmd_parser.add_argument('name',
+    test_cmd_parser.add_argument('--all', action='store_true',
+                                 help='test all files with a filter')
+    test_cmd_parser.add_argument('--jobs', metavar='N', type=int,
+                                 help='test N files in parallel with '
+                                      '--all, default is the number of '
+                                      'CPUs')
+    test_cmd_parser.add_argument('name', nargs='?',
                                  help='file within repository to filter')
-    test_cmd_parser.set_defaults(func=test)
+    test_cmd_parser.set_defaults(command='test')
 
     args = parser.parse_args()
     configure_logging(args)
+    if not hasattr(args, 'command'):
+        parser.error("too few arguments")
     try:
-        return args.func(args)
-    except AttributeError as exc:
-        if exc.args[0] == "'Namespace' object has no attribute 'func'":
-            parser.error("too few arguments")
-        else:
-            logger.exception(exc, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return load_command(args.command)(args)
     except Exception as exc:
         logger.exception(exc, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return 1
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-from datetime import datetime as dt
+import time
 
 __version_info__ = (0, 4, 1)
 __version__ = '.'.join(map(str, __version_info__))
@@ -10,7 +10,8 @@ VERSION = __version__
 LICENSE = 'BSD'
 AUTHOR = 'Olaf Conradi'
 AUTHOR_EMAIL = 'olaf@conradi.org'
-COPYRIGHT = 'Copyright 2013-{}, {}'.format(dt.now().year, AUTHOR)
+COPYRIGHT = 'Copyright 2013-{}, {}'.format(time.localtime().tm_year,
+                                             AUTHOR)
 GITHUB_URL = 'https://github.com/oohlaf/{}'.format(PACKAGE_NAME)
 PROJECT_URLS = {
     'Bug Reports': '{}/issues'.format(GITHUB_URL)
@@ -1,15 +1,65 @@
 # Configuration file for filters
 DOTFILTERS_FILE = '.dotfilters.yaml'
 DOTFILES_PATH = 'dotfiles'
+# Text files of at least this size are filtered as a whole, unless the
+# filter defines the buffered setting
+DOTFILTERS_BUFFERED_SIZE = 1024 * 1024
+# Text files of at least this size are filtered on a process pool in
+# chunks of whole lines, unless the filter defines the parallel setting
+DOTFILTERS_PARALLEL_SIZE = 64 * 1024 * 1024
+DOTFILTERS_PARALLEL_CHUNK_SIZE = 8 * 1024 * 1024
+# Suffix of the cached index of parsed filters
+DOTFILTERS_INDEX_SUFFIX = '.idx'
+# Size of the chunks read by binary filters
+DOTFILTERS_CHUNK_SIZE = 256 * 1024
+# Size of the reads copying a file without a filter, when the kernel
+# can not copy it directly
+DOTFILTERS_COPY_SIZE = 1024 * 1024
+# Encodings in which a newline byte always ends a line, text filters in
+# these encodings are applied on chunks of whole lines
+DOTFILTERS_CHUNKED_ENCODINGS = ('utf-8', 'ascii', 'iso8859-1')
+# Known secret values shorter than this are not redacted by clean
+DOTFILTERS_REDACT_MIN_LENGTH = 4
+# Blobs are scanned by audit in batches of about this many bytes
+AUDIT_BATCH_SIZE = 8 * 1024 * 1024
+# Size of the reads of the history listing by audit
+AUDIT_READ_SIZE = 64 * 1024
+# Suffix of the state of smudged files kept by init
+SMUDGE_STATE_SUFFIX = '.json'
+# Maximum total size of the cached clean filter output
+DOTFILTERS_CACHE_SIZE = 64 * 1024 * 1024
+# Inputs of the filter process and the clean command of at least these
+# sizes go through the clean cache, smaller ones are cleaned faster than
+# a separate clean command loads the hash functions
+DOTFILTERS_CACHE_MIN_SIZE = 16 * 1024
+DOTFILTERS_CACHE_CLEAN_MIN_SIZE = 256 * 1024
 
 # Location of default secrets store
 DOTSECRETS_FILE = 'dotsecrets.yaml'
+# Suffix of the compiled secrets store, kept next to the store
+DOTSECRETS_COMPILED_SUFFIX = '.idx'
+# Environment variable enabling the secrets store shared between smudge
+# processes, off by default to keep plaintext secrets off the disk
+DOTSECRETS_SHARED = 'DOTSECRETS_SHARED'
+# Seconds the secrets store shared between smudge processes is kept
+# without being used
+DOTSECRETS_SHARED_TIMEOUT = 60
 # Subdirectory name under XDG config home
 DOTSECRETS_XDG_NAME = 'dotsecrets'
 
+# Environment variable pointing to the socket of the secrets agent
+DOTSECRETS_AGENT_SOCK = 'DOTSECRETS_AGENT_SOCK'
+# Seconds to wait for the secrets agent to respond
+DOTSECRETS_AGENT_TIMEOUT = 5
+# Maximum length of a single request to the secrets agent
+DOTSECRETS_AGENT_REQUEST_MAX = 65536
+
 # Used to tag secrets in dot files
 TAG_SECRET_START = '$DotSecrets: '
 TAG_SECRET_END = '$'
+# Maximum length of the key in a tag, bounds the length of a tag so large
+# inputs are smudged in chunks of bounded size, longer keys are left alone
+TAG_SECRET_KEY_MAX = 255
 
 # Tag used in regex substitution for secret keys
 TAG_SECRET_KEY = '(?#Key)'
@@ -22,22 +72,36 @@ DOTFILTERS_KEYWORD_DICT = {
     # Match an unquoted single word or a quoted string
     '(?#QuotedOrSingleWord)':
         r'("[^"\\]*(?:\\.[^"\\]*)*"|\'[^\'\\]*(?:\\.[^\'\\]*)*\'|\S+)',
-    # Match whitespace up to hash symbol
+    # Match whitespace up to hash symbol, each word after the first two
+    # characters is preceded by whitespace to avoid catastrophic
+    # backtracking
     '(?#WSUpToHash)':
-        r'([^\s#]+(?:[ \t\v\f]*[^\s#]+)+)',
+        r'([^\s#][ \t\v\f]*[^\s#]+(?:[ \t\v\f]+[^\s#]+)*)',
     # Match whitespace up to semicolon
     '(?#WSUpToSemicolon)':
-        r'([^\s;]+(?:[ \t\v\f]*[^\s;]+)+)',
+        r'([^\s;][ \t\v\f]*[^\s;]+(?:[ \t\v\f]+[^\s;]+)*)',
 }
 
+# Maximum number of paths passed to a single Git command
+GIT_PATHSPEC_MAX = 1000
+
 # Pattern used to detect presence of the dotsecrets filter in git attributes
 GIT_ATTR_DOTSECRETS = r'^[^#].*filter=dotsecrets'
 
 # Suffixes used for intermediate files created by test command
 TEST_CLEAN_SUFFIX = '.dotclean'
 TEST_SMUDGE_SUFFIX = '.dotsmudge'
+# Cleaned output kept in memory by the test command up to this size
+TEST_SPOOL_SIZE = 1024 * 1024
 
 # Yaml template for dotfilters version 2
 DOTFILTERS_V2_YAML = """version: 2
 filters: {}
 """
+
+# Git long running filter process protocol
+PKT_LINE_DATA_MAX = 65516
+PKT_FILTER_CLIENT = 'git-filter-client'
+PKT_FILTER_SERVER = 'git-filter-server'
+PKT_FILTER_VERSION = '2'
+PKT_FILTER_CAPABILITIES = ('clean', 'smudge')
@@ -0,0 +1,178 @@
+import collections
+import fnmatch
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+# Characters that make a filter name a glob pattern
+GLOB_CHARS = '*?['
+
+# Number of filter dictionaries whose path matcher is kept
+MATCHERS_MAX = 4
+
+# Path matchers by identity of their filter dictionary
+matchers = collections.OrderedDict()
+
+
+def is_pattern(name):
+    """Check whether a filter name is a glob or directory pattern."""
+    return name.endswith('/') or any(c in name for c in GLOB_CHARS)
+
+
+class PatternNode(object):
+    def __init__(self, any_depth=False):
+        # Node of a ** component, which consumes any number of components
+        self.is_any_depth = any_depth
+        self.children = {}
+        # Glob components map to their compiled regex and node
+        self.globs = {}
+        self.any_depth = None
+        # Order and name of the pattern ending in this node, and of the
+        # directory pattern matching all paths below this node
+        self.match = None
+        self.below = None
+
+
+def first(entry, other):
+    if entry is None or (other is not None and other < entry):
+        return other
+    return entry
+
+
+class PathMatcher(object):
+    """Match repository paths against glob and directory patterns.
+
+    Patterns are stored in a trie of path components, so the steps taken
+    to match a path depend on its depth rather than on the number of
+    patterns. A component may hold glob characters, ** matches any number
+    of components and a trailing slash matches all paths below a
+    directory. Patterns are anchored at the repository root. When several
+    patterns match, the first one in the given order wins.
+    """
+    def __init__(self, names=()):
+        self.root = PatternNode()
+        # Compiled glob components, shared by all nodes
+        self.regexes = {}
+        for order, name in enumerate(names):
+            if is_pattern(name):
+                self.add(order, name)
+
+    def add(self, order, pattern):
+        node = self.root
+        for part in pattern.strip('/').split('/'):
+            if part == '**':
+                if node.any_depth is None:
+                    node.any_depth = PatternNode(any_depth=True)
+                node = node.any_depth
+            elif any(c in part for c in GLOB_CHARS):
+                if part not in node.globs:
+                    if part not in self.regexes:
+                        self.regexes[part] = re.compile(
+                            fnmatch.translate(part))
+                    node.globs[part] = (self.regexes[part], PatternNode())
+                node = node.globs[part][1]
+            else:
+                node = node.children.setdefault(part, PatternNode())
+        if pattern.endswith('/'):
+            node.below = first(node.below, (order, pattern))
+        else:
+            node.match = first(node.match, (order, pattern))
+
+    def expand(self, nodes):
+        # A ** component may also match no components at all
+        states = set()
+        for node in nodes:
+            while node is not None and node not in states:
+                states.add(node)
+                node = node.any_depth
+        return states
+
+    def match(self, path):
+        """Return the first pattern matching path, else None."""
+        entry = None
+        states = self.expand([self.root])
+        for part in path.split('/'):
+            next_states = []
+            for node in states:
+                entry = first(entry, node.below)
+                if node.is_any_depth:
+                    next_states.append(node)
+                child = node.children.get(part)
+                if child is not None:
+                    next_states.append(child)
+                for regex, child in node.globs.values():
+                    if regex.match(part):
+                        next_states.append(child)
+            states = self.expand(next_states)
+            if not states:
+                break
+        for node in states:
+            entry = first(entry, node.match)
+        if entry is None:
+            return None
+        return entry[1]
+
+
+def get_matcher(names):
+    """Return the path matcher of names, built once per names object.
+
+    Looking it up by identity keeps the cost of resolving a path
+    independent of the number of names. The object is kept with its
+    matcher, so its identity is not reused while cached. An object that
+    changed in size gets a new matcher.
+    """
+    key = id(names)
+    entry = matchers.get(key)
+    if entry is None or entry[0] is not names or entry[1] != len(names):
+        entry = (names, len(names), PathMatcher(names))
+        matchers[key] = entry
+        if len(matchers) > MATCHERS_MAX:
+            matchers.popitem(last=False)
+    else:
+        matchers.move_to_end(key)
+    return entry[2]
+
+
+def resolve_name(name, names):
+    """Return the filter name in names that applies to a path.
+
+    An exact name takes precedence over patterns. Returns the path itself
+    when nothing matches.
+    """
+    if name is None or name in names:
+        return name
+    pattern = get_matcher(names).match(name)
+    if pattern is None:
+        return name
+    logger.debug("Path '%s' matches filter '%s'.", name, pattern)
+    return pattern
+
+
+def list_filtered_files(dotfiles_path, names):
+    """Return a dictionary of path to the filter name applying to it.
+
+    Exact names are paths themselves, patterns are matched against the
+    files tracked by Git in the dotfiles repository.
+    """
+    paths = {name: name for name in names if not is_pattern(name)}
+    if len(paths) == len(names):
+        return paths
+    # Only needed to list the files matched by patterns
+    import subprocess
+    proc = subprocess.run(['git', 'ls-files', '-z'],
+                          stdout=subprocess.PIPE,
+                          cwd=str(dotfiles_path),
+                          check=True)
+    matcher = PathMatcher(names)
+    for path in proc.stdout.split(b'\0'):
+        path = os.fsdecode(path)
+        if not path or path in paths:
+            continue
+        pattern = matcher.match(path)
+        if pattern is not None:
+            paths[path] = pattern
+    return paths
@@ -0,0 +1,215 @@
+import logging
+import sys
+
+from dotsecrets.clean import load_all_filters, get_clean_filter
+from dotsecrets.params import (DOTFILTERS_CACHE_MIN_SIZE,
+                               PKT_LINE_DATA_MAX,
+                               PKT_FILTER_CLIENT,
+                               PKT_FILTER_SERVER,
+                               PKT_FILTER_VERSION,
+                               PKT_FILTER_CAPABILITIES)
+from dotsecrets.redact import configure_redaction
+from dotsecrets.smudge import (load_all_secrets,
+                               get_smudge_filter,
+                               configure_smudge_filter)
+from dotsecrets.stream import sub_bytes
+from dotsecrets.utils import get_clean_cache_path
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def read_pkt_line(stream):
+    """Read a single pkt-line, returns None on a flush packet."""
+    header = stream.read(4)
+    if not header:
+        raise EOFError("Git closed the filter process connection")
+    if len(header) != 4:
+        raise ProtocolError("Truncated pkt-line header %r" % header)
+    try:
+        length = int(header, 16)
+    except ValueError:
+        raise ProtocolError("Invalid pkt-line header %r" % header)
+    if length == 0:
+        return None
+    if length <= 4:
+        raise ProtocolError("Invalid pkt-line length %d" % length)
+    data = stream.read(length - 4)
+    if len(data) != length - 4:
+        raise ProtocolError("Truncated pkt-line data")
+    return data
+
+
+def read_pkt_text_list(stream):
+    """Read text pkt-lines up to the next flush packet."""
+    lines = []
+    while True:
+        data = read_pkt_line(stream)
+        if data is None:
+            return lines
+        lines.append(data.decode('utf-8').rstrip('\n'))
+
+
+def read_pkt_content(stream):
+    """Read binary pkt-lines up to the next flush packet."""
+    chunks = []
+    while True:
+        data = read_pkt_line(stream)
+        if data is None:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def write_pkt_line(stream, data):
+    stream.write(('%04x' % (len(data) + 4)).encode('ascii'))
+    stream.write(data)
+
+
+def write_pkt_flush(stream):
+    stream.write(b'0000')
+
+
+def write_pkt_text_list(stream, lines):
+    for line in lines:
+        write_pkt_line(stream, (line + '\n').encode('utf-8'))
+    write_pkt_flush(stream)
+
+
+def write_pkt_content(stream, data):
+    view = memoryview(data)
+    for start in range(0, len(view), PKT_LINE_DATA_MAX):
+        write_pkt_line(stream, view[start:start + PKT_LINE_DATA_MAX])
+    write_pkt_flush(stream)
+
+
+def parse_pkt_keys(lines):
+    keys = {}
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if not sep:
+            raise ProtocolError("Expected key=value, got '%s'" % line)
+        keys[key] = value
+    return keys
+
+
+class FilterProcess(object):
+    """Long running Git filter process.
+
+    Filters and secrets are loaded once and the resulting filter objects
+    are reused for every file Git passes through the process.
+    """
+    def __init__(self, filters_file=None, secrets_file=None,
+                 filters_dict=None, secrets_dict=None):
+        self.filters_file = filters_file
+        self.secrets_file = secrets_file
+        self.filters_dict = filters_dict
+        self.secrets_dict = secrets_dict
+        self.clean_filters = {}
+        self.smudge_filters = {}
+        self.clean_cache = None
+
+    def get_clean_filter(self, name):
+        if self.filters_dict is None:
+            self.filters_dict, self.filters_file = \
+                load_all_filters(self.filters_file)
+        if name not in self.clean_filters:
+            clean_filter = get_clean_filter(name, self.filters_file,
+                                            self.filters_dict)
+            self.clean_filters[name] = clean_filter
+            if getattr(clean_filter, 'redact', False):
+                configure_redaction(clean_filter,
+                                    self.get_smudge_filter(name))
+        clean_filter = self.clean_filters[name]
+        if hasattr(clean_filter, 'reset'):
+            clean_filter.reset()
+        return clean_filter
+
+    def get_smudge_filter(self, name):
+        if name not in self.smudge_filters:
+            clean_filter = self.get_clean_filter(name)
+            if self.secrets_dict is None:
+                self.secrets_dict, self.secrets_file = \
+                    load_all_secrets(self.secrets_file)
+            smudge_filter = get_smudge_filter(name, self.secrets_file,
+                                              self.secrets_dict)
+            configure_smudge_filter(smudge_filter, clean_filter)
+            self.smudge_filters[name] = smudge_filter
+        return self.smudge_filters[name]
+
+    def get_clean_cache(self):
+        if self.clean_cache is None:
+            # Only needed once a large file is cleaned
+            from dotsecrets.cache import CleanCache
+            self.clean_cache = CleanCache(get_clean_cache_path())
+        return self.clean_cache
+
+    def filter(self, command, name, data):
+        if command == 'clean':
+            text_filter = self.get_clean_filter(name)
+            if len(data) >= DOTFILTERS_CACHE_MIN_SIZE and \
+                    hasattr(text_filter, 'definition'):
+                return self.get_clean_cache().clean(data, text_filter)
+        elif command == 'smudge':
+            text_filter = self.get_smudge_filter(name)
+        else:
+            raise ProtocolError("Unsupported command '%s'" % command)
+        return sub_bytes(data, text_filter)
+
+    def handshake(self, input_stream, output_stream):
+        welcome = read_pkt_text_list(input_stream)
+        if not welcome or welcome[0] != PKT_FILTER_CLIENT:
+            raise ProtocolError("Unexpected welcome message %r" % welcome)
+        if 'version=' + PKT_FILTER_VERSION not in welcome[1:]:
+            raise ProtocolError("Unsupported protocol versions %r" %
+                                welcome[1:])
+        write_pkt_text_list(output_stream,
+                            [PKT_FILTER_SERVER,
+                             'version=' + PKT_FILTER_VERSION])
+        output_stream.flush()
+        capabilities = read_pkt_text_list(input_stream)
+        write_pkt_text_list(output_stream,
+                            ['capability=' + capability
+                             for capability in PKT_FILTER_CAPABILITIES
+                             if 'capability=' + capability in capabilities])
+        output_stream.flush()
+
+    def handle_command(self, input_stream, output_stream):
+        keys = parse_pkt_keys(read_pkt_text_list(input_stream))
+        data = read_pkt_content(input_stream)
+        command = keys.get('command')
+        name = keys.get('pathname')
+        logger.debug("Filter process command '%s' on '%s'.", command, name)
+        try:
+            result = self.filter(command, name, data)
+        except Exception as exc:
+            logger.error("Filter process failed to %s '%s': %s",
+                         command, name, exc,
+                         exc_info=logger.isEnabledFor(logging.DEBUG))
+            write_pkt_text_list(output_stream, ['status=error'])
+        else:
+            write_pkt_text_list(output_stream, ['status=success'])
+            write_pkt_content(output_stream, result)
+            # Empty list keeps the status as success
+            write_pkt_flush(output_stream)
+        output_stream.flush()
+
+    def run(self, input_stream, output_stream):
+        self.handshake(input_stream, output_stream)
+        while True:
+            try:
+                self.handle_command(input_stream, output_stream)
+            except EOFError:
+                logger.debug("Filter process finished.")
+                return 0
+
+
+def filter_process(args):
+    process = FilterProcess(args.filters, args.store)
+    try:
+        return process.run(sys.stdin.buffer, sys.stdout.buffer)
+    except EOFError:
+        return 0
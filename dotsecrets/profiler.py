@@ -0,0 +1,251 @@
+import json
+import logging
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class RuleStats(object):
+    def __init__(self, name):
+        self.name = name
+        # Regex scans done and avoided by the literal prefilter
+        self.scans = 0
+        self.skipped = 0
+        self.matches = 0
+        # Size of the matched text and of its substitution
+        self.size_in = 0
+        self.size_out = 0
+        self.match_time = 0.0
+        self.sub_time = 0.0
+
+    def as_dict(self):
+        return {'scans': self.scans,
+                'skipped': self.skipped,
+                'matches': self.matches,
+                'size_in': self.size_in,
+                'size_out': self.size_out,
+                'match_time': self.match_time,
+                'sub_time': self.sub_time}
+
+
+class FilterStats(object):
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        # Lines (or binary chunks) passed to the filter
+        self.lines = 0
+        self.size_in = 0
+        self.size_out = 0
+        self.time = 0.0
+        self.rules = []
+        # Rule counters kept by the filter itself, finished on report
+        self.counters = []
+        # Rule substituting inline, all time outside matching is its own
+        self.inline_rule = None
+
+    def add_rule(self, name):
+        rule_stats = RuleStats(name)
+        self.rules.append(rule_stats)
+        return rule_stats
+
+    def finish(self):
+        for rule_stats, get_skipped, skipped in self.counters:
+            rule_stats.skipped = get_skipped() - skipped
+        self.counters = []
+        if self.inline_rule is not None:
+            # Text outside the matches passes the filter unchanged
+            rule_stats = self.inline_rule
+            rule_stats.sub_time = max(self.time - rule_stats.match_time, 0.0)
+            rule_stats.size_out = self.size_out - (self.size_in -
+                                                   rule_stats.size_in)
+
+    def as_dict(self):
+        self.finish()
+        return {'command': self.command,
+                'filter': self.name,
+                'lines': self.lines,
+                'size_in': self.size_in,
+                'size_out': self.size_out,
+                'time': self.time,
+                'rules': {rule_stats.name: rule_stats.as_dict()
+                          for rule_stats in self.rules}}
+
+
+class TimedRegex(object):
+    """Compiled regex adding the time spent matching to rule stats.
+
+    Every other attribute is taken from the compiled regex.
+    """
+    def __init__(self, regex, rule_stats, count=False):
+        self.regex = regex
+        self.rule_stats = rule_stats
+        # Count matches and their size here when no expand method does
+        self.count = count
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+    def finditer(self, string, *args):
+        rule_stats = self.rule_stats
+        rule_stats.scans += 1
+        matches = self.regex.finditer(string, *args)
+        while True:
+            start = time.perf_counter()
+            m = next(matches, None)
+            rule_stats.match_time += time.perf_counter() - start
+            if m is None:
+                return
+            if self.count:
+                rule_stats.matches += 1
+                rule_stats.size_in += m.end() - m.start()
+            yield m
+
+    def match(self, string, *args):
+        start = time.perf_counter()
+        m = self.regex.match(string, *args)
+        self.rule_stats.match_time += time.perf_counter() - start
+        return m
+
+
+def timed_expand(expand, rule_stats):
+    def wrapper(m):
+        start = time.perf_counter()
+        subs = expand(m)
+        rule_stats.sub_time += time.perf_counter() - start
+        rule_stats.matches += 1
+        rule_stats.size_in += len(m.group(0))
+        rule_stats.size_out += len(subs)
+        return subs
+    return wrapper
+
+
+def timed_sub(sub, filter_stats):
+    def wrapper(line):
+        start = time.perf_counter()
+        out = sub(line)
+        filter_stats.time += time.perf_counter() - start
+        filter_stats.lines += 1
+        filter_stats.size_in += len(line)
+        filter_stats.size_out += len(out)
+        return out
+    return wrapper
+
+
+def timed_sub_chunk(sub_chunk, filter_stats):
+    def wrapper(data, start, limit):
+        begin = time.perf_counter()
+        output, end = sub_chunk(data, start, limit)
+        filter_stats.time += time.perf_counter() - begin
+        filter_stats.lines += 1
+        filter_stats.size_in += end - start
+        filter_stats.size_out += len(output)
+        return output, end
+    return wrapper
+
+
+def rule_time(item):
+    name, rule = item
+    return rule['match_time'] + rule['sub_time']
+
+
+class Profile(object):
+    """Per filter and per rule statistics of clean and smudge runs.
+
+    Filters are instrumented in place by replacing methods and compiled
+    regexes of the instance with timed versions. Filters that are not
+    profiled run without any overhead. Instrumented filters can not be
+    sent to another process, they are marked as profiled to keep them in
+    the current one.
+    """
+    def __init__(self):
+        self.filters = []
+
+    def add(self, command, text_filter):
+        filter_stats = FilterStats(command, getattr(text_filter, 'name',
+                                                    None))
+        self.filters.append(filter_stats)
+        text_filter.profiled = True
+        rules = getattr(text_filter, 'rules', None)
+        if rules is not None:
+            self.add_clean_rules(filter_stats, text_filter)
+        elif hasattr(text_filter, 'secrets'):
+            self.add_smudge_tags(filter_stats, text_filter)
+        text_filter.sub = timed_sub(text_filter.sub, filter_stats)
+        if hasattr(text_filter, 'sub_chunk'):
+            text_filter.sub_chunk = timed_sub_chunk(text_filter.sub_chunk,
+                                                    filter_stats)
+        return filter_stats
+
+    def add_clean_rules(self, filter_stats, clean_filter):
+        scanner = getattr(clean_filter, 'scanner', None)
+        if scanner is not None:
+            # Matches of the combined regex are expanded by the rules
+            rule_stats = filter_stats.add_rule('(combined)')
+            scanner.regex = TimedRegex(scanner.regex, rule_stats)
+        for key, rule in clean_filter.rules.items():
+            rule_stats = filter_stats.add_rule(key)
+            # Bypass the regex property, it compiles the pattern
+            rule._regex = TimedRegex(rule._regex, rule_stats)
+            rule.expand = timed_expand(rule.expand, rule_stats)
+            filter_stats.counters.append(
+                (rule_stats, lambda rule=rule: rule.skipped, rule.skipped))
+
+    def add_smudge_tags(self, filter_stats, smudge_filter):
+        rule_stats = filter_stats.add_rule('(tags)')
+        smudge_filter.regex = TimedRegex(smudge_filter.regex, rule_stats,
+                                         count=True)
+        if 'b' in smudge_filter.read_mode:
+            smudge_filter.compile_bytes()
+            smudge_filter.bytes_regex = TimedRegex(smudge_filter.bytes_regex,
+                                                   rule_stats)
+            smudge_filter.expand_bytes = timed_expand(
+                smudge_filter.expand_bytes, rule_stats)
+        else:
+            filter_stats.inline_rule = rule_stats
+        filter_stats.counters.append(
+            (rule_stats, lambda: smudge_filter.skipped,
+             smudge_filter.skipped))
+
+    def report(self):
+        return {'filters': [filter_stats.as_dict()
+                            for filter_stats in self.filters]}
+
+    def format_table(self):
+        lines = []
+        for entry in self.report()['filters']:
+            lines.append("{} filter '{}': {} lines, size {} -> {}, "
+                         "{:.3f} ms".format(entry['command'].capitalize(),
+                                            entry['filter'], entry['lines'],
+                                            entry['size_in'],
+                                            entry['size_out'],
+                                            entry['time'] * 1000))
+            if not entry['rules']:
+                continue
+            lines.append('  {:<20} {:>8} {:>8} {:>8} {:>10} {:>10} '
+                         '{:>10} {:>10}'.format('rule', 'scans', 'skipped',
+                                                'matches', 'size in',
+                                                'size out', 'match ms',
+                                                'sub ms'))
+            for name, rule in sorted(entry['rules'].items(), key=rule_time,
+                                     reverse=True):
+                lines.append('  {:<20} {:>8} {:>8} {:>8} {:>10} {:>10} '
+                             '{:>10.3f} {:>10.3f}'.format(
+                                 name, rule['scans'], rule['skipped'],
+                                 rule['matches'], rule['size_in'],
+                                 rule['size_out'],
+                                 rule['match_time'] * 1000,
+                                 rule['sub_time'] * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None):
+        """Write a table to stderr, or a JSON report to json_file."""
+        if json_file is None:
+            sys.stderr.write(self.format_table())
+            return
+        with json_file.open(mode='w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        logger.info("Wrote profile to '%s'.", json_file)
+
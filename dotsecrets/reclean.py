@@ -0,0 +1,175 @@
+import logging
+import os
+import subprocess
+import tempfile
+
+from pathlib import Path
+
+from dotsecrets.batch import filter_files, get_batch_filter
+from dotsecrets.clean import load_all_filters
+from dotsecrets.compat import resolve
+from dotsecrets.patterns import list_filtered_files
+from dotsecrets.smudge import load_all_secrets
+from dotsecrets.utils import get_dotfiles_path, is_sub_path, load_yaml
+
+
+logger = logging.getLogger(__name__)
+
+
+# Index entries of regular files, other entries are never filtered
+REGULAR_MODES = (b'100644', b'100755')
+
+
+def load_old_filters(dotfiles_path, filters_file, rev):
+    """Return the filters of the filters file at rev, None if unknown."""
+    filters_file = resolve(filters_file.absolute())
+    dotfiles_path = resolve(dotfiles_path)
+    if not is_sub_path(filters_file, dotfiles_path):
+        logger.warning("Filters file '%s' is not within the dotfiles "
+                       "repository.", filters_file)
+        return None
+    name = filters_file.relative_to(dotfiles_path).as_posix()
+    proc = subprocess.run(['git', 'show', '{}:{}'.format(rev, name)],
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL,
+                          cwd=str(dotfiles_path))
+    if proc.returncode != 0:
+        logger.warning("Filters file '%s' not found at '%s'.", name, rev)
+        return None
+    filters_dict = load_yaml(proc.stdout.decode('utf-8'))
+    return (filters_dict or {}).get('filters') or {}
+
+
+def find_changed_files(dotfiles_path, filters, old_filters=None):
+    """Return the sorted paths whose filter definition changed.
+
+    A path changed when the filter applying to it is another one than
+    before or its definition differs. Without old filters all paths with
+    a filter are returned.
+    """
+    files = list_filtered_files(dotfiles_path, list(filters))
+    if old_filters is None:
+        return sorted(files)
+    old_files = list_filtered_files(dotfiles_path, list(old_filters))
+    changed = []
+    for name in sorted(set(files) | set(old_files)):
+        filter_name = files.get(name)
+        old_name = old_files.get(name)
+        if filter_name != old_name or \
+                filters.get(filter_name) != old_filters.get(old_name):
+            changed.append(name)
+    return changed
+
+
+def read_index(dotfiles_path):
+    """Return a dictionary of path to mode and object id in the index."""
+    proc = subprocess.run(['git', 'ls-files', '--stage', '-z'],
+                          stdout=subprocess.PIPE,
+                          cwd=str(dotfiles_path),
+                          check=True)
+    entries = {}
+    for record in proc.stdout.split(b'\0'):
+        if not record:
+            continue
+        info, path = record.split(b'\t', 1)
+        mode, oid, stage = info.split(b' ')
+        # Unmerged paths are left to the merge
+        if stage == b'0':
+            entries[os.fsdecode(path)] = (mode, oid)
+    return entries
+
+
+def hash_objects(dotfiles_path, files, write=True):
+    """Return the object ids of files, written to the object database.
+
+    Without write the ids are only computed.
+    """
+    if not files:
+        return []
+    # The files already hold the cleaned content, do not filter again
+    proc = subprocess.run(['git', 'hash-object'] +
+                          (['-w'] if write else []) +
+                          ['--no-filters', '--stdin-paths'],
+                          input=''.join(str(f) + '\n'
+                                        for f in files).encode('utf-8'),
+                          stdout=subprocess.PIPE,
+                          cwd=str(dotfiles_path),
+                          check=True)
+    return proc.stdout.split()
+
+
+def update_index(dotfiles_path, entries):
+    """Set the object ids of paths in the index in a single update.
+
+    The entries are tuples of path, mode and object id.
+    """
+    info = b''.join(mode + b' ' + oid + b'\t' + os.fsencode(path) + b'\0'
+                    for path, mode, oid in entries)
+    subprocess.run(['git', 'update-index', '-z', '--index-info'],
+                   input=info,
+                   cwd=str(dotfiles_path),
+                   check=True)
+
+
+def reclean(args):
+    dotfiles_path = get_dotfiles_path()
+    filters_dict, filters_file = load_all_filters(args.filters)
+    filters = filters_dict.get('filters') or {}
+    old_filters = None
+    if not args.all:
+        old_filters = load_old_filters(dotfiles_path, filters_file,
+                                       args.since)
+        if old_filters is None:
+            logger.warning("Recleaning all files with a filter.")
+    index = read_index(dotfiles_path)
+    names = []
+    for name in find_changed_files(dotfiles_path, filters, old_filters):
+        if name not in index or index[name][0] not in REGULAR_MODES:
+            logger.debug("Skipping '%s', not a file in the index.", name)
+        elif not dotfiles_path.joinpath(name).is_file():
+            logger.info("Skipping '%s', missing in the working tree.", name)
+        else:
+            names.append(name)
+    if not names:
+        logger.info("No files to reclean.")
+        return 0
+    secrets_dict = secrets_file = None
+    if any(filters_def and filters_def.get('redact')
+           for filters_def in filters.values()):
+        secrets_dict, secrets_file = load_all_secrets(args.store)
+    with tempfile.TemporaryDirectory(prefix='dotsecrets-') as tmp_dir:
+        jobs_list = []
+        for i, name in enumerate(names):
+            clean_filter = get_batch_filter('clean', name, filters_file,
+                                            filters_dict, secrets_file,
+                                            secrets_dict)
+            # Numbered outputs keep newlines out of the paths hashed
+            jobs_list.append((name, dotfiles_path.joinpath(name),
+                              Path(tmp_dir).joinpath(str(i)),
+                              clean_filter))
+        status = filter_files(jobs_list, args.jobs)
+        cleaned = [(name, output_file)
+                   for name, input_file, output_file, clean_filter
+                   in jobs_list if status[name] is None]
+        oids = hash_objects(dotfiles_path,
+                            [output_file for name, output_file in cleaned],
+                            write=not args.dry_run)
+    entries = []
+    for (name, output_file), oid in zip(cleaned, oids):
+        mode, index_oid = index[name]
+        if oid != index_oid:
+            entries.append((name, mode, oid))
+    if entries and not args.dry_run:
+        update_index(dotfiles_path, entries)
+    for name, mode, oid in entries:
+        print('changed\t{}'.format(name))
+    failed = sorted(name for name in status if status[name] is not None)
+    for name in failed:
+        print('error\t{}\t{}'.format(name, status[name]))
+    logger.info("Recleaned %d files, %d changed.", len(cleaned),
+                len(entries))
+    if failed:
+        logger.error("Failed to reclean %d of %d files.", len(failed),
+                     len(names))
+        return 1
+    return 0
@@ -0,0 +1,114 @@
+import logging
+import re
+
+from dotsecrets.params import (DOTFILTERS_REDACT_MIN_LENGTH,
+                               TAG_SECRET_START,
+                               TAG_SECRET_END)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum distance between the windows looked up in a line, larger
+# distances scan faster but index more windows of each value
+WINDOW_STRIDE_MAX = 4
+
+
+class Redactor(object):
+    """Replace known secret values by their tags.
+
+    All values are at least as long as the shortest one, so every
+    occurrence covers one of the windows of a fixed size taken at a fixed
+    stride along the line. Windows are looked up in a hash of the windows
+    at the first stride positions of each value, which only takes time
+    proportional to the line length, whatever the number of values.
+    Occurrences are verified by comparing the whole value.
+
+    Values shorter than DOTFILTERS_REDACT_MIN_LENGTH are ignored, they
+    would replace ordinary words. Values within tags are left alone.
+    """
+    def __init__(self, secrets):
+        # Value to the key of its tag
+        self.keys = {}
+        for key, value in sorted(secrets.items()):
+            if not isinstance(value, str):
+                continue
+            if len(value) < DOTFILTERS_REDACT_MIN_LENGTH:
+                logger.debug("Not redacting secret '%s', shorter than %d "
+                             "characters.", key, DOTFILTERS_REDACT_MIN_LENGTH)
+                continue
+            # The first key of a value is as good as any when smudging
+            self.keys.setdefault(value, key)
+        self.size = 0
+        self.stride = 0
+        # Window to the offsets within values it was taken at
+        self.windows = {}
+        if self.keys:
+            length = min(map(len, self.keys))
+            self.size = max((length + 1) // 2,
+                            length - WINDOW_STRIDE_MAX + 1)
+            self.stride = length - self.size + 1
+            for value in self.keys:
+                for offset in range(self.stride):
+                    window = value[offset:offset + self.size]
+                    self.windows.setdefault(window, []).append(
+                        (offset, value))
+        self.window_set = frozenset(self.windows)
+        self.tag_regex = re.compile(re.escape(TAG_SECRET_START) + r'\S+?' +
+                                    re.escape(TAG_SECRET_END))
+
+    def find(self, line):
+        """Return start, negated length and value of all occurrences."""
+        size = self.size
+        positions = range(0, len(line) - size + 1, self.stride)
+        hits = {line[i:i + size] for i in positions} & self.window_set
+        if not hits:
+            return []
+        matches = []
+        for i in positions:
+            window = line[i:i + size]
+            if window not in hits:
+                continue
+            for offset, value in self.windows[window]:
+                start = i - offset
+                if start >= 0 and line.startswith(value, start):
+                    matches.append((start, -len(value), value))
+        return matches
+
+    def sub(self, line):
+        if not self.keys:
+            return line
+        matches = self.find(line)
+        if not matches:
+            return line
+        tags = [m.span() for m in self.tag_regex.finditer(line)]
+        pieces = []
+        prev_end = 0
+        # Leftmost occurrences first, the longest one at a position wins
+        for start, length, value in sorted(set(matches)):
+            end = start - length
+            if start < prev_end or any(tag_start < end and start < tag_end
+                                       for tag_start, tag_end in tags):
+                continue
+            key = self.keys[value]
+            logger.debug("Redacting known value of secret '%s'.", key)
+            pieces.append(line[prev_end:start])
+            pieces.append(TAG_SECRET_START + key + TAG_SECRET_END)
+            prev_end = end
+        if not pieces:
+            return line
+        pieces.append(line[prev_end:])
+        return ''.join(pieces)
+
+    def fingerprint(self):
+        """Return the redacted values and keys, sorted by value."""
+        return sorted(self.keys.items())
+
+
+def configure_redaction(clean_filter, smudge_filter):
+    """Redact the secrets of smudge filter when the filter asks to."""
+    if not getattr(clean_filter, 'redact', False):
+        return
+    secrets = getattr(smudge_filter, 'secrets', {})
+    clean_filter.set_redactor(Redactor(
+        {key: secret.secret for key, secret in secrets.items()}))
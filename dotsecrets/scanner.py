@@ -0,0 +1,155 @@
+import logging
+import re
+
+from dotsecrets.compat import sre_parse
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_FLAGS = re.compile('').flags
+
+REPEAT_OPS = tuple(getattr(sre_parse, name)
+                   for name in ('MAX_REPEAT', 'MIN_REPEAT',
+                                'POSSESSIVE_REPEAT')
+                   if hasattr(sre_parse, name))
+
+GROUPREF_OPS = (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+
+
+def iter_subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            yield from iter_subpatterns(item)
+
+
+def has_group_references(subpattern):
+    """Check whether a parsed regex refers back to its own groups."""
+    for op, av in subpattern.data:
+        if op in GROUPREF_OPS:
+            return True
+        for child in iter_subpatterns(av):
+            if has_group_references(child):
+                return True
+    return False
+
+
+def literal_runs(subpattern):
+    """Yield literal strings that are part of every match."""
+    run = []
+    for op, av in subpattern.data:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            yield ''.join(run)
+            run = []
+        if op is sre_parse.SUBPATTERN:
+            # Python 3.6+ adds scoped flags to the group definition
+            if len(av) == 4 and av[1] & re.IGNORECASE:
+                continue
+            yield from literal_runs(av[-1])
+        elif op in REPEAT_OPS and av[0] >= 1:
+            yield from literal_runs(av[2])
+    if run:
+        yield ''.join(run)
+
+
+def required_literal(regex):
+    """Return the longest literal every match of the regex contains.
+
+    Returns None when no such literal can be derived.
+    """
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, RecursionError):
+        return None
+    literal = max(literal_runs(parsed), key=len, default='')
+    return literal or None
+
+
+class RuleScanner(object):
+    """Scan a line for the matches of all rules in a single pass.
+
+    All rule regexes are combined in one alternation. A line is only
+    rewritten from the combined scan when the result is provably equal to
+    applying the rules one after another: all matches belong to a single
+    rule and the required literal of every other rule is absent from the
+    input (for earlier rules) or the output (for later rules). Any other
+    line is handed to the sequential fallback.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.literals = [rule.literal for rule in self.rules]
+        self.group_rules = {}
+        parts = []
+        group = 0
+        for index, rule in enumerate(self.rules):
+            # Non-capturing groups keep the literal prefix optimization of
+            # the regex engine, the empty group marks the matching rule
+            parts.append('(?:(?:' + rule.regex.pattern + ')())')
+            group += rule.regex.groups + 1
+            self.group_rules[group] = index
+        self.regex = re.compile('|'.join(parts))
+
+    @classmethod
+    def compile(cls, rules):
+        """Return a scanner for the rules or None when unsupported."""
+        rules = list(rules)
+        if len(rules) < 2:
+            return None
+        for rule in rules:
+            if rule.regex.flags != DEFAULT_FLAGS:
+                logger.debug("Rule '%s' uses regex flags, "
+                             "scanning rules sequentially.", rule.key)
+                return None
+            parsed = sre_parse.parse(rule.regex.pattern)
+            if has_group_references(parsed):
+                logger.debug("Rule '%s' uses group references, "
+                             "scanning rules sequentially.", rule.key)
+                return None
+            if not parsed.data or parsed.data[0][0] is not sre_parse.LITERAL:
+                # Without a literal prefix the combined regex is slower
+                # than scanning each rule
+                logger.debug("Rule '%s' does not start with a literal, "
+                             "scanning rules sequentially.", rule.key)
+                return None
+        try:
+            return cls(rules)
+        except re.error as exc:
+            logger.debug("Unable to combine rules (%s), "
+                         "scanning rules sequentially.", exc)
+            return None
+
+    def sub(self, line, fallback):
+        matches = list(self.regex.finditer(line))
+        if not matches:
+            return line
+        index = self.group_rules[matches[0].lastindex]
+        for m in matches[1:]:
+            if self.group_rules[m.lastindex] != index:
+                return fallback(line)
+        for literal in self.literals[:index]:
+            if literal is None or literal in line:
+                return fallback(line)
+        rule = self.rules[index]
+        n = rule.n
+        pieces = []
+        prev_end = 0
+        for m in matches:
+            start = m.start()
+            pieces.append(line[prev_end:start])
+            pieces.append(rule.expand(rule.regex.match(line, start)))
+            prev_end = m.end()
+        pieces.append(line[prev_end:])
+        out = ''.join(pieces)
+        for literal in self.literals[index + 1:]:
+            if literal is None or literal in out:
+                # Undo numbering before handing over to the fallback
+                rule.n = n
+                return fallback(line)
+        return out
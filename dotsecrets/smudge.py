@@ -1,17 +1,25 @@
-import io
 import logging
+import os
 import re
-import sys
-
-from ruamel.yaml import YAML
+import time
 
 from dotsecrets.clean import get_clean_filter
-from dotsecrets.params import TAG_SECRET_START, TAG_SECRET_END
-from dotsecrets.utils import get_dotsecrets_file
+from dotsecrets.index import IndexCache
+from dotsecrets.patterns import resolve_name
+from dotsecrets.params import (DOTSECRETS_SHARED_TIMEOUT,
+                               TAG_SECRET_START,
+                               TAG_SECRET_END,
+                               TAG_SECRET_KEY_MAX)
+from dotsecrets.stream import sub_file, sub_regex_chunk
+from dotsecrets.utils import (FileLock,
+                              get_agent_socket_file,
+                              get_compiled_secrets_file,
+                              get_dotsecrets_file,
+                              get_shared_secrets_file,
+                              load_yaml)
 from dotsecrets.textsub import CopyFilter
 
 
-yaml = YAML(typ='safe')
 logger = logging.getLogger(__name__)
 
 
@@ -24,16 +32,35 @@ class SmudgeFilter(object):
         self.read_mode = 'r'
         self.write_mode = 'w'
         self.encoding = 'utf-8'
+        self.buffered = None
+        self.parallel = None
+        # Lines without a tag are not touched by the filter
+        self.literals = [TAG_SECRET_START]
+        # Lines seen and lines rejected by the literal prefilter
+        self.lines = 0
+        self.skipped = 0
         self.parse_secrets()
-        regex = re.escape(TAG_SECRET_START) + r'(\S+)' + \
-            re.escape(TAG_SECRET_END)
+        regex = re.escape(TAG_SECRET_START) + \
+            r'(\S{1,%d}?)' % TAG_SECRET_KEY_MAX + re.escape(TAG_SECRET_END)
         self.regex = re.compile(regex)
+        # Used when applied in binary mode
+        self.bytes_regex = None
+        self.bytes_secrets = None
+        # Longest tag, the carry-over between chunks in binary mode
+        self.overlap = len(TAG_SECRET_START) + TAG_SECRET_KEY_MAX + \
+            len(TAG_SECRET_END)
 
     def parse_secrets(self):
-        for key, secret_def in self.secrets.items():
-            self.secrets[key] = SmudgeSecret(key=key, **secret_def)
+        # Leave the definitions alone, all paths matching a pattern share
+        # them
+        self.secrets = {key: SmudgeSecret(key=key, **secret_def)
+                        for key, secret_def in self.secrets.items()}
 
     def sub(self, line):
+        self.lines += 1
+        if TAG_SECRET_START not in line:
+            self.skipped += 1
+            return line
         out = u''
         prev_start = -1
         prev_end = -1
@@ -60,8 +87,44 @@ class SmudgeFilter(object):
         else:
             return line
 
+    def compile_bytes(self):
+        encoding = self.encoding or 'utf-8'
+        self.bytes_regex = re.compile(
+            re.escape(TAG_SECRET_START.encode('ascii')) +
+            rb'(\S{1,%d}?)' % TAG_SECRET_KEY_MAX +
+            re.escape(TAG_SECRET_END.encode('ascii')))
+        self.bytes_secrets = {}
+        for key, secret in self.secrets.items():
+            if secret.secret is not None:
+                self.bytes_secrets[key.encode(encoding)] = \
+                    secret.secret.encode(encoding)
+
+    def expand_bytes(self, m):
+        key = m.group(1)
+        secret = self.bytes_secrets.get(key)
+        if secret is None:
+            logger.info("No secret found for key '%s' in filter '%s'.",
+                        key.decode('ascii', 'replace'), self.name)
+            return m.group(0)
+        logger.debug("Replacing key '%s' with secret '%s'.",
+                     key.decode('ascii', 'replace'), secret)
+        return secret
+
+    def sub_chunk(self, data, start, limit):
+        if self.bytes_regex is None:
+            self.compile_bytes()
+        return sub_regex_chunk(self.bytes_regex, self.expand_bytes,
+                               data, start, limit)
+
+    def log_stats(self):
+        logger.debug("Prefilter of filter '%s' skipped %d of %d lines.",
+                     self.name, self.skipped, self.lines)
+
 
 class SmudgeSecret(object):
+    # Stores may hold many thousands of secrets, avoid a dict per secret
+    __slots__ = ('key', 'secret', 'description')
+
     # kwargs allows for additional keyword arguments passed
     # through YAML dictionaries
     def __init__(self, key, secret=None, description='', **kwargs):
@@ -75,16 +138,176 @@ def load_all_secrets(secrets_file=None):
         secrets_file = get_dotsecrets_file()
     logger.debug("Opening secrets store '%s'.", secrets_file)
     with secrets_file.open(mode='r', encoding='utf-8') as f:
-        secrets_dict = yaml.load(f)
+        secrets_dict = load_yaml(f)
     logger.debug("Closed secrets store '%s'.", secrets_file)
     return secrets_dict, secrets_file
 
 
+def parse_secrets_store(content):
+    """Parse secrets store content into secrets per filter."""
+    secrets_dict = load_yaml(content.decode('utf-8'))
+    return secrets_dict.get('filters') or {}
+
+
+def load_compiled_secrets(name, secrets_file=None):
+    """Load the secrets of a single filter from the compiled store.
+
+    Only the entry of the filter is read and decoded. The compiled store
+    is rebuilt when the secrets store changed since it was compiled.
+    Returns None when the store was never compiled.
+    """
+    if secrets_file is None:
+        secrets_file = get_dotsecrets_file()
+    compiled_file = get_compiled_secrets_file(secrets_file)
+    if not compiled_file.exists():
+        return None
+    index_cache = IndexCache(secrets_file, compiled_file)
+    try:
+        secrets_def = index_cache.get(name, parse_secrets_store,
+                                      resolve_name)
+    except KeyError:
+        secrets_def = None
+    logger.debug("Loaded secrets for '%s' from compiled store '%s'.",
+                 name, compiled_file)
+    filters = {} if secrets_def is None else {name: secrets_def}
+    return {'filters': filters}, secrets_file
+
+
+def expire_shared_secrets(shared_file):
+    try:
+        mtime = shared_file.stat().st_mtime
+    except FileNotFoundError:
+        return
+    if time.time() - mtime > DOTSECRETS_SHARED_TIMEOUT:
+        logger.debug("Removing expired shared secrets '%s'.", shared_file)
+        shared_file.unlink()
+
+
+def reap_shared_secrets(shared_file, lock_file):
+    """Wait until the shared store is unused, then remove it."""
+    while True:
+        try:
+            mtime = shared_file.stat().st_mtime
+        except FileNotFoundError:
+            return
+        time.sleep(max(mtime + DOTSECRETS_SHARED_TIMEOUT - time.time(),
+                       0) + 1)
+        with FileLock(lock_file):
+            expire_shared_secrets(shared_file)
+
+
+def start_shared_reaper(shared_file, lock_file):
+    """Remove the shared store once unused from a detached process.
+
+    The process is forked twice, so it is neither waited for by the
+    smudge process nor by Git, and it keeps none of their streams open.
+    """
+    try:
+        pid = os.fork()
+    except (AttributeError, OSError) as exc:
+        logger.debug("Unable to start reaper of shared secrets: %s", exc)
+        return
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            return
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        reap_shared_secrets(shared_file, lock_file)
+    except BaseException:
+        pass
+    finally:
+        os._exit(0)
+
+
+def load_shared_secrets(name, secrets_file=None):
+    """Load the secrets of a single filter through the shared store.
+
+    Smudge processes running at the same time, like the workers of a Git
+    parallel checkout, share the parsed store in the runtime directory.
+    The first process parses the store while holding a lock, the others
+    wait and then only decode the secrets of their filter. The process
+    creating the shared store starts a reaper removing it once unused for
+    DOTSECRETS_SHARED_TIMEOUT seconds, later processes remove it as well.
+    Returns None when sharing is not enabled with DOTSECRETS_SHARED or no
+    runtime directory is available.
+    """
+    if secrets_file is None:
+        secrets_file = get_dotsecrets_file()
+    shared_file = get_shared_secrets_file(secrets_file)
+    if shared_file is None:
+        return None
+    lock_file = shared_file.with_name(shared_file.name + '.lock')
+    try:
+        with FileLock(lock_file):
+            expire_shared_secrets(shared_file)
+            created = not shared_file.exists()
+            index_cache = IndexCache(secrets_file, shared_file)
+            try:
+                secrets_def = index_cache.get(name, parse_secrets_store,
+                                              resolve_name)
+            except KeyError:
+                secrets_def = None
+            if shared_file.exists():
+                # Keep the shared store while it is being used
+                os.utime(str(shared_file))
+            else:
+                created = False
+    except (ImportError, OSError) as exc:
+        logger.debug("Unable to share secrets in '%s': %s",
+                     shared_file, exc)
+        return None
+    if created:
+        # Only after releasing the lock, which a forked process shares
+        start_shared_reaper(shared_file, lock_file)
+    logger.debug("Loaded secrets for '%s' from shared store '%s'.",
+                 name, shared_file)
+    filters = {} if secrets_def is None else {name: secrets_def}
+    return {'filters': filters}, secrets_file
+
+
+def load_agent_secrets(name, socket_file):
+    """Load the secrets of a single filter from the secrets agent.
+
+    Returns None when the agent can not be reached.
+    """
+    # Only import the socket machinery when an agent is running
+    from dotsecrets.agent import AgentError, query_agent
+    try:
+        secrets_def, secrets_file = query_agent(socket_file, name)
+    except AgentError as exc:
+        logger.warning("%s, falling back to secrets store.", exc)
+        return None
+    logger.debug("Loaded secrets for '%s' from agent '%s'.",
+                 name, socket_file)
+    return {'filters': {name: secrets_def}}, secrets_file
+
+
 def get_smudge_filter(name, secrets_file=None, secrets_dict=None):
-    if secrets_dict is None:
-        secrets_dict, secrets_file = load_all_secrets(secrets_file)
     try:
-        secrets_def = secrets_dict['filters'][name]
+        if secrets_dict is None and secrets_file is None:
+            socket_file = get_agent_socket_file()
+            if socket_file is not None:
+                agent_secrets = load_agent_secrets(name, socket_file)
+                if agent_secrets is not None:
+                    secrets_dict, secrets_file = agent_secrets
+        if secrets_dict is None:
+            compiled_secrets = load_compiled_secrets(name, secrets_file)
+            if compiled_secrets is not None:
+                secrets_dict, secrets_file = compiled_secrets
+        if secrets_dict is None:
+            shared_secrets = load_shared_secrets(name, secrets_file)
+            if shared_secrets is not None:
+                secrets_dict, secrets_file = shared_secrets
+        if secrets_dict is None:
+            secrets_dict, secrets_file = load_all_secrets(secrets_file)
+        filters = secrets_dict['filters']
+        secrets_def = filters[resolve_name(name, filters)]
     except KeyError:
         logger.warning("No filter named '%s' found in secrets store '%s', "
                        "using copy filter.", name, secrets_file)
@@ -92,58 +315,34 @@ def get_smudge_filter(name, secrets_file=None, secrets_dict=None):
     return SmudgeFilter(name=name, secrets=secrets_def['secrets'])
 
 
+def configure_smudge_filter(smudge_filter, clean_filter):
+    # The mode and encoding for the file is defined in the dotfilter file
+    # and put them in the smudge filter
+    smudge_filter.read_mode = clean_filter.read_mode
+    smudge_filter.write_mode = clean_filter.write_mode
+    smudge_filter.encoding = clean_filter.encoding
+    smudge_filter.buffered = getattr(clean_filter, 'buffered', None)
+    smudge_filter.parallel = getattr(clean_filter, 'parallel', None)
+
+
 def smudge_stream(input_file, output_file, smudge_filter):
-    if 'b' in smudge_filter.read_mode:
-        # Binary mode
-        with (output_file.open(
-                   mode=smudge_filter.write_mode) if output_file != '-'
-              else sys.stdout.buffer) as output_stream:
-            with (input_file.open(
-                       mode=smudge_filter.read_mode) if input_file != '-'
-                  else sys.stdin.buffer) as input_stream:
-                while True:
-                    try:
-                        data = input_stream.read(io.DEFAULT_BUFFER_SIZE)
-                    except KeyboardInterrupt:
-                        break
-                    if not data:
-                        break
-                    output_stream.write(smudge_filter.sub(data))
-    else:
-        # Text mode
-        if output_file == '-':
-            sys_stdout = io.TextIOWrapper(sys.stdout.buffer,
-                    encoding=smudge_filter.encoding)
-            # sys.stdout.reconfigure(encoding=smudge_filter.encoding)
-        if input_file == '-':
-            sys_stdin = io.TextIOWrapper(sys.stdin.buffer,
-                    encoding=smudge_filter.encoding)
-            # sys.stdin.reconfigure(encoding=smudge_filter.encoding)
-        with (output_file.open(
-                   mode=smudge_filter.write_mode,
-                   encoding=smudge_filter.encoding) if output_file != '-'
-              else sys_stdout) as output_stream:
-            with (input_file.open(
-                       mode=smudge_filter.read_mode,
-                       encoding=smudge_filter.encoding) if input_file != '-'
-                  else sys_stdin) as input_stream:
-                while True:
-                    try:
-                        line = input_stream.readline()
-                    except KeyboardInterrupt:
-                        break
-                    if not line:
-                        break
-                    output_stream.write(smudge_filter.sub(line))
+    sub_file(input_file, output_file, smudge_filter)
+    if logger.isEnabledFor(logging.DEBUG) and \
+            hasattr(smudge_filter, 'log_stats'):
+        smudge_filter.log_stats()
 
 
 def smudge(args):
-    # The mode and encoding for the file is defined in the dotfilter file
-    # and put them in the smudge filter
     clean_filter = get_clean_filter(args.name, args.filters)
     smudge_filter = get_smudge_filter(args.name, args.store)
-    smudge_filter.read_mode = clean_filter.read_mode
-    smudge_filter.write_mode = clean_filter.write_mode
-    smudge_filter.encoding = clean_filter.encoding
+    configure_smudge_filter(smudge_filter, clean_filter)
+    profile = None
+    if args.profile or args.profile_json is not None:
+        # Only needed when profiling
+        from dotsecrets.profiler import Profile
+        profile = Profile()
+        profile.add('smudge', smudge_filter)
     smudge_stream(args.input, args.output, smudge_filter)
+    if profile is not None:
+        profile.write(args.profile_json)
     return 0
@@ -0,0 +1,32 @@
+import logging
+
+from dotsecrets.index import IndexCache
+from dotsecrets.smudge import parse_secrets_store
+from dotsecrets.utils import get_compiled_secrets_file, get_dotsecrets_file
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_store(secrets_file):
+    """Write the compiled store of secrets file, returns its location.
+
+    The compiled store is an index of filter name to the offset of its
+    secrets, so smudge only decodes the secrets of the filter it needs.
+    """
+    compiled_file = get_compiled_secrets_file(secrets_file)
+    index_cache = IndexCache(secrets_file, compiled_file)
+    entries = index_cache.refresh(index_cache.stat_key(),
+                                  parse_secrets_store)
+    logger.info("Compiled %d filters of secrets store '%s' to '%s'.",
+                len(entries), secrets_file, compiled_file)
+    return compiled_file
+
+
+def store(args):
+    secrets_file = args.store
+    if secrets_file is None:
+        secrets_file = get_dotsecrets_file()
+    if args.store_command == 'compile':
+        compile_store(secrets_file)
+    return 0
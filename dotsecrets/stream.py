@@ -0,0 +1,524 @@
+import codecs
+import errno
+import io
+import logging
+import mmap
+import os
+import re
+import stat
+import sys
+
+from dotsecrets.params import (DOTFILTERS_BUFFERED_SIZE,
+                               DOTFILTERS_CHUNK_SIZE,
+                               DOTFILTERS_CHUNKED_ENCODINGS,
+                               DOTFILTERS_COPY_SIZE,
+                               DOTFILTERS_PARALLEL_SIZE,
+                               DOTFILTERS_PARALLEL_CHUNK_SIZE)
+
+
+logger = logging.getLogger(__name__)
+
+# Up to this many literals are searched one by one instead of by regex
+LITERAL_FIND_MAX = 8
+
+# Maximum bytes copied by the kernel in a single call
+COPY_KERNEL_MAX = 1 << 30
+
+# Errors of a kernel copy between descriptors it does not support
+COPY_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+                    errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+def sub_regex_chunk(regex, expand, data, start, limit):
+    """Substitute the matches of a regex starting before limit.
+
+    Returns the output and the end of the input it covers, which is past
+    limit when the last match extends beyond it.
+    """
+    pieces = []
+    pos = start
+    for m in regex.finditer(data, start):
+        if m.start() >= limit:
+            break
+        pieces.append(data[pos:m.start()])
+        pieces.append(expand(m))
+        pos = m.end()
+    end = max(pos, limit)
+    pieces.append(data[pos:end])
+    return b''.join(pieces), end
+
+
+def sub_chunked(input_stream, output_stream, chunk_filter,
+                chunk_size=DOTFILTERS_CHUNK_SIZE):
+    """Apply a binary filter on large chunks without missing matches.
+
+    The overlap attribute of the filter bounds the length of a match. The
+    last overlap bytes of a chunk are held back and processed together
+    with the next chunk, so a match starting before that window is known
+    to be complete. An overlap of None means matches never span a line
+    end, then only complete lines are processed. Bytes before the
+    unprocessed data are kept as context for look behind assertions.
+
+    The filter implements sub_chunk(data, start, limit) which substitutes
+    matches starting from start up to limit, see sub_regex_chunk.
+    """
+    overlap = chunk_filter.overlap
+    data = bytearray()
+    start = 0
+    while True:
+        try:
+            chunk = input_stream.read(chunk_size)
+        except KeyboardInterrupt:
+            chunk = b''
+        final = not chunk
+        data += chunk
+        if final:
+            limit = len(data)
+        elif overlap is None:
+            limit = max(data.rfind(b'\n', start) + 1, start)
+        else:
+            limit = max(len(data) - overlap, start)
+        end = start
+        if limit > start:
+            output, end = chunk_filter.sub_chunk(data, start, limit)
+            output_stream.write(output)
+        if final:
+            break
+        keep = max(end - (overlap or 0), 0)
+        del data[:keep]
+        start = end - keep
+
+
+def copy_kernel(in_fd, out_fd):
+    """Copy all remaining input between descriptors within the kernel.
+
+    Files are copied by copy_file_range or sendfile, pipes by splice.
+    Returns False when the kernel can not copy between the descriptors,
+    anything copied until then is already written.
+    """
+    in_mode = os.fstat(in_fd).st_mode
+    out_mode = os.fstat(out_fd).st_mode
+    copies = []
+    if stat.S_ISREG(in_mode) and stat.S_ISREG(out_mode) and \
+            hasattr(os, 'copy_file_range'):
+        copies.append(lambda: os.copy_file_range(in_fd, out_fd,
+                                                 COPY_KERNEL_MAX))
+    if stat.S_ISREG(in_mode) and hasattr(os, 'sendfile'):
+        copies.append(lambda: os.sendfile(out_fd, in_fd, None,
+                                          COPY_KERNEL_MAX))
+    if (stat.S_ISFIFO(in_mode) or stat.S_ISFIFO(out_mode)) and \
+            hasattr(os, 'splice'):
+        copies.append(lambda: os.splice(in_fd, out_fd, COPY_KERNEL_MAX))
+    for copy in copies:
+        try:
+            while copy():
+                pass
+            return True
+        except OSError as exc:
+            if exc.errno not in COPY_UNSUPPORTED:
+                raise
+            logger.debug("Kernel copy not supported: %s", exc)
+    return False
+
+
+def copy_fds(in_fd, out_fd):
+    while True:
+        data = os.read(in_fd, DOTFILTERS_COPY_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out_fd, view):]
+
+
+def copy_stream(input_stream, output_stream):
+    """Copy the rest of a binary input stream to a binary output stream.
+
+    Streams backed by file descriptors are copied by the kernel where
+    possible, without passing the data through Python. Other streams are
+    copied in large blocks. Input that is not seekable must not have been
+    read from through the stream before.
+    """
+    try:
+        in_fd = input_stream.fileno()
+        out_fd = output_stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        while True:
+            data = input_stream.read(DOTFILTERS_COPY_SIZE)
+            if not data:
+                break
+            output_stream.write(data)
+        return
+    output_stream.flush()
+    if input_stream.seekable():
+        # Skip what was already read into the buffer of the stream
+        os.lseek(in_fd, input_stream.tell(), os.SEEK_SET)
+    if not copy_kernel(in_fd, out_fd):
+        copy_fds(in_fd, out_fd)
+
+
+def sub_stream(input_stream, output_stream, text_filter):
+    """Apply filter on already opened input and output streams.
+
+    Binary filters are applied on chunks, text filters are applied line
+    by line. Binary filters that never change anything (empty literals)
+    copy their input as is.
+    """
+    if 'b' in text_filter.read_mode and \
+            getattr(text_filter, 'literals', None) == []:
+        copy_stream(input_stream, output_stream)
+    elif 'b' in text_filter.read_mode and hasattr(text_filter, 'sub_chunk'):
+        sub_chunked(input_stream, output_stream, text_filter)
+    elif 'b' in text_filter.read_mode:
+        while True:
+            try:
+                data = input_stream.read(io.DEFAULT_BUFFER_SIZE)
+            except KeyboardInterrupt:
+                break
+            if not data:
+                break
+            output_stream.write(text_filter.sub(data))
+    else:
+        while True:
+            try:
+                line = input_stream.readline()
+            except KeyboardInterrupt:
+                break
+            if not line:
+                break
+            output_stream.write(text_filter.sub(line))
+
+
+def use_buffered(text_filter, size=None):
+    """Decide whether a text filter processes its input as a whole.
+
+    Filters choose explicitly with the buffered setting, otherwise
+    regular files of at least DOTFILTERS_BUFFERED_SIZE bytes are buffered.
+    """
+    if 'b' in text_filter.read_mode:
+        return False
+    buffered = getattr(text_filter, 'buffered', None)
+    if buffered is not None:
+        return buffered
+    return size is not None and size >= DOTFILTERS_BUFFERED_SIZE
+
+
+def decode_text(data, encoding):
+    text = str(data, encoding)
+    # Same universal newlines translation as reading in text mode
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def encode_text(text, encoding):
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    return text.encode(encoding)
+
+
+class LiteralFinder(object):
+    """Find the next occurrence of any of the literals in a text.
+
+    A few literals are searched one by one, which is a lot faster than a
+    regex alternation. Positions found beyond the current position are
+    remembered, so each literal is scanned only once over the text.
+    """
+    def __init__(self, text, literals):
+        self.text = text
+        self.literals = list(set(literals))
+        self.regex = None
+        self.hits = None
+        if len(self.literals) > LITERAL_FIND_MAX:
+            self.regex = re.compile('|'.join(map(re.escape, self.literals)))
+        else:
+            self.hits = [text.find(literal) for literal in self.literals]
+
+    def find(self, pos):
+        if self.regex is not None:
+            m = self.regex.search(self.text, pos)
+            return -1 if m is None else m.start()
+        first = -1
+        for i, hit in enumerate(self.hits):
+            if 0 <= hit < pos:
+                hit = self.text.find(self.literals[i], pos)
+                self.hits[i] = hit
+            if hit != -1 and (first == -1 or hit < first):
+                first = hit
+        return first
+
+
+def sub_text(text, text_filter):
+    """Apply a text filter on a whole text with per line semantics.
+
+    Filters that know the literals required by all their rules (the
+    literals attribute) only get to see the lines containing one of those
+    literals. All other lines are copied as a whole.
+    """
+    literals = getattr(text_filter, 'literals', None)
+    pieces = []
+    pos = 0
+    if literals is None:
+        while pos < len(text):
+            end = text.find('\n', pos) + 1 or len(text)
+            pieces.append(text_filter.sub(text[pos:end]))
+            pos = end
+        return ''.join(pieces)
+    if not literals:
+        return text
+    finder = LiteralFinder(text, literals)
+    while True:
+        hit = finder.find(pos)
+        if hit == -1:
+            break
+        start = text.rfind('\n', pos, hit) + 1 or pos
+        end = text.find('\n', hit) + 1 or len(text)
+        pieces.append(text[pos:start])
+        pieces.append(text_filter.sub(text[start:end]))
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+def use_chunked(text_filter):
+    """Decide whether a text filter can be applied on chunks of lines."""
+    if 'b' in text_filter.read_mode:
+        return False
+    try:
+        name = codecs.lookup(text_filter.encoding).name
+    except (LookupError, TypeError):
+        return False
+    return name in DOTFILTERS_CHUNKED_ENCODINGS
+
+
+class ChunkedTextFilter(object):
+    """Apply a text filter on chunks of whole lines.
+
+    Each chunk is decoded at once and filtered as a whole text, which
+    avoids the per line overhead of reading through a text wrapper while
+    keeping the memory use bounded.
+    """
+    # Chunks end at a line end
+    overlap = None
+
+    def __init__(self, text_filter):
+        self.text_filter = text_filter
+        self.encoding = text_filter.encoding
+
+    def sub_chunk(self, data, start, limit):
+        text = decode_text(bytes(data[start:limit]), self.encoding)
+        return encode_text(sub_text(text, self.text_filter),
+                           self.encoding), limit
+
+
+def use_parallel(text_filter, size=None):
+    """Decide whether a text filter is applied on a process pool.
+
+    Filters choose explicitly with the parallel setting, otherwise text of
+    at least DOTFILTERS_PARALLEL_SIZE bytes is filtered in parallel. Only
+    text that can be split at newline bytes qualifies, and processes of a
+    pool never start a pool of their own. Profiled filters can not be
+    pickled and always run in the current process.
+    """
+    if not use_chunked(text_filter) or \
+            getattr(text_filter, 'profiled', False):
+        return False
+    parallel = getattr(text_filter, 'parallel', None)
+    if parallel is None:
+        parallel = size is not None and size >= DOTFILTERS_PARALLEL_SIZE
+    if not parallel or (os.cpu_count() or 1) < 2:
+        return False
+    # Only needed for large files
+    import multiprocessing
+    return multiprocessing.current_process().name == 'MainProcess'
+
+
+def split_lines(data, chunk_size):
+    """Yield start and end of chunks of whole lines in data."""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_size - 1) + 1 or len(data)
+        yield start, end
+        start = end
+
+
+def sub_lines(text_filter, data, counters=None, output=True):
+    """Apply a text filter on a chunk of whole lines.
+
+    Numbered rules start counting at the given counters. Returns the
+    output, None when not wanted, and the counters after the chunk.
+    """
+    if counters is not None:
+        text_filter.set_counters(counters)
+    text = sub_text(decode_text(data, text_filter.encoding), text_filter)
+    if counters is not None:
+        counters = text_filter.counters()
+    if not output:
+        return None, counters
+    return encode_text(text, text_filter.encoding), counters
+
+
+def map_ordered(executor, fn, calls, max_pending):
+    """Yield the results of calls in order, with few of them pending."""
+    # Only needed for parallel filtering
+    from collections import deque
+    pending = deque()
+    for args in calls:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def sub_parallel(data, text_filter, jobs=None,
+                 chunk_size=DOTFILTERS_PARALLEL_CHUNK_SIZE):
+    """Yield the output of a text filter applied on a process pool.
+
+    Data is split into chunks of whole lines, which are filtered in
+    parallel and put back in order. Numbered rules count their matches
+    through the whole file. Filters with numbered rules (the counters
+    method) first count the matches in each chunk, then each chunk is
+    filtered starting from the counts of all chunks before it.
+    """
+    # The process pool machinery is only needed for large files
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = jobs or os.cpu_count() or 1
+    # Bound the number of chunks in memory
+    max_pending = jobs * 2
+    bounds = list(split_lines(data, chunk_size))
+    counters = None
+    if hasattr(text_filter, 'counters'):
+        counters = text_filter.counters() or None
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        offsets = [counters] * len(bounds)
+        if counters is not None:
+            zero = dict.fromkeys(counters, 0)
+            offsets = []
+            total = dict(counters)
+            for output, counts in map_ordered(
+                    executor, sub_lines,
+                    ((text_filter, data[start:end], zero, False)
+                     for start, end in bounds), max_pending):
+                offsets.append(dict(total))
+                for key, n in counts.items():
+                    total[key] += n
+        for output, counts in map_ordered(
+                executor, sub_lines,
+                ((text_filter, data[start:end], offsets[i])
+                 for i, (start, end) in enumerate(bounds)), max_pending):
+            yield output
+    if counters is not None:
+        text_filter.set_counters(total)
+
+
+def read_buffer(input_stream):
+    """Map regular files into memory, read any other stream as a whole."""
+    try:
+        st = os.fstat(input_stream.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return input_stream.read()
+    if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+        try:
+            return mmap.mmap(input_stream.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+    return input_stream.read()
+
+
+def sub_buffered(input_stream, output_stream, text_filter):
+    """Apply a text filter on a binary input stream as a whole."""
+    data = read_buffer(input_stream)
+    try:
+        text = decode_text(data, text_filter.encoding)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    output_stream.write(encode_text(sub_text(text, text_filter),
+                                    text_filter.encoding))
+
+
+def get_stream_size(stream):
+    """Return size of a regular file stream, None for other streams."""
+    try:
+        st = os.fstat(stream.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if stat.S_ISREG(st.st_mode):
+        return st.st_size
+    return None
+
+
+def sub_binary_stream(input_stream, output_stream, text_filter):
+    """Apply filter on opened binary input and output streams."""
+    size = get_stream_size(input_stream)
+    if 'b' in text_filter.read_mode:
+        # Binary mode
+        sub_stream(input_stream, output_stream, text_filter)
+    elif use_parallel(text_filter, size):
+        # Text mode on chunks of lines in parallel
+        logger.debug("Applying filter on a process pool.")
+        data = read_buffer(input_stream)
+        try:
+            for output in sub_parallel(data, text_filter):
+                output_stream.write(output)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    elif use_buffered(text_filter, size):
+        # Text mode on the whole file
+        logger.debug("Applying filter on the whole input.")
+        sub_buffered(input_stream, output_stream, text_filter)
+    elif use_chunked(text_filter):
+        # Text mode on chunks of lines
+        sub_chunked(input_stream, output_stream,
+                    ChunkedTextFilter(text_filter))
+    else:
+        # Text mode line by line
+        input_text = io.TextIOWrapper(input_stream,
+                                      encoding=text_filter.encoding)
+        output_text = io.TextIOWrapper(output_stream,
+                                       encoding=text_filter.encoding)
+        sub_stream(input_text, output_text, text_filter)
+        # Leave the binary streams open for the caller
+        output_text.detach()
+        input_text.detach()
+
+
+def sub_file(input_file, output_file, text_filter):
+    """Apply filter from input file to output file, '-' means stdio."""
+    with (output_file.open(mode='wb') if output_file != '-'
+          else sys.stdout.buffer) as output_stream:
+        with (input_file.open(mode='rb') if input_file != '-'
+              else sys.stdin.buffer) as input_stream:
+            sub_binary_stream(input_stream, output_stream, text_filter)
+
+
+def sub_bytes(data, text_filter):
+    """Apply filter on an in-memory buffer and return the result.
+
+    Text filters decode and encode the buffer using the encoding of
+    the filter, identical to filtering an opened file.
+    """
+    if use_parallel(text_filter, len(data)):
+        return b''.join(sub_parallel(data, text_filter))
+    if use_buffered(text_filter, len(data)) or use_chunked(text_filter):
+        return encode_text(sub_text(decode_text(data, text_filter.encoding),
+                                    text_filter),
+                           text_filter.encoding)
+    if 'b' in text_filter.read_mode and \
+            getattr(text_filter, 'literals', None) == []:
+        return bytes(data)
+    input_stream = io.BytesIO(data)
+    output_stream = io.BytesIO()
+    if 'b' in text_filter.read_mode:
+        sub_stream(input_stream, output_stream, text_filter)
+        return output_stream.getvalue()
+    input_text = io.TextIOWrapper(input_stream,
+                                  encoding=text_filter.encoding)
+    output_text = io.TextIOWrapper(output_stream,
+                                   encoding=text_filter.encoding)
+    sub_stream(input_text, output_text, text_filter)
+    output_text.flush()
+    return output_stream.getvalue()
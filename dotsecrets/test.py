@@ -1,87 +1,255 @@
+import difflib
+import hashlib
+import io
 import logging
-import subprocess
+import sys
+import tempfile
 
-from dotsecrets.clean import get_clean_filter, clean_stream
-from dotsecrets.params import TEST_CLEAN_SUFFIX, TEST_SMUDGE_SUFFIX
-from dotsecrets.smudge import get_smudge_filter, smudge_stream
+from dotsecrets.clean import (load_all_filters,
+                              get_clean_filter)
+from dotsecrets.params import (DOTFILTERS_CHUNK_SIZE,
+                               TEST_CLEAN_SUFFIX,
+                               TEST_SMUDGE_SUFFIX,
+                               TEST_SPOOL_SIZE)
+from dotsecrets.patterns import list_filtered_files
+from dotsecrets.redact import configure_redaction
+from dotsecrets.smudge import (load_all_secrets,
+                               get_smudge_filter,
+                               configure_smudge_filter)
+from dotsecrets.stream import sub_binary_stream, sub_bytes
 from dotsecrets.utils import get_dotfiles_path
 
 
 logger = logging.getLogger(__name__)
 
 
-def check_test_results(source_file, clean_file, smudge_file):
-    logger.info("Comparing '%s' before and after cleaning",
-                source_file)
-    try:
-        subprocess.run(['diff', '-u',
-                        str(source_file), str(clean_file)],
-                       # stdout=subprocess.DEVNULL,
-                       check=True)
-    except subprocess.CalledProcessError:
-        logger.info("Source '%s' and cleaned source differ", source_file)
+class HashWriter(io.BufferedIOBase):
+    """Binary stream hashing all data written to it.
+
+    The data is passed on to the target stream, if any.
+    """
+    def __init__(self, target=None):
+        super().__init__()
+        self.target = target
+        self.hash = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.hash.update(data)
+        if self.target is not None:
+            self.target.write(data)
+        return len(data)
+
+    def digest(self):
+        return self.hash.digest()
+
+
+def hash_file(source_file):
+    source_hash = hashlib.sha256()
+    with source_file.open(mode='rb') as f:
+        while True:
+            data = f.read(DOTFILTERS_CHUNK_SIZE)
+            if not data:
+                break
+            source_hash.update(data)
+    return source_hash.digest()
+
+
+def diff_text(source_file, a, b, suffix, encoding):
+    """Return the unified diff between two versions of a source file."""
+    encoding = encoding or 'utf-8'
+    a_lines = a.decode(encoding, errors='replace').splitlines(keepends=True)
+    b_lines = b.decode(encoding, errors='replace').splitlines(keepends=True)
+    lines = []
+    for line in difflib.unified_diff(a_lines, b_lines, str(source_file),
+                                     str(source_file) + suffix):
+        if not line.endswith('\n'):
+            line += '\n\\ No newline at end of file\n'
+        lines.append(line)
+    return ''.join(lines)
+
+
+def open_result(source_file, suffix, keep):
+    if keep:
+        return source_file.with_name(source_file.name + suffix) \
+            .open(mode='w+b')
+    return tempfile.SpooledTemporaryFile(max_size=TEST_SPOOL_SIZE)
+
+
+def check_file(source_file, clean_filter, smudge_filter, show_clean=False,
+               keep=False):
+    """Clean and smudge a file and compare the results with the source.
+
+    The cleaned source is kept in memory up to TEST_SPOOL_SIZE bytes, the
+    smudged source is only hashed. Unified diffs are only rendered when
+    requested or when the smudged source differs. Returns whether the
+    test passed and the diffs.
+    """
+    diffs = []
+    encoding = getattr(clean_filter, 'encoding', None)
+    with open_result(source_file, TEST_CLEAN_SUFFIX, keep) as clean_stream:
+        clean_hash = HashWriter(clean_stream)
+        with source_file.open(mode='rb') as input_stream:
+            sub_binary_stream(input_stream, clean_hash, clean_filter)
+        source_digest = hash_file(source_file)
+        if clean_hash.digest() == source_digest:
+            logger.warning("Source and cleaned source are identical\n"
+                           "Does '%s' contain secrets?", source_file)
+            return False, diffs
+        clean_stream.seek(0)
+        if keep:
+            with open_result(source_file, TEST_SMUDGE_SUFFIX,
+                             keep) as smudge_stream:
+                smudge_hash = HashWriter(smudge_stream)
+                sub_binary_stream(clean_stream, smudge_hash, smudge_filter)
+        else:
+            smudge_hash = HashWriter()
+            sub_binary_stream(clean_stream, smudge_hash, smudge_filter)
+        passed = smudge_hash.digest() == source_digest
+        if show_clean or not passed:
+            source = source_file.read_bytes()
+            clean_stream.seek(0)
+            cleaned = clean_stream.read()
+            diffs.append(diff_text(source_file, source, cleaned,
+                                   TEST_CLEAN_SUFFIX, encoding))
+            if not passed:
+                diffs.append(diff_text(source_file, source,
+                                       sub_bytes(cleaned, smudge_filter),
+                                       TEST_SMUDGE_SUFFIX, encoding))
+    if passed:
+        logger.info("Source '%s' and smudged source are identical",
+                    source_file)
     else:
-        logger.warning("Source and cleaned source are identical\n"
-                       "Does '%s' contain secrets?", source_file)
-        return False
-    logger.info("Comparing '%s' before and after smudge",
-                source_file)
-    try:
-        subprocess.run(['diff', '-u',
-                        str(source_file), str(smudge_file)],
-                       # stdout=subprocess.DEVNULL,
-                       check=True)
-    except subprocess.CalledProcessError:
         logger.warning("Source '%s' and smudged source differ\n"
                        "Please adjust filter definition or "
                        "validate your stored secrets", source_file)
-        return False
-    else:
-        logger.info("Source '%s' and smudged source are identical",
-                    source_file)
-        return True
-
-
-def delete_test_results(clean_file, smudge_file):
-    logger.info("Delete intermediate files '%s' and '%s'",
-                clean_file, smudge_file)
-    try:
-        clean_file.unlink()
-    except FileNotFoundError:
-        pass
-    try:
-        smudge_file.unlink()
-    except FileNotFoundError:
-        pass
+    return passed, diffs
 
 
-def test(args):
-    repo_path = get_dotfiles_path()
-    source_file = repo_path.joinpath(args.name)
-    clean_file = source_file.with_suffix(source_file.suffix +
-                                         TEST_CLEAN_SUFFIX)
-    smudge_file = source_file.with_suffix(source_file.suffix +
-                                          TEST_SMUDGE_SUFFIX)
+def check_name(dotfiles_path, name, clean_filter, smudge_filter,
+               show_clean=False, keep=False):
     try:
-        clean_filter = get_clean_filter(args.name, args.filters)
-        clean_stream(source_file, clean_file, clean_filter)
-        smudge_filter = get_smudge_filter(args.name, args.store)
-        smudge_filter.read_mode = clean_filter.read_mode
-        smudge_filter.write_mode = clean_filter.write_mode
-        smudge_filter.encoding = clean_filter.encoding
-        smudge_stream(clean_file, smudge_file, smudge_filter)
-        if check_test_results(source_file, clean_file, smudge_file):
-            return 0
-        else:
-            return 1
+        return check_file(dotfiles_path.joinpath(name), clean_filter,
+                          smudge_filter, show_clean, keep)
     except TypeError as exc:
         if (exc.args[0] == "cannot use a string pattern on "
                            "a bytes-like object"):
-            logger.exception("Binary mismatch between "
-                             "clean and smudge filter",
-                             exc_info=logger.isEnabledFor(logging.DEBUG))
+            logger.error("Binary mismatch between clean and smudge "
+                         "filter of '%s'", name)
+            return False, []
+        raise
+
+
+def check_files(dotfiles_path, filters, jobs=None, keep=False):
+    """Test files on a process pool.
+
+    The filters dictionary maps names to a tuple of clean and smudge
+    filter. Returns a dictionary of name to the test result, or to the
+    error message of a failure.
+    """
+    results = {}
+    if jobs == 1 or len(filters) < 2:
+        for name, (clean_filter, smudge_filter) in filters.items():
+            try:
+                results[name] = check_name(dotfiles_path, name,
+                                           clean_filter, smudge_filter,
+                                           keep=keep)
+            except Exception as exc:
+                results[name] = str(exc)
+        return results
+    # The process pool machinery is only needed for many files
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(check_name, dotfiles_path, name,
+                                   clean_filter, smudge_filter,
+                                   keep=keep): name
+                   for name, (clean_filter, smudge_filter)
+                   in filters.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as exc:
+                results[name] = str(exc)
+    return results
+
+
+def start_profile(args, filters):
+    """Profile the clean and smudge filters when requested."""
+    if not args.profile and args.profile_json is None:
+        return None
+    # Only needed when profiling
+    from dotsecrets.profiler import Profile
+    profile = Profile()
+    for clean_filter, smudge_filter in filters:
+        profile.add('clean', clean_filter)
+        profile.add('smudge', smudge_filter)
+    return profile
+
+
+def check_all(args):
+    filters_dict, filters_file = load_all_filters(args.filters)
+    secrets_dict, secrets_file = load_all_secrets(args.store)
+    dotfiles_path = get_dotfiles_path()
+    filters = {}
+    for name in list_filtered_files(dotfiles_path,
+                                    filters_dict.get('filters') or {}):
+        clean_filter = get_clean_filter(name, filters_file, filters_dict)
+        smudge_filter = get_smudge_filter(name, secrets_file, secrets_dict)
+        configure_smudge_filter(smudge_filter, clean_filter)
+        configure_redaction(clean_filter, smudge_filter)
+        filters[name] = (clean_filter, smudge_filter)
+    jobs = args.jobs
+    profile = start_profile(args, filters.values())
+    if profile is not None:
+        # Profiled filters stay in this process, which also keeps the
+        # timings free of other jobs
+        jobs = 1
+    results = check_files(dotfiles_path, filters, jobs, args.keep)
+    if profile is not None:
+        profile.write(args.profile_json)
+    failed = 0
+    for name in sorted(results):
+        result = results[name]
+        if isinstance(result, str):
+            failed += 1
+            print('error\t{}\t{}'.format(name, result))
+            continue
+        passed, diffs = result
+        for diff in diffs:
+            sys.stdout.write(diff)
+        if passed:
+            print('ok\t{}'.format(name))
         else:
-            raise
-    finally:
-        if not args.keep:
-            delete_test_results(clean_file, smudge_file)
+            failed += 1
+            print('fail\t{}'.format(name))
+    if failed:
+        logger.error("Failed to test %d of %d files.", failed, len(results))
+        return 1
+    return 0
+
+
+def test(args):
+    if args.all:
+        if args.name is not None:
+            logger.error("Either test a single file or all files.")
+            return 1
+        return check_all(args)
+    if args.name is None:
+        logger.error("No file to test.")
+        return 1
+    clean_filter = get_clean_filter(args.name, args.filters)
+    smudge_filter = get_smudge_filter(args.name, args.store)
+    configure_smudge_filter(smudge_filter, clean_filter)
+    configure_redaction(clean_filter, smudge_filter)
+    profile = start_profile(args, [(clean_filter, smudge_filter)])
+    passed, diffs = check_name(get_dotfiles_path(), args.name,
+                               clean_filter, smudge_filter,
+                               show_clean=True, keep=args.keep)
+    for diff in diffs:
+        sys.stdout.write(diff)
+    if profile is not None:
+        profile.write(args.profile_json)
+    return 0 if passed else 1
@@ -34,6 +34,10 @@ class CopyFilter(object):
         self.read_mode = 'rb'
         self.write_mode = 'wb'
         self.encoding = None
+        self.buffered = None
+        self.parallel = None
+        # Copying never changes a line
+        self.literals = []
 
     def sub(self, line):
         return line
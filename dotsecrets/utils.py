@@ -2,17 +2,34 @@ import errno
 import logging
 import os
 import stat
+import zlib
 
 from pathlib import Path
 
 from dotsecrets.params import (DOTFILES_PATH,
+                               DOTSECRETS_AGENT_SOCK,
+                               DOTSECRETS_SHARED,
                                DOTFILTERS_FILE,
+                               DOTFILTERS_INDEX_SUFFIX,
+                               SMUDGE_STATE_SUFFIX,
+                               DOTSECRETS_COMPILED_SUFFIX,
                                DOTSECRETS_XDG_NAME,
                                DOTSECRETS_FILE)
 
 
 logger = logging.getLogger(__name__)
 
+yaml = None
+
+
+def load_yaml(stream):
+    # Import ruamel.yaml on first use, it dominates the startup time
+    global yaml
+    if yaml is None:
+        from ruamel.yaml import YAML
+        yaml = YAML(typ='safe')
+    return yaml.load(stream)
+
 
 def get_git_repository_root():
     cwd_path = Path.cwd()
@@ -77,5 +94,98 @@ def get_dotsecrets_file():
         raise PermissionError(errno.EACCES, msg, str(secrets_file))
 
 
+def get_compiled_secrets_file(secrets_file):
+    # Holds the same secrets as the store, so it is kept beside it rather
+    # than in the cache directory
+    return secrets_file.with_name(secrets_file.name +
+                                  DOTSECRETS_COMPILED_SUFFIX)
+
+
+def get_dotsecrets_cache_path():
+    env_cache_home = os.getenv('XDG_CACHE_HOME')
+    if env_cache_home is not None:
+        cache_path = Path(env_cache_home)
+    else:
+        cache_path = Path.home().joinpath('.cache')
+    cache_path = cache_path.joinpath(DOTSECRETS_XDG_NAME)
+    logger.debug("Dotsecrets cache path is '%s'", cache_path)
+    return cache_path
+
+
+def get_dotsecrets_runtime_path():
+    # Only the per user runtime directory is trusted to hold secrets, it
+    # is private and usually not backed by a disk
+    env_runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if not env_runtime_dir:
+        return None
+    return Path(env_runtime_dir).joinpath(DOTSECRETS_XDG_NAME)
+
+
+def get_shared_secrets_file(secrets_file):
+    # Sharing only pays off for many smudge processes at the same time,
+    # a single checkout should not leave its secrets behind
+    if os.getenv(DOTSECRETS_SHARED, '') in ('', '0'):
+        return None
+    runtime_path = get_dotsecrets_runtime_path()
+    if runtime_path is None:
+        return None
+    path_crc = zlib.crc32(str(secrets_file.absolute()).encode('utf-8'))
+    return runtime_path.joinpath('secrets-%08x%s' %
+                                 (path_crc, DOTSECRETS_COMPILED_SUFFIX))
+
+
+def get_clean_cache_path():
+    return get_dotsecrets_cache_path().joinpath('clean')
+
+
+def get_dotfilters_index_file(filters_file):
+    # Each filters file gets its own index named after its location, the
+    # index itself records the full location to detect collisions
+    path_crc = zlib.crc32(str(filters_file.absolute()).encode('utf-8'))
+    index_file = get_dotsecrets_cache_path().joinpath(
+        'filters', '%08x%s' % (path_crc, DOTFILTERS_INDEX_SUFFIX))
+    logger.debug("Dotfilters index file is '%s'", index_file)
+    return index_file
+
+
+def get_smudge_state_file(dotfiles_path):
+    path_crc = zlib.crc32(str(dotfiles_path.absolute()).encode('utf-8'))
+    state_file = get_dotsecrets_cache_path().joinpath(
+        'state', '%08x%s' % (path_crc, SMUDGE_STATE_SUFFIX))
+    logger.debug("Smudge state file is '%s'", state_file)
+    return state_file
+
+
+def get_agent_socket_file():
+    env_sock = os.getenv(DOTSECRETS_AGENT_SOCK)
+    if not env_sock:
+        return None
+    return Path(env_sock)
+
+
+class FileLock(object):
+    """Exclusive lock on a lock file, held while in the context."""
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.fd = None
+
+    def __enter__(self):
+        # Only needed when locking, not available on all platforms
+        import fcntl
+        self.lock_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the file releases the lock
+        os.close(self.fd)
+        self.fd = None
+
+
 def is_sub_path(child_path, parent_path):
     return (parent_path == child_path) or (parent_path in child_path.parents)
@@ -0,0 +1,71 @@
+import logging
+import os
+import stat
+import tempfile
+import threading
+import unittest
+
+from pathlib import Path
+
+from dotsecrets.agent import AgentError, AgentServer, query_agent
+from dotsecrets.smudge import get_smudge_filter
+
+
+class TestAgent(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_file = Path(self.tmp_dir.name).joinpath('agent.sock')
+        secrets_dict = {
+            'filters': {
+                'muttrc': {
+                    'secrets': {
+                        'passwd_1': {'secret': 's3cr3t'}
+                    }
+                }
+            }
+        }
+        self.server = AgentServer(self.socket_file,
+                                  secrets_file=Path('dotsecrets.yaml'),
+                                  secrets_dict=secrets_dict)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        os.environ.pop('DOTSECRETS_AGENT_SOCK', None)
+        self.tmp_dir.cleanup()
+
+    def test_socket_mode(self):
+        """Test socket is accessible by the user only"""
+        mode = stat.S_IMODE(self.socket_file.stat().st_mode)
+        self.assertEqual(mode, 0o600)
+
+    def test_query(self):
+        """Test query for secrets of a filter"""
+        secrets_def, store = query_agent(self.socket_file, 'muttrc')
+        self.assertEqual(secrets_def['secrets']['passwd_1']['secret'],
+                         's3cr3t')
+        self.assertEqual(store, 'dotsecrets.yaml')
+        with self.assertRaises(KeyError):
+            query_agent(self.socket_file, 'missing')
+
+    def test_unreachable(self):
+        """Test unreachable agent"""
+        with self.assertRaises(AgentError):
+            query_agent(self.socket_file.with_name('missing.sock'),
+                        'muttrc')
+
+    def test_smudge_filter(self):
+        """Test smudge filter uses the agent"""
+        os.environ['DOTSECRETS_AGENT_SOCK'] = str(self.socket_file)
+        smudge_filter = get_smudge_filter('muttrc')
+        self.assertEqual(smudge_filter.sub('$DotSecrets: passwd_1$'),
+                         's3cr3t')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import io
+import logging
+import subprocess
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.audit import (AuditScanner, audit, audit_history,
+                              iter_new_blobs)
+
+
+FILTERS = {
+    'mutt/.muttrc': {
+        'rules': {
+            'passwd': {
+                'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+                'substitute': r'password\1=\2(?#Key)'
+            }
+        }
+    }
+}
+
+SECRETS = {('mutt/.muttrc', 'passwd'): 's3cr3t',
+           ('vimrc', 'token'): 'tok-123456'}
+
+FILTERS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+"""
+
+SECRETS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    secrets:
+      passwd:
+        secret: s3cr3t
+  "vimrc":
+    secrets:
+      token:
+        secret: tok-123456
+"""
+
+
+class TestAuditScanner(unittest.TestCase):
+
+    def test_scan(self):
+        """Test secret values and uncleaned rule lines are found"""
+        scanner = AuditScanner(SECRETS, FILTERS)
+        data = ('set x\n'
+                'password = $DotSecrets: passwd$\n'
+                'url = https://host/tok-123456\n'
+                'password = hunter22\n').encode('utf-8')
+        self.assertEqual(scanner.scan('mutt/.muttrc', data),
+                         [(3, 'secret', 'vimrc', 'token'),
+                          (4, 'rule', 'mutt/.muttrc', 'passwd')])
+        self.assertEqual(scanner.scan('other', data),
+                         [(3, 'secret', 'vimrc', 'token')])
+
+    def test_numbered(self):
+        """Test tags of numbered rules are not hits in any blob"""
+        rule = dict(FILTERS['mutt/.muttrc']['rules']['passwd'],
+                    numbered=True)
+        scanner = AuditScanner({}, {'m': {'rules': {'p': rule}}})
+        data = (b'password = $DotSecrets: p_1$\n'
+                b'password = $DotSecrets: p_2$\n')
+        self.assertEqual(scanner.scan('m', data), [])
+        self.assertEqual(scanner.scan('m', data), [])
+        self.assertEqual(scanner.scan('m', b'password = xy\n'),
+                         [(1, 'rule', 'm', 'p')])
+
+    def test_raw_log(self):
+        """Test added and modified blobs are read from a raw log"""
+        log = (b'\x01' + b'a' * 40 + b'\0\n'
+               b':000000 100644 ' + b'0' * 40 + b' ' + b'1' * 40 + b' A\0'
+               b'x y\0'
+               b':100644 000000 ' + b'1' * 40 + b' ' + b'0' * 40 + b' D\0'
+               b'z\0'
+               b'\x01' + b'b' * 40 + b'\0\n'
+               b':100644 100644 ' + b'1' * 40 + b' ' + b'2' * 40 + b' M\0'
+               b'x y\0')
+        self.assertEqual(list(iter_new_blobs(io.BytesIO(log))),
+                         [('a' * 40, 'x y', b'1' * 40),
+                          ('b' * 40, 'x y', b'2' * 40)])
+
+
+class TestAuditHistory(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.dotfiles_path = self.tmp_path.joinpath('dotfiles')
+        self.dotfiles_path.joinpath('mutt').mkdir(parents=True)
+        try:
+            self.git('init', '-q')
+            self.git('config', 'user.name', 'test')
+            self.git('config', 'user.email', 'test@example.com')
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('git is not available')
+        # The same content at a filtered path is scanned for rules again
+        self.commit('vimrc', 'password = s3cr3t\n')
+        self.commit('mutt/.muttrc', 'password = s3cr3t\n')
+        self.commit('mutt/.muttrc', 'password = $DotSecrets: passwd$\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def git(self, *args):
+        return subprocess.run(('git',) + args, cwd=str(self.dotfiles_path),
+                              stdout=subprocess.PIPE, check=True
+                              ).stdout.decode('ascii').strip()
+
+    def commit(self, name, content):
+        self.dotfiles_path.joinpath(name).write_text(content)
+        self.git('add', name)
+        self.git('commit', '-q', '-m', name)
+
+    def check_history(self, jobs):
+        first, second = self.git('rev-list', '--reverse',
+                                 'HEAD').split()[:2]
+        results = audit_history(self.dotfiles_path, ['--all'],
+                                AuditScanner(SECRETS, FILTERS), jobs)
+        self.assertEqual(
+            [result[1:] for result in results],
+            [(first, 'vimrc', 1, 'secret', 'mutt/.muttrc', 'passwd'),
+             (second, 'mutt/.muttrc', 1, 'rule', 'mutt/.muttrc', 'passwd')])
+
+    def test_serial(self):
+        """Test the history is audited in a single process"""
+        self.check_history(1)
+
+    def test_parallel(self):
+        """Test the history is audited in a process pool"""
+        self.check_history(2)
+
+    def test_command(self):
+        """Test the audit command reports hits without the secret"""
+        filters_file = self.tmp_path.joinpath('filters.yaml')
+        filters_file.write_text(FILTERS_YAML)
+        secrets_file = self.tmp_path.joinpath('dotsecrets.yaml')
+        secrets_file.write_text(SECRETS_YAML)
+        args = mock.Mock(filters=filters_file, store=secrets_file, revs=[],
+                         jobs=1)
+        out = io.StringIO()
+        with mock.patch('dotsecrets.audit.get_dotfiles_path',
+                        return_value=self.dotfiles_path), \
+                mock.patch('sys.stdout', out):
+            self.assertEqual(audit(args), 1)
+        self.assertIn(":vimrc:1: secret 'passwd' of filter "
+                      "'mutt/.muttrc'", out.getvalue())
+        self.assertIn(":mutt/.muttrc:1: rule 'passwd' of filter "
+                      "'mutt/.muttrc'", out.getvalue())
+        self.assertNotIn('s3cr3t', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import argparse
+import logging
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.batch import batch
+
+
+FILTERS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+"""
+
+SECRETS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    secrets:
+      passwd:
+        secret: s3cr3t
+"""
+
+SOURCE = 'password = s3cr3t # comment\n'
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.dotfiles_path = tmp_path.joinpath('dotfiles')
+        self.dotfiles_path.joinpath('mutt').mkdir(parents=True)
+        self.names = ['mutt/.muttrc', 'plain']
+        for name in self.names:
+            self.dotfiles_path.joinpath(name).write_text(SOURCE)
+        self.filters_file = tmp_path.joinpath('filters.yaml')
+        self.filters_file.write_text(FILTERS_YAML)
+        self.secrets_file = tmp_path.joinpath('secrets.yaml')
+        self.secrets_file.write_text(SECRETS_YAML)
+        self.output_dir = tmp_path.joinpath('output')
+        env = mock.patch.dict(os.environ,
+                              {'DOTFILES_PATH': str(self.dotfiles_path),
+                               'XDG_CACHE_HOME': str(tmp_path)})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_batch(self, command, paths, jobs=2, **kwargs):
+        args = argparse.Namespace(batch_command=command, paths=paths,
+                                  paths_from=None, null=False, jobs=jobs,
+                                  filters=self.filters_file,
+                                  store=self.secrets_file,
+                                  output_dir=self.output_dir,
+                                  in_place=False)
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return batch(args)
+
+    def test_round_trip(self):
+        """Test clean to a directory and smudge in place"""
+        paths = [str(self.dotfiles_path.joinpath(name))
+                 for name in self.names]
+        self.assertEqual(self.run_batch('clean', paths), 0)
+        cleaned = self.output_dir.joinpath('mutt', '.muttrc').read_text()
+        self.assertEqual(cleaned,
+                         'password = $DotSecrets: passwd$ # comment\n')
+        self.assertEqual(self.output_dir.joinpath('plain').read_text(),
+                         SOURCE)
+        self.dotfiles_path.joinpath('mutt', '.muttrc').write_text(cleaned)
+        self.assertEqual(self.run_batch('smudge', paths, in_place=True), 0)
+        self.assertEqual(
+            self.dotfiles_path.joinpath('mutt', '.muttrc').read_text(),
+            SOURCE)
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(str(self.dotfiles_path))),
+                         ['mutt', 'plain'])
+
+    def test_paths_from(self):
+        """Test NUL separated paths read from a file"""
+        paths_file = Path(self.tmp_dir.name).joinpath('paths')
+        paths_file.write_bytes(b'\0'.join(
+            os.fsencode(str(self.dotfiles_path.joinpath(name)))
+            for name in self.names) + b'\0')
+        self.assertEqual(self.run_batch('clean', [], jobs=1,
+                                        paths_from=str(paths_file),
+                                        null=True), 0)
+        self.assertTrue(self.output_dir.joinpath('plain').exists())
+
+    def test_failure(self):
+        """Test a failing path does not stop the other paths"""
+        paths = [self.tmp_dir.name,
+                 str(self.dotfiles_path.joinpath('missing')),
+                 str(self.dotfiles_path.joinpath('plain'))]
+        self.assertEqual(self.run_batch('clean', paths), 1)
+        self.assertTrue(self.output_dir.joinpath('plain').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+import unittest
+
+from pathlib import Path
+
+
+THROUGHPUT = Path(__file__).parents[1].joinpath('benchmarks',
+                                                'throughput.py')
+
+
+class TestThroughput(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Test synthetic dotfiles survive a clean and smudge round trip"""
+        proc = subprocess.run([sys.executable, str(THROUGHPUT),
+                               '--quick', '--repeat', '1',
+                               '--case', 'small', '--case', 'dense'],
+                              stdout=subprocess.PIPE,
+                              universal_newlines=True)
+        self.assertEqual(proc.returncode, 0)
+        results = json.loads(proc.stdout)['results']
+        self.assertEqual(set(results), {'small', 'dense'})
+        for result in results.values():
+            self.assertTrue(result['verified'])
+            self.assertGreater(result['secret_lines'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
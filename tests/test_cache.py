@@ -0,0 +1,153 @@
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.cache import CleanCache, clean_file_cached
+from dotsecrets.clean import CleanFilter
+from dotsecrets.stream import sub_bytes
+
+
+RULES = {
+    'passwd': {
+        'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+        'substitute': r'password\1=\2(?#Key)'
+    }
+}
+
+CONTENT = 'set x\npassword = s3cr3t # comment\n'.encode('utf-8')
+
+
+class TestCleanCache(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.tmp_dir.name).joinpath('clean')
+        self.clean_filter = CleanFilter('config', {'rules': RULES})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit(self):
+        """Test a second clean of the same content is read from cache"""
+        clean_cache = CleanCache(self.cache_path)
+        expected = sub_bytes(CONTENT, self.clean_filter)
+        self.assertEqual(clean_cache.clean(CONTENT, self.clean_filter),
+                         expected)
+        self.assertEqual(len(clean_cache.list_entries()), 1)
+        name = clean_cache.entry_name(self.clean_filter, CONTENT)
+        clean_cache.entries_path.joinpath(name).write_bytes(b'cached')
+        self.assertEqual(clean_cache.clean(CONTENT, self.clean_filter),
+                         b'cached')
+        # Another filter definition misses
+        other_filter = CleanFilter('config', {'rules': RULES,
+                                              'encoding': 'ascii'})
+        self.assertEqual(clean_cache.clean(CONTENT, other_filter), expected)
+
+    def test_unchanged(self):
+        """Test output equal to its input is not stored"""
+        clean_cache = CleanCache(self.cache_path)
+        self.assertEqual(clean_cache.clean(b'set x\n', self.clean_filter),
+                         b'set x\n')
+        self.assertEqual(clean_cache.list_entries(), [])
+
+    def test_keyed_names(self):
+        """Test entry names do not reveal a plain hash of the input"""
+        clean_cache = CleanCache(self.cache_path)
+        clean_cache.clean(CONTENT, self.clean_filter)
+        name = clean_cache.list_entries()[0][0]
+        self.assertNotEqual(name, hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(os.stat(str(clean_cache.key_file)).st_mode & 0o077,
+                         0)
+
+    def test_evict(self):
+        """Test the least recently used entries are evicted"""
+        contents = [CONTENT + '# {}\n'.format(i).encode('utf-8')
+                    for i in range(3)]
+        output_size = len(sub_bytes(contents[0], self.clean_filter))
+        clean_cache = CleanCache(self.cache_path, max_size=2 * output_size)
+        names = []
+        for i, data in enumerate(contents[:2]):
+            clean_cache.clean(data, self.clean_filter)
+            name = clean_cache.entry_name(self.clean_filter, data)
+            os.utime(str(clean_cache.entries_path.joinpath(name)), (i, i))
+            names.append(name)
+        # Reading the oldest entry makes it the most recently used
+        clean_cache.clean(contents[0], self.clean_filter)
+        clean_cache.clean(contents[2], self.clean_filter)
+        remaining = {entry[0] for entry in clean_cache.list_entries()}
+        self.assertIn(names[0], remaining)
+        self.assertNotIn(names[1], remaining)
+        self.assertEqual(len(remaining), 2)
+
+    def test_clear(self):
+        """Test clearing removes all entries and the key"""
+        clean_cache = CleanCache(self.cache_path)
+        clean_cache.clean(CONTENT, self.clean_filter)
+        clean_cache.clear()
+        self.assertEqual(clean_cache.list_entries(), [])
+        self.assertFalse(clean_cache.key_file.exists())
+
+
+class BoundedInput(io.BytesIO):
+    """Input stream refusing to be read as a whole."""
+    def read(self, size=-1):
+        assert size is not None and size >= 0, 'unbounded read'
+        return super().read(size)
+
+
+class TestCleanFileCached(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.cache_path = self.tmp_path.joinpath('clean')
+        self.clean_filter = CleanFilter('config', {'rules': RULES})
+        self.data = CONTENT * 20000
+        self.expected = sub_bytes(self.data, self.clean_filter)
+        patcher = mock.patch('dotsecrets.cache.get_clean_cache_path',
+                             return_value=self.cache_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_file(self):
+        """Test a large file is cleaned through the cache"""
+        input_file = self.tmp_path.joinpath('input')
+        output_file = self.tmp_path.joinpath('output')
+        input_file.write_bytes(self.data)
+        for hit in (False, True):
+            clean_file_cached(input_file, output_file, self.clean_filter)
+            self.assertEqual(output_file.read_bytes(), self.expected, hit)
+            self.assertEqual(len(CleanCache(self.cache_path)
+                                 .list_entries()), 1)
+
+    def test_stream(self):
+        """Test piped input is never read as a whole"""
+        clean_cache = CleanCache(self.cache_path)
+        for hit in (False, True):
+            input_stream = BoundedInput(self.data)
+            data = input_stream.read(1024)
+            output_stream = io.BytesIO()
+            clean_cache.clean_stream(data, input_stream, output_stream,
+                                     self.clean_filter)
+            self.assertEqual(output_stream.getvalue(), self.expected, hit)
+        # Unchanged output is not stored
+        output_stream = io.BytesIO()
+        clean_cache.clean_stream(b'', BoundedInput(b'set x\n' * 50000),
+                                 output_stream, self.clean_filter)
+        self.assertEqual(output_stream.getvalue(), b'set x\n' * 50000)
+        self.assertEqual(len(clean_cache.list_entries()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,8 @@
 import logging
+import signal
 import unittest
 
-from dotsecrets.clean import CleanSecret
+from dotsecrets.clean import CleanFilter, CleanSecret, RuleTimeoutError
 
 
 class TestCleanSecret(unittest.TestCase):
@@ -32,7 +33,7 @@ class TestCleanSecret(unittest.TestCase):
         """Test regex substitution with predefined short cuts"""
         self.assertEqual(self.secrets[0].regex.pattern,
                          r'password(\s*)=(\s*)'
-                         r'([^\s#]+(?:[ \t\v\f]*[^\s#]+)+)')
+                         r'([^\s#][ \t\v\f]*[^\s#]+(?:[ \t\v\f]+[^\s#]+)*)')
         self.assertEqual(self.secrets[1].regex.pattern,
                          r'password(\s*)=(\s*)'
                          r'("[^"\\]*(?:\\.[^"\\]*)*'
@@ -97,6 +98,50 @@ class TestCleanSecret(unittest.TestCase):
         out = self.secrets[1].sub(line)
         self.assertEqual(out, 'password = $DotSecrets: passwd_1$')
 
+    def test_prefilter(self):
+        """Test lines without the required literal skip the regex"""
+        secret = self.secrets[0]
+        self.assertEqual(secret.literal, 'password')
+        self.assertEqual(secret.sub('user = me # password'),
+                         'user = me # password')
+        self.assertEqual(secret.sub('user = me'), 'user = me')
+        self.assertEqual(secret.sub('password = s3cr3t'),
+                         'password = $DotSecrets: passwd_1$')
+        self.assertEqual((secret.skipped, secret.scanned), (1, 2))
+
+
+@unittest.skipUnless(hasattr(signal, 'setitimer'), 'requires setitimer')
+class TestTimeBudget(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.clean_filter = CleanFilter('name', {
+            'time_budget': 0.05,
+            'rules': {
+                'slow': {'regex': r'slow = (a+)+b',
+                         'substitute': r'slow = (?#Key)'},
+                'fast': {'regex': r'fast = (\S+)',
+                         'substitute': r'fast = (?#Key)',
+                         'time_budget': 1},
+            }})
+
+    def test_within_budget(self):
+        """Test rules within their time budget"""
+        self.assertIsNone(self.clean_filter.scanner)
+        self.assertEqual(self.clean_filter.rules['slow'].time_budget, 0.05)
+        self.assertEqual(self.clean_filter.rules['fast'].time_budget, 1)
+        self.assertEqual(self.clean_filter.sub('fast = x\n'),
+                         'fast = $DotSecrets: fast$\n')
+        self.assertEqual(self.clean_filter.sub('slow = aab\n'),
+                         'slow = $DotSecrets: slow$\n')
+
+    def test_exceeded(self):
+        """Test a rule exceeding its time budget is interrupted"""
+        with self.assertRaisesRegex(RuleTimeoutError, "Rule 'slow'"):
+            self.clean_filter.sub('slow = ' + 'a' * 64 + '\n')
+        # The timer does not fire after the rule
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from dotsecrets.clean import expand_filters
+from dotsecrets.index import IndexCache
+
+
+FILTERS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+  "empty":
+"""
+
+
+class TestIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.filters_file = tmp_path.joinpath('.dotfilters.yaml')
+        self.filters_file.write_text(FILTERS_YAML)
+        self.set_old_mtime()
+        self.index_file = tmp_path.joinpath('cache', 'filters.idx')
+        self.parsed = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def set_old_mtime(self):
+        # Avoid the racy check by backdating the source
+        st = self.filters_file.stat()
+        os.utime(str(self.filters_file), (st.st_atime - 60,
+                                          st.st_mtime - 60))
+
+    def parse(self, content):
+        self.parsed += 1
+        return expand_filters(content)
+
+    def get(self, name):
+        return IndexCache(self.filters_file,
+                          self.index_file).get(name, self.parse)
+
+    def test_expanded(self):
+        """Test keywords are expanded in the index"""
+        filters_def = self.get('mutt/.muttrc')
+        self.assertEqual(filters_def['rules']['passwd']['regex'],
+                         r'password(\s*)=(\s*)'
+                         r'([^\s#][ \t\v\f]*[^\s#]+(?:[ \t\v\f]+[^\s#]+)*)')
+        self.assertIsNone(self.get('empty'))
+        with self.assertRaises(KeyError):
+            self.get('missing')
+
+    def test_parse_once(self):
+        """Test the source is parsed only once"""
+        self.get('mutt/.muttrc')
+        self.get('mutt/.muttrc')
+        self.get('empty')
+        self.assertEqual(self.parsed, 1)
+
+    def test_touch(self):
+        """Test touching the source does not parse again"""
+        self.get('mutt/.muttrc')
+        os.utime(str(self.filters_file), None)
+        self.get('mutt/.muttrc')
+        self.assertEqual(self.parsed, 1)
+
+    def test_changed(self):
+        """Test changing the source rebuilds the index"""
+        self.get('mutt/.muttrc')
+        self.filters_file.write_text(FILTERS_YAML.replace('passwd',
+                                                          'secret'))
+        self.set_old_mtime()
+        filters_def = self.get('mutt/.muttrc')
+        self.assertIn('secret', filters_def['rules'])
+        self.assertEqual(self.parsed, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
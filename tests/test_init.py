@@ -0,0 +1,196 @@
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.init import SmudgeState, initial_smudge, smudge_files
+from dotsecrets.smudge import SmudgeFilter
+
+
+FILTERS_YAML = """version: 2
+filters:
+  "hosts/*/muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+"""
+
+SECRETS_YAML = """version: 2
+filters:
+  "hosts/*/muttrc":
+    secrets:
+      passwd:
+        secret: s3cr3t
+"""
+
+
+class TestSmudgeFiles(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dotfiles_path = Path(self.tmp_dir.name)
+        self.smudge_filters = {}
+        for i in range(4):
+            name = 'file{}'.format(i)
+            self.dotfiles_path.joinpath(name).write_text(
+                'password = $DotSecrets: passwd$\n')
+            self.smudge_filters[name] = SmudgeFilter(name, {
+                'passwd': {'secret': 's3cr3t{}'.format(i)}})
+        self.smudge_filters['missing'] = SmudgeFilter('missing')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_files(self, jobs):
+        with self.assertLogs('dotsecrets.init', logging.INFO) as logs:
+            written, failed = smudge_files(self.dotfiles_path,
+                                           self.smudge_filters, jobs=jobs)
+        self.assertEqual(sorted(written), ['file{}'.format(i)
+                                           for i in range(4)])
+        self.assertEqual(failed, {'missing'})
+        # The same files are reported whatever the number of jobs
+        self.assertEqual(sorted(line for line in logs.output
+                                if 'Smudged' in line),
+                         ["INFO:dotsecrets.init:Smudged 'file{}'.".format(i)
+                          for i in range(4)])
+        for i in range(4):
+            content = self.dotfiles_path.joinpath(
+                'file{}'.format(i)).read_text()
+            self.assertEqual(content, 'password = s3cr3t{}\n'.format(i))
+        # No temporary files are left behind
+        self.assertEqual(len(list(self.dotfiles_path.iterdir())), 4)
+
+    def test_serial(self):
+        """Test smudge files in this process"""
+        self.check_files(1)
+
+    def test_parallel(self):
+        """Test smudge files on a process pool"""
+        self.check_files(2)
+
+    def test_unchanged(self):
+        """Test files already smudged are not written again"""
+        smudge_files(self.dotfiles_path, self.smudge_filters, jobs=1)
+        source_file = self.dotfiles_path.joinpath('file0')
+        inode = source_file.stat().st_ino
+        written, failed = smudge_files(self.dotfiles_path,
+                                       self.smudge_filters, jobs=1)
+        self.assertEqual(written, [])
+        self.assertEqual(source_file.stat().st_ino, inode)
+
+
+class TestInitialSmudge(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.dotfiles_path = tmp_path.joinpath('dotfiles')
+        package_path = Path(__file__).absolute().parent.parent
+        env = mock.patch.dict(os.environ,
+                              {'DOTFILES_PATH': str(self.dotfiles_path),
+                               'XDG_CACHE_HOME': str(tmp_path),
+                               'PYTHONPATH': str(package_path)})
+        env.start()
+        self.addCleanup(env.stop)
+        self.secrets_file = tmp_path.joinpath('dotsecrets.yaml')
+        self.secrets_file.write_text(SECRETS_YAML)
+        self.dotfiles_path.mkdir()
+        self.dotfiles_path.joinpath('.dotfilters.yaml').write_text(
+            FILTERS_YAML)
+        self.dotfiles_path.joinpath('.gitattributes').write_text(
+            'muttrc filter=dotsecrets\n')
+        for name in ('hosts/a/muttrc', 'hosts/b/muttrc'):
+            self.dotfiles_path.joinpath(name).parent.mkdir(parents=True)
+            self.dotfiles_path.joinpath(name).write_text(
+                'password = $DotSecrets: passwd$\n')
+        try:
+            self.git('init', '-q')
+            self.git('add', '.')
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('git is not available')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'dotfiles')
+        self.set_clean('{} -m dotsecrets.main clean %f'.format(
+            sys.executable))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def git(self, *args):
+        subprocess.run(('git',) + args, cwd=str(self.dotfiles_path),
+                       stdout=subprocess.DEVNULL, check=True)
+
+    def set_clean(self, command):
+        self.git('config', 'filter.dotsecrets.clean', command)
+
+    def test_pattern(self):
+        """Test files sharing the secrets of a pattern are smudged"""
+        self.assertEqual(initial_smudge(None, self.secrets_file, jobs=1), 0)
+        for name in ('hosts/a/muttrc', 'hosts/b/muttrc'):
+            self.assertEqual(self.dotfiles_path.joinpath(name).read_text(),
+                             'password = s3cr3t\n')
+
+    def test_diff_failure(self):
+        """Test files failing the clean check are checked again"""
+        self.set_clean('cat')
+        self.assertEqual(initial_smudge(None, self.secrets_file, jobs=1), 1)
+        self.assertEqual(initial_smudge(None, self.secrets_file, jobs=1), 1)
+
+
+class TestSmudgeState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.source_file = tmp_path.joinpath('file')
+        self.source_file.write_text('content\n')
+        # Avoid the racy check by backdating the source
+        st = self.source_file.stat()
+        os.utime(str(self.source_file), (st.st_atime - 60,
+                                         st.st_mtime - 60))
+        self.state_file = tmp_path.joinpath('state', 'files.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def load(self):
+        state = SmudgeState(self.state_file)
+        state.load()
+        return state
+
+    def test_current(self):
+        """Test a saved file is current until it or its hashes change"""
+        state = self.load()
+        self.assertFalse(state.is_current('file', self.source_file,
+                                          'f', 's'))
+        state.update('file', self.source_file, 'f', 's')
+        state.save()
+        state = self.load()
+        self.assertTrue(state.is_current('file', self.source_file,
+                                         'f', 's'))
+        self.assertFalse(state.is_current('file', self.source_file,
+                                          'f', 'other'))
+        self.source_file.write_text('changed\n')
+        self.assertFalse(state.is_current('file', self.source_file,
+                                          'f', 's'))
+
+    def test_racy(self):
+        """Test a file modified while saving the state is not current"""
+        os.utime(str(self.source_file), None)
+        state = self.load()
+        state.update('file', self.source_file, 'f', 's')
+        state.save()
+        self.assertFalse(self.load().is_current('file', self.source_file,
+                                                'f', 's'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from dotsecrets.lint import lint_filter, lint_regex
+from dotsecrets.params import DOTFILTERS_KEYWORD_DICT
+
+
+class TestLintRegex(unittest.TestCase):
+
+    def levels(self, regex):
+        return [level for level, message in lint_regex(regex)]
+
+    def test_keywords(self):
+        """Test the keyword expansions do not backtrack catastrophically"""
+        for keyword, regex in DOTFILTERS_KEYWORD_DICT.items():
+            self.assertEqual(lint_regex(regex + ';'), [], keyword)
+
+    def test_nested(self):
+        """Test nested repeats that can split a string in many ways"""
+        self.assertIn('error', self.levels(r'(a+)+b'))
+        self.assertIn('error', self.levels(r'x = (?:[ \t]*[^\s#]+)+;'))
+        self.assertIn('error', self.levels(r'(?:"[^"]*"|\S+)+;'))
+        self.assertIn('error', self.levels(r'(x+x+)+y'))
+        self.assertEqual(self.levels(r'(?:\\.[^"\\]*)*'), [])
+        self.assertEqual(self.levels(r'(?:a*b)+'), [])
+
+    def test_adjacent(self):
+        """Test adjacent repeats of overlapping characters"""
+        self.assertEqual(self.levels(r'\s*\s*='), ['warning'])
+        self.assertEqual(self.levels(r'(.*)=(.*)'), [])
+        self.assertEqual(self.levels(r'user(\s*)=(\s*)(\S+)'), [])
+
+    def test_invalid(self):
+        """Test invalid regexes are reported"""
+        self.assertEqual(self.levels(r'(a'), ['error'])
+
+
+class TestLintFilter(unittest.TestCase):
+
+    def test_filter(self):
+        """Test keywords are expanded before checking rules"""
+        findings = lint_filter({
+            'time_budget': 0,
+            'rules': {
+                'passwd': {'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+                           'substitute': r'password\1=\2(?#Key)'},
+                'slow': {'regex': r'(a+)+b', 'substitute': '(?#Key)',
+                         'time_budget': 0.5},
+            }})
+        self.assertEqual([(key, level) for key, level, message in findings],
+                         [(None, 'error'), ('slow', 'error')])
+
+    def test_long_key(self):
+        """Test rule keys too long for a secret tag"""
+        findings = lint_filter({'rules': {'k' * 256: {'regex': 'x'}}})
+        self.assertEqual([level for key, level, message in findings],
+                         ['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
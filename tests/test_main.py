@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+import unittest
+
+from pathlib import Path
+
+from dotsecrets.main import commands, load_command
+
+
+BUDGET_FILE = Path(__file__).parents[1].joinpath('benchmarks',
+                                                 'import_budget.json')
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_load_command(self):
+        """Test all commands can be loaded"""
+        for name in commands:
+            self.assertTrue(callable(load_command(name)))
+
+    def test_lazy_imports(self):
+        """Test commands do not import modules outside their budget"""
+        budget = json.loads(BUDGET_FILE.read_text())
+        self.assertEqual(set(budget), set(commands))
+        for name, limits in budget.items():
+            proc = subprocess.run(
+                [sys.executable, '-c',
+                 'import sys\n'
+                 'from dotsecrets.main import load_command\n'
+                 'load_command({!r})\n'
+                 'print(" ".join(sys.modules))'.format(name)],
+                stdout=subprocess.PIPE, universal_newlines=True,
+                check=True)
+            modules = set(proc.stdout.split())
+            self.assertEqual(set(limits['forbidden']) & modules, set(),
+                             name)
+
+
+if __name__ == '__main__':
+    unittest.main()
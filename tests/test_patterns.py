@@ -0,0 +1,136 @@
+import logging
+import os
+import subprocess
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.clean import CleanFilter, get_clean_filter
+from dotsecrets.patterns import (PathMatcher, list_filtered_files,
+                                 resolve_name)
+from dotsecrets.smudge import get_smudge_filter
+
+
+FILTERS_YAML = """version: 2
+filters:
+  "hosts/*/mutt/.muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+  "hosts/work/mutt/.muttrc":
+    encoding: ascii
+"""
+
+
+class TestPathMatcher(unittest.TestCase):
+
+    def test_glob(self):
+        """Test glob characters match within a single component"""
+        matcher = PathMatcher(['hosts/*/.muttrc', 'config.[ab]', 'x?'])
+        self.assertEqual(matcher.match('hosts/home/.muttrc'),
+                         'hosts/*/.muttrc')
+        self.assertIsNone(matcher.match('hosts/a/b/.muttrc'))
+        self.assertEqual(matcher.match('config.b'), 'config.[ab]')
+        self.assertIsNone(matcher.match('config.c'))
+        self.assertEqual(matcher.match('xy'), 'x?')
+        self.assertIsNone(matcher.match('xyz'))
+
+    def test_any_depth(self):
+        """Test ** matches any number of components"""
+        matcher = PathMatcher(['**/.muttrc', 'a/**/b'])
+        self.assertEqual(matcher.match('.muttrc'), '**/.muttrc')
+        self.assertEqual(matcher.match('x/y/.muttrc'), '**/.muttrc')
+        self.assertEqual(matcher.match('a/b'), 'a/**/b')
+        self.assertEqual(matcher.match('a/x/y/b'), 'a/**/b')
+        self.assertIsNone(matcher.match('a/x/c'))
+
+    def test_directory(self):
+        """Test a trailing slash matches all paths below a directory"""
+        matcher = PathMatcher(['mutt/'])
+        self.assertEqual(matcher.match('mutt/.muttrc'), 'mutt/')
+        self.assertEqual(matcher.match('mutt/a/b'), 'mutt/')
+        self.assertIsNone(matcher.match('mutt'))
+        self.assertIsNone(matcher.match('muttrc/a'))
+
+    def test_precedence(self):
+        """Test an exact name wins, then the first matching pattern"""
+        names = ['mutt/', '*/.muttrc', 'mutt/.muttrc']
+        self.assertEqual(resolve_name('mutt/.muttrc', names),
+                         'mutt/.muttrc')
+        self.assertEqual(resolve_name('mutt/other', names), 'mutt/')
+        self.assertEqual(resolve_name('vim/.muttrc', names), '*/.muttrc')
+        self.assertEqual(resolve_name('vimrc', names), 'vimrc')
+
+    def test_matcher_reused(self):
+        """Test the patterns of a filters dictionary are compiled once"""
+        filters = {'mutt/': {}, '*/.muttrc': {}}
+        with mock.patch('dotsecrets.patterns.PathMatcher',
+                        wraps=PathMatcher) as matcher:
+            self.assertEqual(resolve_name('mutt/a', filters), 'mutt/')
+            self.assertEqual(resolve_name('vim/.muttrc', filters),
+                             '*/.muttrc')
+            self.assertEqual(matcher.call_count, 1)
+            resolve_name('mutt/a', dict(filters))
+            self.assertEqual(matcher.call_count, 2)
+
+
+class TestResolve(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.filters_file = self.tmp_path.joinpath('filters.yaml')
+        self.filters_file.write_text(FILTERS_YAML)
+        env = mock.patch.dict(os.environ,
+                              {'XDG_CACHE_HOME': str(self.tmp_path)})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_clean_filter(self):
+        """Test clean filters resolve patterns through the index"""
+        clean_filter = get_clean_filter('hosts/home/mutt/.muttrc',
+                                        self.filters_file)
+        self.assertIsInstance(clean_filter, CleanFilter)
+        self.assertEqual(list(clean_filter.rules), ['passwd'])
+        clean_filter = get_clean_filter('hosts/work/mutt/.muttrc',
+                                        self.filters_file)
+        self.assertEqual(clean_filter.encoding, 'ascii')
+
+    def test_smudge_filter(self):
+        """Test smudge filters resolve patterns in the secrets store"""
+        secrets_dict = {'filters': {'hosts/*/mutt/.muttrc': {
+            'secrets': {'passwd': {'secret': 's3cr3t'}}}}}
+        smudge_filter = get_smudge_filter('hosts/home/mutt/.muttrc',
+                                          secrets_dict=secrets_dict)
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 's3cr3t')
+
+    def test_list_files(self):
+        """Test patterns are matched against the files tracked by Git"""
+        dotfiles_path = self.tmp_path.joinpath('dotfiles')
+        for name in ('hosts/home/mutt/.muttrc', 'hosts/home/vimrc'):
+            dotfiles_path.joinpath(name).parent.mkdir(parents=True,
+                                                      exist_ok=True)
+            dotfiles_path.joinpath(name).write_text('set x\n')
+        try:
+            subprocess.run(['git', 'init', '-q'], cwd=str(dotfiles_path),
+                           check=True)
+            subprocess.run(['git', 'add', '.'], cwd=str(dotfiles_path),
+                           check=True)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('git is not available')
+        self.assertEqual(
+            list_filtered_files(dotfiles_path, ['hosts/*/mutt/.muttrc',
+                                                'vimrc']),
+            {'hosts/home/mutt/.muttrc': 'hosts/*/mutt/.muttrc',
+             'vimrc': 'vimrc'})
+
+
+if __name__ == '__main__':
+    unittest.main()
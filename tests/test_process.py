@@ -0,0 +1,158 @@
+import io
+import logging
+import unittest
+
+from dotsecrets.process import (FilterProcess,
+                                ProtocolError,
+                                read_pkt_line,
+                                read_pkt_text_list,
+                                read_pkt_content,
+                                write_pkt_line,
+                                write_pkt_flush,
+                                write_pkt_text_list,
+                                write_pkt_content)
+
+
+def pkt_session(*messages):
+    stream = io.BytesIO()
+    for lines, content in messages:
+        write_pkt_text_list(stream, lines)
+        if content is not None:
+            write_pkt_content(stream, content)
+    stream.seek(0)
+    return stream
+
+
+class TestPktLine(unittest.TestCase):
+
+    def test_pkt_line_roundtrip(self):
+        """Test writing and reading a single pkt-line"""
+        stream = io.BytesIO()
+        write_pkt_line(stream, b'hello\n')
+        write_pkt_flush(stream)
+        self.assertEqual(stream.getvalue(), b'000ahello\n0000')
+        stream.seek(0)
+        self.assertEqual(read_pkt_line(stream), b'hello\n')
+        self.assertIsNone(read_pkt_line(stream))
+
+    def test_pkt_content_split(self):
+        """Test large content is split over multiple pkt-lines"""
+        stream = io.BytesIO()
+        data = b'x' * 100000
+        write_pkt_content(stream, data)
+        stream.seek(0)
+        self.assertEqual(len(read_pkt_line(stream)), 65516)
+        stream.seek(0)
+        self.assertEqual(read_pkt_content(stream), data)
+
+    def test_pkt_eof(self):
+        """Test end of stream raises EOFError"""
+        with self.assertRaises(EOFError):
+            read_pkt_line(io.BytesIO())
+
+    def test_pkt_invalid_header(self):
+        """Test invalid header raises ProtocolError"""
+        with self.assertRaises(ProtocolError):
+            read_pkt_line(io.BytesIO(b'zzzz'))
+
+
+class TestFilterProcess(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        filters_dict = {
+            'filters': {
+                'muttrc': {
+                    'rules': {
+                        'passwd': {
+                            'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+                            'substitute': r'password\1=\2(?#Key)',
+                            'numbered': True
+                        }
+                    }
+                }
+            }
+        }
+        secrets_dict = {
+            'filters': {
+                'muttrc': {
+                    'secrets': {
+                        'passwd_1': {'secret': 's3cr3t'}
+                    }
+                }
+            }
+        }
+        self.process = FilterProcess(filters_dict=filters_dict,
+                                     secrets_dict=secrets_dict)
+
+    def run_session(self, *messages):
+        handshake = [(['git-filter-client', 'version=2'], None),
+                     (['capability=clean', 'capability=smudge',
+                       'capability=delay'], None)]
+        input_stream = pkt_session(*(handshake + list(messages)))
+        output_stream = io.BytesIO()
+        self.assertEqual(self.process.run(input_stream, output_stream), 0)
+        output_stream.seek(0)
+        self.assertEqual(read_pkt_text_list(output_stream),
+                         ['git-filter-server', 'version=2'])
+        self.assertEqual(read_pkt_text_list(output_stream),
+                         ['capability=clean', 'capability=smudge'])
+        return output_stream
+
+    def test_clean_twice(self):
+        """Test numbering restarts for every cleaned file"""
+        command = (['command=clean', 'pathname=muttrc'],
+                   b'password = s3cr3t\n')
+        output_stream = self.run_session(command, command)
+        for i in range(2):
+            self.assertEqual(read_pkt_text_list(output_stream),
+                             ['status=success'])
+            self.assertEqual(read_pkt_content(output_stream),
+                             b'password = $DotSecrets: passwd_1$\n')
+            self.assertEqual(read_pkt_text_list(output_stream), [])
+
+    def test_smudge(self):
+        """Test smudge of a tagged file"""
+        output_stream = self.run_session(
+            (['command=smudge', 'pathname=muttrc'],
+             b'password = $DotSecrets: passwd_1$\n'))
+        self.assertEqual(read_pkt_text_list(output_stream),
+                         ['status=success'])
+        self.assertEqual(read_pkt_content(output_stream),
+                         b'password = s3cr3t\n')
+
+    def test_smudge_pattern(self):
+        """Test smudge of several paths sharing the secrets of a pattern"""
+        secrets_dict = {
+            'filters': {
+                'hosts/*/muttrc': {
+                    'secrets': {
+                        'passwd': {'secret': 's3'}
+                    }
+                }
+            }
+        }
+        self.process = FilterProcess(filters_dict={'filters': {}},
+                                     secrets_dict=secrets_dict)
+        output_stream = self.run_session(
+            (['command=smudge', 'pathname=hosts/a/muttrc'],
+             b'password = $DotSecrets: passwd$\n'),
+            (['command=smudge', 'pathname=hosts/b/muttrc'],
+             b'password = $DotSecrets: passwd$\n'))
+        for i in range(2):
+            self.assertEqual(read_pkt_text_list(output_stream),
+                             ['status=success'])
+            self.assertEqual(read_pkt_content(output_stream),
+                             b'password = s3\n')
+            self.assertEqual(read_pkt_text_list(output_stream), [])
+
+    def test_unknown_command(self):
+        """Test unknown command results in error status"""
+        output_stream = self.run_session(
+            (['command=unknown', 'pathname=muttrc'], b''))
+        self.assertEqual(read_pkt_text_list(output_stream),
+                         ['status=error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import logging
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.clean import CleanFilter
+from dotsecrets.profiler import Profile
+from dotsecrets.smudge import SmudgeFilter
+from dotsecrets.stream import sub_bytes
+
+
+RULES = {
+    'passwd': {
+        'numbered': True,
+        'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+        'substitute': r'password\1=\2(?#Key)'
+    },
+    'user': {
+        'regex': r'user(\s*)=(\s*)(\S+)',
+        'substitute': r'user\1=\2(?#Key)'
+    }
+}
+
+SECRETS = {
+    'passwd_1': {'secret': 's3cr3t'},
+    'passwd_2': {'secret': 'other'},
+    'user': {'secret': 'me'},
+}
+
+CONTENT = ('# config\n'
+           'user = me\n'
+           'password = s3cr3t # comment\n'
+           'password = other\n').encode('utf-8')
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+
+    def test_clean(self):
+        """Test per rule statistics of a clean filter"""
+        expected = sub_bytes(CONTENT, CleanFilter('name', {'rules': RULES}))
+        clean_filter = CleanFilter('name', {'rules': RULES})
+        profile = Profile()
+        profile.add('clean', clean_filter)
+        self.assertEqual(sub_bytes(CONTENT, clean_filter), expected)
+        entry = profile.report()['filters'][0]
+        self.assertEqual(entry['command'], 'clean')
+        self.assertEqual(entry['lines'], 3)
+        self.assertEqual(set(entry['rules']),
+                         {'(combined)', 'passwd', 'user'})
+        self.assertEqual(entry['rules']['(combined)']['scans'], 3)
+        self.assertEqual(entry['rules']['passwd']['matches'], 2)
+        self.assertEqual(entry['rules']['passwd']['size_in'],
+                         len('password = s3cr3tpassword = other'))
+        self.assertEqual(entry['rules']['user']['matches'], 1)
+        self.assertIn("Clean filter 'name': 3 lines",
+                      profile.format_table())
+
+    def test_smudge(self):
+        """Test statistics of a smudge filter in text and binary mode"""
+        cleaned = sub_bytes(CONTENT, CleanFilter('name', {'rules': RULES}))
+        for read_mode in ('r', 'rb'):
+            smudge_filter = SmudgeFilter('name', dict(SECRETS))
+            smudge_filter.read_mode = read_mode
+            profile = Profile()
+            profile.add('smudge', smudge_filter)
+            self.assertEqual(sub_bytes(cleaned, smudge_filter), CONTENT)
+            tags = profile.report()['filters'][0]['rules']['(tags)']
+            self.assertEqual(tags['matches'], 3, read_mode)
+            self.assertEqual(tags['size_out'], len('mes3cr3tother'),
+                             read_mode)
+
+    def test_parallel(self):
+        """Test profiled filters are applied in the current process"""
+        expected = sub_bytes(CONTENT, CleanFilter('name', {'rules': RULES}))
+        clean_filter = CleanFilter('name', {'rules': RULES})
+        clean_filter.parallel = True
+        profile = Profile()
+        profile.add('clean', clean_filter)
+        with mock.patch('os.cpu_count', return_value=4):
+            self.assertEqual(sub_bytes(CONTENT, clean_filter), expected)
+        self.assertEqual(profile.report()['filters'][0]['lines'], 3)
+
+    def test_json(self):
+        """Test the JSON report written to a file"""
+        profile = Profile()
+        profile.add('smudge', SmudgeFilter('name', dict(SECRETS)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_file = Path(tmp_dir).joinpath('profile.json')
+            profile.write(json_file)
+            report = json.loads(json_file.read_text())
+        self.assertEqual(report['filters'][0]['filter'], 'name')
+
+
+if __name__ == '__main__':
+    unittest.main()
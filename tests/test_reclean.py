@@ -0,0 +1,120 @@
+import io
+import logging
+import os
+import subprocess
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.reclean import find_changed_files, reclean
+
+
+OLD_FILTERS_YAML = """version: 2
+filters:
+  "vimrc":
+    rules:
+      token:
+        regex: token(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: token\\1=\\2(?#Key)
+"""
+
+FILTERS_YAML = OLD_FILTERS_YAML + """  "mutt/*":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+"""
+
+
+class TestReclean(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.dotfiles_path = self.tmp_path.joinpath('dotfiles')
+        self.dotfiles_path.joinpath('mutt').mkdir(parents=True)
+        env = mock.patch.dict(os.environ,
+                              {'DOTFILES_PATH': str(self.dotfiles_path),
+                               'XDG_CACHE_HOME': str(self.tmp_path)})
+        env.start()
+        self.addCleanup(env.stop)
+        self.filters_file = self.dotfiles_path.joinpath('.dotfilters.yaml')
+        self.filters_file.write_text(OLD_FILTERS_YAML)
+        for name, content in (('mutt/.muttrc', 'password = s3cr3t\n'),
+                              ('mutt/other', 'set x\n'),
+                              ('vimrc', 'password = other\n')):
+            self.dotfiles_path.joinpath(name).write_text(content)
+        try:
+            self.git('init', '-q')
+            self.git('add', '.')
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('git is not available')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'dotfiles')
+        self.filters_file.write_text(FILTERS_YAML)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def git(self, *args):
+        return subprocess.run(('git',) + args, cwd=str(self.dotfiles_path),
+                              stdout=subprocess.PIPE, check=True
+                              ).stdout.decode('utf-8')
+
+    def run_reclean(self, **kwargs):
+        options = {'filters': None, 'store': None, 'since': 'HEAD',
+                   'all': False, 'jobs': 1, 'dry_run': False}
+        options.update(kwargs)
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            self.assertEqual(reclean(mock.Mock(**options)), 0)
+        return out.getvalue()
+
+    def test_changed_files(self):
+        """Test only paths with a new or changed filter are found"""
+        old_filters = {'vimrc': {}, 'mutt/other': {}}
+        filters = {'vimrc': {}, 'mutt/*': {'rules': {}}}
+        self.assertEqual(find_changed_files(self.dotfiles_path, filters,
+                                            old_filters),
+                         ['mutt/.muttrc', 'mutt/other'])
+        self.assertEqual(find_changed_files(self.dotfiles_path, filters),
+                         ['mutt/.muttrc', 'mutt/other', 'vimrc'])
+
+    def test_reclean(self):
+        """Test changed files are cleaned into the index"""
+        self.assertEqual(self.run_reclean(), 'changed\tmutt/.muttrc\n')
+        self.assertEqual(self.git('show', ':mutt/.muttrc'),
+                         'password = $DotSecrets: passwd$\n')
+        self.assertEqual(self.git('show', ':vimrc'), 'password = other\n')
+        # The working tree keeps its secrets
+        self.assertEqual(
+            self.dotfiles_path.joinpath('mutt/.muttrc').read_text(),
+            'password = s3cr3t\n')
+
+    def test_parallel(self):
+        """Test all files with a filter are cleaned in parallel"""
+        self.dotfiles_path.joinpath('vimrc').write_text('token = abc\n')
+        self.assertEqual(self.run_reclean(all=True, jobs=2),
+                         'changed\tmutt/.muttrc\nchanged\tvimrc\n')
+        self.assertEqual(self.git('show', ':vimrc'),
+                         'token = $DotSecrets: token$\n')
+
+    def test_dry_run(self):
+        """Test a dry run leaves the index alone"""
+        objects = self.git('cat-file', '--batch-check',
+                           '--batch-all-objects')
+        self.assertEqual(self.run_reclean(dry_run=True),
+                         'changed\tmutt/.muttrc\n')
+        self.assertEqual(self.git('show', ':mutt/.muttrc'),
+                         'password = s3cr3t\n')
+        # No objects are written either
+        self.assertEqual(
+            self.git('cat-file', '--batch-check', '--batch-all-objects'),
+            objects)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import logging
+import random
+import re
+import unittest
+
+from dotsecrets.clean import CleanFilter
+from dotsecrets.scanner import RuleScanner, required_literal
+
+
+def make_filter(rules):
+    return CleanFilter('name', {'rules': rules})
+
+
+class TestRequiredLiteral(unittest.TestCase):
+
+    def test_prefix(self):
+        """Test literal prefix of a rule"""
+        self.assertEqual(required_literal(re.compile(r'password(\s*)=')),
+                         'password')
+
+    def test_longest(self):
+        """Test longest literal is returned"""
+        self.assertEqual(required_literal(re.compile(r'nick\s*=\s*real_name')),
+                         'real_name')
+
+    def test_group(self):
+        """Test literal inside a required group"""
+        self.assertEqual(required_literal(re.compile(r'\s*(secret)+')),
+                         'secret')
+
+    def test_none(self):
+        """Test patterns without required literal"""
+        self.assertIsNone(required_literal(re.compile(r'a|b')))
+        self.assertIsNone(required_literal(re.compile(r'(abc)?\s+')))
+        self.assertIsNone(required_literal(re.compile(r'(?i)password')))
+
+
+class TestRuleScanner(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.rules = {
+            'passwd': {
+                'numbered': True,
+                'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+                'substitute': r'password\1=\2(?#Key)'
+            },
+            'nickname': {
+                'regex': r'nick(\s*)=(\s*)(?#QuotedString);',
+                'substitute': r'nick\1=\2"(?#Key)";'
+            },
+            'realname': {
+                'regex': r'real_name(\s*)=(\s*)(?#QuotedString);',
+                'substitute': r'real_name\1=\2"(?#Key)";'
+            }
+        }
+
+    def assert_equivalent(self, rules, lines):
+        combined = make_filter(rules)
+        sequential = make_filter(rules)
+        sequential.scanner = None
+        self.assertIsNotNone(combined.scanner)
+        for line in lines:
+            self.assertEqual(combined.sub(line), sequential.sub(line), line)
+        for key in rules:
+            self.assertEqual(combined.rules[key].n,
+                             sequential.rules[key].n)
+
+    def test_unsupported(self):
+        """Test fallback to sequential rules"""
+        self.assertIsNone(make_filter({}).scanner)
+        self.assertIsNone(make_filter({
+            'a': {'regex': r'(a)\1', 'substitute': 'b'},
+            'b': {'regex': r'b', 'substitute': 'c'}}).scanner)
+        self.assertIsNone(make_filter({
+            'a': {'regex': r'(?i)a', 'substitute': 'b'},
+            'b': {'regex': r'b', 'substitute': 'c'}}).scanner)
+        self.assertIsNone(make_filter({
+            'a': {'regex': r'(?P<x>a)', 'substitute': 'b'},
+            'b': {'regex': r'(?P<x>b)', 'substitute': 'c'}}).scanner)
+
+    def test_lines(self):
+        """Test combined scan equals sequential rules"""
+        lines = [
+            'no secrets here\n',
+            'password = s3cr3t # comment\n',
+            'password = a; password = b # nick = "x";\n',
+            '  nick = "mynick";\n',
+            'real_name = "My Name"; nick = \'n\';\n',
+            'password = nick = "x";\n',
+        ]
+        self.assert_equivalent(self.rules, lines)
+
+    def test_chained_rules(self):
+        """Test later rule matching substituted output"""
+        rules = {
+            'first': {'regex': r'user=(\w+)',
+                      'substitute': r'user=(?#Key) pass=x'},
+            'second': {'regex': r'pass=(\w+)',
+                       'substitute': r'pass=(?#Key)'}
+        }
+        self.assert_equivalent(rules, ['user=bob\n', 'pass=y user=bob\n'])
+
+    def test_random_lines(self):
+        """Test combined scan equals sequential rules on random input"""
+        rng = random.Random(42)
+        words = ['password', '=', ' ', '#', '"a b"', "'c'", 'nick',
+                 'real_name', ';', 'x', '$DotSecrets: k$']
+        lines = [''.join(rng.choice(words) for i in range(12)) + '\n'
+                 for j in range(500)]
+        self.assert_equivalent(self.rules, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,6 +49,14 @@ class TestSmudgeFilter(unittest.TestCase):
                          'password = s3cr3t; security question = '
                          'h1dd3n 4g3nd4 # comment')
 
+    def test_prefilter(self):
+        """Test lines without a secret tag skip the regex"""
+        self.assertEqual(self.filters[0].sub('password = s3cr3t'),
+                         'password = s3cr3t')
+        self.filters[0].sub('password = $DotSecrets: password$')
+        self.assertEqual((self.filters[0].skipped, self.filters[0].lines),
+                         (1, 2))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,163 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets import smudge
+from dotsecrets.cache import remove_shared_secrets
+from dotsecrets.index import IndexReader
+from dotsecrets.smudge import (SmudgeFilter, get_smudge_filter,
+                               load_shared_secrets, reap_shared_secrets)
+from dotsecrets.store import compile_store
+from dotsecrets.textsub import CopyFilter
+from dotsecrets.utils import get_shared_secrets_file
+
+
+SECRETS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    secrets:
+      passwd:
+        secret: s3cr3t
+  "vimrc":
+    secrets:
+      passwd:
+        secret: other
+"""
+
+
+class TestCompiledStore(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.secrets_file = Path(self.tmp_dir.name).joinpath(
+            'dotsecrets.yaml')
+        self.secrets_file.write_text(SECRETS_YAML)
+        self.set_old_mtime()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def set_old_mtime(self):
+        # Avoid the racy check by backdating the store
+        st = self.secrets_file.stat()
+        os.utime(str(self.secrets_file), (st.st_atime - 60,
+                                          st.st_mtime - 60))
+
+    def test_compile(self):
+        """Test the compiled store indexes the secrets per filter"""
+        compiled_file = compile_store(self.secrets_file)
+        self.assertEqual(compiled_file.name, 'dotsecrets.yaml.idx')
+        self.assertEqual(os.stat(str(compiled_file)).st_mode & 0o077, 0)
+        with compiled_file.open(mode='rb') as f:
+            reader = IndexReader(f)
+            self.assertEqual(set(reader), {'mutt/.muttrc', 'vimrc'})
+            self.assertEqual(reader.get('vimrc'),
+                             {'secrets': {'passwd': {'secret': 'other'}}})
+
+    def test_smudge_compiled(self):
+        """Test smudge loads a single filter without parsing the store"""
+        compile_store(self.secrets_file)
+        with mock.patch.object(smudge, 'load_yaml') as load_yaml:
+            smudge_filter = get_smudge_filter('vimrc', self.secrets_file)
+            missing_filter = get_smudge_filter('missing', self.secrets_file)
+        load_yaml.assert_not_called()
+        self.assertIsInstance(smudge_filter, SmudgeFilter)
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 'other')
+        self.assertIsInstance(missing_filter, CopyFilter)
+
+    def test_rebuild(self):
+        """Test a changed store is compiled again on smudge"""
+        compile_store(self.secrets_file)
+        self.secrets_file.write_text(SECRETS_YAML.replace('other', 'new'))
+        self.set_old_mtime()
+        smudge_filter = get_smudge_filter('vimrc', self.secrets_file)
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 'new')
+
+
+class TestSharedStore(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.secrets_file = tmp_path.joinpath('dotsecrets.yaml')
+        self.secrets_file.write_text(SECRETS_YAML)
+        st = self.secrets_file.stat()
+        os.utime(str(self.secrets_file), (st.st_atime - 60,
+                                          st.st_mtime - 60))
+        self.runtime_path = tmp_path.joinpath('run')
+        env = mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR':
+                                           str(self.runtime_path),
+                                           'DOTSECRETS_SHARED': '1'})
+        env.start()
+        self.addCleanup(env.stop)
+        self.shared_file = get_shared_secrets_file(self.secrets_file)
+        reaper = mock.patch.object(smudge, 'start_shared_reaper')
+        self.start_reaper = reaper.start()
+        self.addCleanup(reaper.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_shared(self):
+        """Test later smudge processes do not parse the store"""
+        smudge_filter = get_smudge_filter('vimrc', self.secrets_file)
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 'other')
+        self.assertEqual(os.stat(str(self.shared_file)).st_mode & 0o077, 0)
+        with mock.patch.object(smudge, 'load_yaml') as load_yaml:
+            smudge_filter = get_smudge_filter('mutt/.muttrc',
+                                              self.secrets_file)
+        load_yaml.assert_not_called()
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 's3cr3t')
+        # Only the process creating the shared store starts a reaper
+        self.start_reaper.assert_called_once()
+
+    def test_expired(self):
+        """Test an unused shared store is removed and parsed again"""
+        load_shared_secrets('vimrc', self.secrets_file)
+        os.utime(str(self.shared_file), (0, 0))
+        with mock.patch.object(smudge, 'load_yaml',
+                               wraps=smudge.load_yaml) as load_yaml:
+            load_shared_secrets('vimrc', self.secrets_file)
+        load_yaml.assert_called_once()
+        self.assertGreater(self.shared_file.stat().st_mtime, 0)
+
+    def test_reaper(self):
+        """Test the reaper removes the shared store once unused"""
+        load_shared_secrets('vimrc', self.secrets_file)
+        lock_file = self.start_reaper.call_args[0][1]
+        with mock.patch.object(smudge, 'DOTSECRETS_SHARED_TIMEOUT', 0), \
+                mock.patch.object(smudge.time, 'sleep') as sleep:
+            reap_shared_secrets(self.shared_file, lock_file)
+        sleep.assert_called_once()
+        self.assertFalse(self.shared_file.exists())
+
+    def test_cache_clear(self):
+        """Test clearing the cache removes the shared store"""
+        load_shared_secrets('vimrc', self.secrets_file)
+        self.assertEqual(remove_shared_secrets(), 1)
+        self.assertFalse(self.shared_file.exists())
+        self.assertEqual(remove_shared_secrets(), 0)
+
+    def test_not_enabled(self):
+        """Test a single smudge leaves no shared store behind"""
+        with mock.patch.dict(os.environ, {'DOTSECRETS_SHARED': ''}):
+            smudge_filter = get_smudge_filter('vimrc', self.secrets_file)
+        self.assertEqual(smudge_filter.secrets['passwd'].secret, 'other')
+        self.assertFalse(self.runtime_path.exists())
+        self.start_reaper.assert_not_called()
+
+    def test_no_runtime_dir(self):
+        """Test secrets are not shared without a runtime directory"""
+        with mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': ''}):
+            self.assertIsNone(load_shared_secrets('vimrc',
+                                                  self.secrets_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
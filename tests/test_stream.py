@@ -0,0 +1,321 @@
+import errno
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets.clean import CleanFilter
+from dotsecrets.smudge import SmudgeFilter
+from dotsecrets.stream import (ChunkedTextFilter, copy_stream, sub_bytes,
+                               sub_chunked, sub_file, sub_parallel,
+                               sub_regex_chunk, sub_stream, use_chunked,
+                               use_parallel)
+from dotsecrets.textsub import CopyFilter
+
+
+RULES = {
+    'passwd': {
+        'numbered': True,
+        'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+        'substitute': r'password\1=\2(?#Key)'
+    },
+    'user': {
+        'regex': r'^user(\s*)=(\s*)(\S+)',
+        'substitute': r'user\1=\2(?#Key)'
+    }
+}
+
+CONTENT = ('# config\r\n'
+           'user = me\r\n'
+           '  user = notme\n'
+           'password\n'
+           '= notasecret\n'
+           'password = s3cr3t # comment\r'
+           'other = 1\n'
+           'password = last')
+
+
+def make_filters(buffered, rules=RULES):
+    clean_filter = CleanFilter('name', dict(rules=rules, buffered=buffered))
+    smudge_filter = SmudgeFilter('name', {
+        'passwd_1': {'secret': 's3cr3t'},
+        'passwd_2': {'secret': 'last'},
+        'user': {'secret': 'me'},
+    })
+    smudge_filter.buffered = buffered
+    return clean_filter, smudge_filter
+
+
+class TestBuffered(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.data = CONTENT.encode('utf-8')
+
+    def assert_same(self, rules=RULES):
+        line_clean, line_smudge = make_filters(False, rules)
+        buf_clean, buf_smudge = make_filters(True, rules)
+        cleaned = sub_bytes(self.data, line_clean)
+        self.assertEqual(sub_bytes(self.data, buf_clean), cleaned)
+        self.assertEqual(sub_bytes(cleaned, buf_smudge),
+                         sub_bytes(cleaned, line_smudge))
+        return cleaned
+
+    def test_same_output(self):
+        """Test buffered mode output equals line mode output"""
+        cleaned = self.assert_same()
+        self.assertIn(b'user = $DotSecrets: user$\n', cleaned)
+        self.assertIn(b'  user = notme\n', cleaned)
+        self.assertIn(b'password\n= notasecret\n', cleaned)
+        self.assertTrue(cleaned.endswith(b'$DotSecrets: passwd_2$'))
+
+    def test_same_output_without_literals(self):
+        """Test buffered mode for rules without required literal"""
+        rules = dict(RULES, any={'regex': r'(\w+) = 1',
+                                 'substitute': r'\1 = (?#Key)'})
+        self.assert_same(rules)
+
+    def test_file(self):
+        """Test buffered mode on a memory mapped file"""
+        line_clean, line_smudge = make_filters(False)
+        buf_clean, buf_smudge = make_filters(True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = Path(tmp_dir).joinpath('input')
+            output_file = Path(tmp_dir).joinpath('output')
+            input_file.write_bytes(self.data)
+            sub_file(input_file, output_file, buf_clean)
+            self.assertEqual(output_file.read_bytes(),
+                             sub_bytes(self.data, line_clean))
+            input_file.write_bytes(b'')
+            sub_file(input_file, output_file, buf_clean)
+            self.assertEqual(output_file.read_bytes(), b'')
+
+
+class TestChunkedText(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.data = (CONTENT + '\n'
+                     'password = s\u00e9cr\u00e9t\n'
+                     'password =\u00a0nbsp # comment\r\n'
+                     'user = \u00e9\x1cx\r'
+                     'user=me\u2028password = x y\n').encode('utf-8')
+
+    def line_path(self, data, text_filter):
+        input_text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+        output_stream = io.BytesIO()
+        output_text = io.TextIOWrapper(output_stream, encoding='utf-8')
+        sub_stream(input_text, output_text, text_filter)
+        output_text.flush()
+        return output_stream.getvalue()
+
+    def chunked(self, data, text_filter, chunk_size):
+        output_stream = io.BytesIO()
+        sub_chunked(io.BytesIO(data), output_stream,
+                    ChunkedTextFilter(text_filter), chunk_size)
+        return output_stream.getvalue()
+
+    def test_same_output(self):
+        """Test chunks of lines give the output of line mode"""
+        line_clean, line_smudge = make_filters(None)
+        cleaned = self.line_path(self.data, line_clean)
+        smudged = self.line_path(cleaned, line_smudge)
+        for chunk_size in (1, 2, 3, 16, 1024):
+            clean_filter, smudge_filter = make_filters(None)
+            self.assertTrue(use_chunked(clean_filter))
+            self.assertEqual(self.chunked(self.data, clean_filter,
+                                          chunk_size),
+                             cleaned, chunk_size)
+            self.assertEqual(self.chunked(cleaned, smudge_filter,
+                                          chunk_size),
+                             smudged, chunk_size)
+
+    def test_unsupported(self):
+        """Test encodings where a newline byte can be part of a character"""
+        clean_filter, smudge_filter = make_filters(None)
+        clean_filter.encoding = 'utf-16'
+        self.assertFalse(use_chunked(clean_filter))
+        self.assertFalse(use_chunked(CopyFilter()))
+
+    def test_invalid(self):
+        """Test invalid input fails as in line mode"""
+        clean_filter, smudge_filter = make_filters(None)
+        with self.assertRaises(UnicodeDecodeError):
+            self.chunked(b'user = \xff\n', clean_filter, 4)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.data = (CONTENT + '\n').encode('utf-8') * 20
+
+    def test_same_output(self):
+        """Test chunks filtered in parallel give the sequential output"""
+        line_clean, line_smudge = make_filters(None)
+        cleaned = sub_bytes(self.data, line_clean)
+        smudged = sub_bytes(cleaned, line_smudge)
+        self.assertIn(b'$DotSecrets: passwd_40$', cleaned)
+        for chunk_size in (1, 100, 1024):
+            clean_filter, smudge_filter = make_filters(None)
+            self.assertEqual(b''.join(sub_parallel(self.data, clean_filter,
+                                                   2, chunk_size)),
+                             cleaned, chunk_size)
+            self.assertEqual(clean_filter.counters(), {'passwd': 40})
+            self.assertEqual(b''.join(sub_parallel(cleaned, smudge_filter,
+                                                   2, chunk_size)),
+                             smudged, chunk_size)
+
+    def test_file(self):
+        """Test a memory mapped file filtered in parallel"""
+        line_clean, line_smudge = make_filters(None)
+        clean_filter, smudge_filter = make_filters(None)
+        clean_filter.parallel = True
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = Path(tmp_dir).joinpath('input')
+            output_file = Path(tmp_dir).joinpath('output')
+            input_file.write_bytes(self.data)
+            sub_file(input_file, output_file, clean_filter)
+            self.assertEqual(output_file.read_bytes(),
+                             sub_bytes(self.data, line_clean))
+
+    def test_setting(self):
+        """Test the parallel setting overrides the size of the input"""
+        clean_filter, smudge_filter = make_filters(None)
+        self.assertFalse(use_parallel(clean_filter, len(self.data)))
+        clean_filter.parallel = False
+        self.assertFalse(use_parallel(clean_filter, 1024 ** 4))
+        self.assertFalse(use_parallel(CopyFilter(), 1024 ** 4))
+
+
+class TestCopy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_file = Path(self.tmp_dir.name).joinpath('input')
+        self.output_file = Path(self.tmp_dir.name).joinpath('output')
+        self.data = bytes(range(256)) * 5000
+        self.input_file.write_bytes(self.data)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_file(self):
+        """Test files without a filter are copied as is"""
+        sub_file(self.input_file, self.output_file, CopyFilter())
+        self.assertEqual(self.output_file.read_bytes(), self.data)
+        self.assertEqual(sub_bytes(self.data, CopyFilter()), self.data)
+
+    def test_buffered_input(self):
+        """Test data already read from the input stream is skipped"""
+        with self.input_file.open(mode='rb') as input_stream, \
+                self.output_file.open(mode='wb') as output_stream:
+            output_stream.write(input_stream.read(10))
+            copy_stream(input_stream, output_stream)
+        self.assertEqual(self.output_file.read_bytes(), self.data)
+
+    def test_pipe(self):
+        """Test a pipe is copied into a file"""
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            with open(write_fd, mode='wb') as f:
+                f.write(self.data)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        with open(read_fd, mode='rb') as input_stream, \
+                self.output_file.open(mode='wb') as output_stream:
+            sub_stream(input_stream, output_stream, CopyFilter())
+        writer.join()
+        self.assertEqual(self.output_file.read_bytes(), self.data)
+
+    def test_fallback(self):
+        """Test copying in Python when the kernel can not copy"""
+        unsupported = OSError(errno.EINVAL, 'Invalid argument')
+        with mock.patch('os.sendfile', side_effect=unsupported,
+                        create=True), \
+                mock.patch('os.copy_file_range', side_effect=unsupported,
+                           create=True):
+            sub_file(self.input_file, self.output_file, CopyFilter())
+        self.assertEqual(self.output_file.read_bytes(), self.data)
+        output_stream = io.BytesIO()
+        copy_stream(io.BytesIO(self.data), output_stream)
+        self.assertEqual(output_stream.getvalue(), self.data)
+
+
+class WindowFilter(object):
+    """Binary filter with matches of at most 6 bytes."""
+    read_mode = 'rb'
+    regex = re.compile(rb'(?<=x)ab{1,3}c|^z')
+    overlap = 6
+
+    def sub_chunk(self, data, start, limit):
+        return sub_regex_chunk(self.regex, lambda m: b'<' + m.group(0) + b'>',
+                               data, start, limit)
+
+
+class TestChunked(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+
+    def chunked(self, data, chunk_filter, chunk_size):
+        output_stream = io.BytesIO()
+        sub_chunked(io.BytesIO(data), output_stream, chunk_filter,
+                    chunk_size)
+        return output_stream.getvalue()
+
+    def test_window(self):
+        """Test matches straddling chunks within the overlap window"""
+        data = b'zxabcxabbbc abc xabbbbc\nzxabbc' * 5
+        expected = WindowFilter.regex.sub(lambda m: b'<' + m.group(0) + b'>',
+                                          data)
+        for chunk_size in range(1, 20):
+            self.assertEqual(self.chunked(data, WindowFilter(), chunk_size),
+                             expected, chunk_size)
+
+    def test_smudge_binary(self):
+        """Test secret tags straddling chunks in binary mode"""
+        smudge_filter = SmudgeFilter('name', {
+            'passwd': {'secret': 's3cr3t'},
+            'user': {'secret': 'm\u00e9'},
+        })
+        smudge_filter.read_mode = 'rb'
+        data = ('a = $DotSecrets: passwd$ b = $DotSecrets: user$\r\n'
+                'c = $DotSecrets: other$ $DotSecrets: passwd$\n'
+                '\x00\xff$DotSecrets: user$').encode('latin1')
+        expected = data.replace(b'$DotSecrets: passwd$', b's3cr3t') \
+            .replace(b'$DotSecrets: user$', b'm\xc3\xa9')
+        for chunk_size in (1, 2, 3, 5, 8, 13, 1024):
+            self.assertEqual(self.chunked(data, smudge_filter, chunk_size),
+                             expected, chunk_size)
+        self.assertEqual(sub_bytes(data, smudge_filter), expected)
+
+    def test_smudge_no_newlines(self):
+        """Test input without line ends is smudged in bounded chunks"""
+        smudge_filter = SmudgeFilter('name', {'passwd': {'secret': 'x'}})
+        smudge_filter.read_mode = 'rb'
+        long_tag = '$DotSecrets: ' + 'k' * 256 + '$'
+        data = ('$DotSecrets: passwd$ ' * 2000 + long_tag).encode('ascii')
+        sizes = []
+        sub_chunk = smudge_filter.sub_chunk
+
+        def sized_sub_chunk(data, start, limit):
+            sizes.append(len(data))
+            return sub_chunk(data, start, limit)
+
+        smudge_filter.sub_chunk = sized_sub_chunk
+        self.assertEqual(self.chunked(data, smudge_filter, 1024),
+                         ('x ' * 2000 + long_tag).encode('ascii'))
+        self.assertLessEqual(max(sizes), 1024 + 2 * smudge_filter.overlap)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from dotsecrets import test as test_cmd
+from dotsecrets.clean import CleanFilter
+from dotsecrets.smudge import SmudgeFilter
+from dotsecrets.test import check_file
+
+
+FILTERS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+  "vimrc":
+    rules:
+      passwd:
+        regex: password(\\s*)=(\\s*)(?#WSUpToHash)
+        substitute: password\\1=\\2(?#Key)
+"""
+
+SECRETS_YAML = """version: 2
+filters:
+  "mutt/.muttrc":
+    secrets:
+      passwd:
+        secret: s3cr3t
+  "vimrc":
+    secrets:
+      passwd:
+        secret: typo
+"""
+
+SOURCE = 'set x\npassword = s3cr3t # comment\nset y\n'
+
+RULES = {
+    'passwd': {
+        'regex': r'password(\s*)=(\s*)(?#WSUpToHash)',
+        'substitute': r'password\1=\2(?#Key)'
+    }
+}
+
+
+class TestCheckFile(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source_file = Path(self.tmp_dir.name).joinpath('config')
+        self.source_file.write_text(SOURCE)
+        self.clean_filter = CleanFilter('config', {'rules': RULES})
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_passed(self):
+        """Test a round trip without intermediate files or diffs"""
+        smudge_filter = SmudgeFilter('config', {'passwd':
+                                                {'secret': 's3cr3t'}})
+        passed, diffs = check_file(self.source_file, self.clean_filter,
+                                   smudge_filter)
+        self.assertTrue(passed)
+        self.assertEqual(diffs, [])
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['config'])
+
+    def test_differ(self):
+        """Test a smudge mismatch renders both diffs"""
+        smudge_filter = SmudgeFilter('config', {'passwd':
+                                                {'secret': 'typo'}})
+        passed, diffs = check_file(self.source_file, self.clean_filter,
+                                   smudge_filter)
+        self.assertFalse(passed)
+        self.assertEqual(len(diffs), 2)
+        self.assertIn('+password = $DotSecrets: passwd$ # comment\n',
+                      diffs[0])
+        self.assertIn('-password = s3cr3t # comment\n'
+                      '+password = typo # comment\n', diffs[1])
+        self.assertIn(str(self.source_file) + '.dotsmudge', diffs[1])
+
+    def test_keep(self):
+        """Test intermediate files are kept on request"""
+        smudge_filter = SmudgeFilter('config', {'passwd':
+                                                {'secret': 's3cr3t'}})
+        passed, diffs = check_file(self.source_file, self.clean_filter,
+                                   smudge_filter, show_clean=True,
+                                   keep=True)
+        self.assertTrue(passed)
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(
+            Path(self.tmp_dir.name).joinpath('config.dotsmudge').read_text(),
+            SOURCE)
+
+    def test_no_secrets(self):
+        """Test a source left untouched by cleaning fails"""
+        self.source_file.write_text('set x\n')
+        passed, diffs = check_file(self.source_file, self.clean_filter,
+                                   SmudgeFilter('config'))
+        self.assertFalse(passed)
+
+
+class TestAll(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(level=logging.CRITICAL)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        dotfiles_path = tmp_path.joinpath('dotfiles')
+        dotfiles_path.joinpath('mutt').mkdir(parents=True)
+        for name in ('mutt/.muttrc', 'vimrc'):
+            dotfiles_path.joinpath(name).write_text(SOURCE)
+        self.filters_file = tmp_path.joinpath('filters.yaml')
+        self.filters_file.write_text(FILTERS_YAML)
+        self.secrets_file = tmp_path.joinpath('secrets.yaml')
+        self.secrets_file.write_text(SECRETS_YAML)
+        env = mock.patch.dict(os.environ,
+                              {'DOTFILES_PATH': str(dotfiles_path),
+                               'XDG_CACHE_HOME': str(tmp_path)})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_all(self):
+        """Test all files in parallel, reporting only the failure"""
+        args = argparse.Namespace(all=True, name=None, jobs=2, keep=False,
+                                  filters=self.filters_file,
+                                  store=self.secrets_file,
+                                  profile=False, profile_json=None)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(test_cmd.test(args), 1)
+        lines = output.getvalue().splitlines()
+        self.assertIn('ok\tmutt/.muttrc', lines)
+        self.assertIn('fail\tvimrc', lines)
+        self.assertIn('+password = typo # comment', lines)
+        self.assertNotIn('+password = s3cr3t # comment', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()